@@ -62,6 +62,82 @@ ANNOTATION_ENDPOINT = 'gene'
 QUERY_ENDPOINT = 'query'
 API_VERSION = 'v3'
 
+# *****************************************************************************
+# Response cache
+# *****************************************************************************
+# max. total size (in bytes of serialized JSON) of the in-process cache of
+# /gene and /query responses. Set to 0 to disable the cache.
+RESPONSE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# time-to-live (in seconds) of a cached response
+RESPONSE_CACHE_TTL = 3600
+# how often (in seconds) to check if ES indices were rebuilt/swapped,
+# which empties the cache
+RESPONSE_CACHE_CHECK_INTERVAL = 60
+
+# *****************************************************************************
+# ES clients (web API)
+# *****************************************************************************
+# max. number of keep-alive connections to each ES node, per process
+ES_MAX_CONNECTIONS_PER_NODE = 25
+# discover ES nodes from the cluster (at startup, on connection failures
+# and every ES_SNIFF_INTERVAL seconds), instead of only using ES_HOST
+ES_SNIFF = False
+ES_SNIFF_INTERVAL = 300
+# timeout (in seconds) of requests from the blocking client
+ES_REQUEST_TIMEOUT = 30
+# max. number of concurrent requests to ES from one process (all nodes)
+ES_ASYNC_MAX_CLIENTS = 500
+# max. number of concurrent requests to one ES node from one process
+ES_ASYNC_MAX_PER_HOST = 100
+# timeouts (in seconds)
+ES_ASYNC_CONNECT_TIMEOUT = 5
+ES_ASYNC_REQUEST_TIMEOUT = 30
+
+# *****************************************************************************
+# Batch queries
+# *****************************************************************************
+# POST /gene and /query requests with more ids than this are looked up and
+# streamed back (as a chunked JSON array) this many ids at a time.
+# Set to 0 to never stream.
+MGET_STREAM_BATCH_SIZE = 1000
+
+# *****************************************************************************
+# Export
+# *****************************************************************************
+# /export scrolls all shards in parallel, this many docs per shard and page
+EXPORT_SCROLL_SIZE = 1000
+# how long ES keeps a scroll between two pages
+EXPORT_SCROLL_TIME = '5m'
+
+# *****************************************************************************
+# Genomic interval index
+# *****************************************************************************
+# taxids of species whose genomic positions are kept in an in-process index
+# to answer "chr:start-end" queries (e.g. [9606, 10090]). Empty list to
+# always use ES nested queries.
+GENOMIC_INTERVAL_INDEX_SPECIES = []
+# how often (in seconds) to check if ES indices changed, to rebuild it
+GENOMIC_INTERVAL_INDEX_CHECK_INTERVAL = 60
+
+# *****************************************************************************
+# Named filters
+# *****************************************************************************
+# how often (in seconds) to check if named filters ("userfilter" parameter)
+# changed, to reload them
+USERFILTERS_CHECK_INTERVAL = 60
+
+# *****************************************************************************
+# Returned fields
+# *****************************************************************************
+# fields left out of returned docs when no "fields" parameter is given (they
+# are still returned when asked for), e.g. large fields not indexed like
+# ['exons', 'exons_hg19', 'generif', 'reporter']. Field costs (average
+# bytes) are in "field_costs" of the index metadata (see
+# DataBuilder.get_field_costs), bytes saved in /status/cache.
+ES_SOURCE_DEFAULT_EXCLUDES = []
+# number of docs sampled to compute field costs of a build
+FIELD_COSTS_SAMPLE_SIZE = 1000
+
 # *****************************************************************************
 # Tests
 # *****************************************************************************
@@ -124,3 +200,98 @@ DATA_SRC_BUILD_COLLECTION = 'src_build'     # for src data build information
 DATA_SRC_DATABASE = 'genedoc_src'
 
 DATA_TARGET_MASTER_COLLECTION = 'db_master'
+
+# DataBuilder merge: updates from source docs are sent to the target
+# collection in bulk writes of about this many bytes
+MERGE_BULK_BATCH_BYTES = 16 * 1024 * 1024
+# DataBuilder parallel merge (use_parallel=True): number of worker
+# processes, None for the number of CPUs, and source collections are split
+# in _id ranges of this many docs, merged one per task
+MERGE_PROCESSES = None
+MERGE_PARTITION_SIZE = 100000
+# local folder where DataBuilder keeps id mappings (retired -> current
+# Entrez gene ids, Ensembl -> Entrez gene ids) as memory-mapped files, an
+# absolute path; None for "idmapping" in DATA_ARCHIVE_ROOT
+IDMAPPING_FOLDER = None
+
+# ESIndexer parallel mode (build_index with use_parallel=True):
+# number of worker processes, None for the number of CPUs
+ES_INDEXER_PROCESSES = None
+# docs are split in _id ranges of this many docs, indexed one per task
+ES_INDEXER_PARTITION_SIZE = 100000
+# number of threads sending bulk requests in each worker process
+ES_INDEXER_BULK_THREADS = 2
+
+# ESIndexer bulk requests (sequential mode) are sized in bytes, between
+# ES_BULK_MIN_CHUNK_BYTES and ES_BULK_MAX_CHUNK_BYTES, starting with
+# ES_BULK_CHUNK_BYTES: grown while ES takes less than half
+# ES_BULK_TARGET_TOOK seconds to process one, shrunk when it takes longer
+# or rejects docs (bulk queue full)
+ES_BULK_CHUNK_BYTES = 5 * 1024 * 1024
+ES_BULK_MIN_CHUNK_BYTES = 256 * 1024
+ES_BULK_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+ES_BULK_TARGET_TOOK = 2
+# rejected docs are resent up to ES_BULK_MAX_RETRIES times, after an
+# exponential backoff of at most ES_BULK_MAX_BACKOFF seconds
+ES_BULK_MAX_RETRIES = 10
+ES_BULK_MAX_BACKOFF = 60
+# docs failing indexing with a transient error (rejected, ES node error or
+# unreachable) are sent up to this many times in total
+ES_INDEXER_MAX_ATTEMPTS = 3
+# collection (in target db) where docs which could not be indexed are recorded
+ES_INDEXER_DEAD_LETTER_COLLECTION = 'es_indexer_failed'
+
+# route docs to shards by taxid: ESIndexer indexes docs with their taxid as
+# routing value, and queries on given species only search the shards holding
+# these species (instead of all shards). A query API only sets it once its
+# indices were built with it (docs of the tier-1 index are always routed).
+ES_ROUTING_BY_TAXID = False
+
+# settings of an index built by ESIndexer.build_index
+ES_INDEX_BUILD_PROFILE = {
+    # while bulk indexing: no replicas (added once done), no refresh,
+    # translog fsynced in background, no throttling of merges I/O
+    "bulk_settings": {
+        "index": {
+            "number_of_replicas": 0,
+            "auto_expand_replicas": "false",
+            "refresh_interval": "-1",
+            "translog.durability": "async",
+            "translog.flush_threshold_size": "1gb",
+            "store.throttle.type": "none",
+        }
+    },
+    # once bulk indexing is done (or failed), back to default settings
+    "settings": {
+        "index": {
+            "refresh_interval": "1s",
+            "translog.durability": "request",
+            "translog.flush_threshold_size": "512mb",
+            "store.throttle.type": "node",
+        }
+    },
+    # then segments are merged down to this number per shard
+    "max_num_segments": 5,
+    # then replicas are added
+    "replica_settings": {
+        "index": {
+            "auto_expand_replicas": "0-all",
+        }
+    },
+    # max. time (in seconds) to wait for merges and replicas
+    "timeout": 3600,
+    # and finally these queries are run on each node, to load caches
+    "warmup_queries": [
+        {"query": {"query_string": {"query": "cdk2"}}},
+        {"query": {"term": {"entrezgene": 1017}}},
+        {"query": {"match_all": {}}, "size": 0,
+         "aggs": {"taxid": {"terms": {"field": "taxid"}},
+                  "type_of_gene": {"terms": {"field": "type_of_gene"}}}},
+        {"query": {"nested": {
+            "path": "genomic_pos",
+            "query": {"bool": {"must": [
+                {"term": {"genomic_pos.chr": "1"}},
+                {"range": {"genomic_pos.start": {"lte": 10000000}}},
+                {"range": {"genomic_pos.end": {"gte": 1000000}}}]}}}}},
+    ],
+}
@@ -3,6 +3,11 @@ Backend for storing merged genedoc after building.
 Support MongoDB, ES, CouchDB
 '''
 from __future__ import print_function
+from bson import BSON
+from pymongo import UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
+
+from config import MERGE_BULK_BATCH_BYTES
 
 
 class GeneDocBackendBase:
@@ -19,6 +24,15 @@ class GeneDocBackendBase:
         '''update only, no upsert.'''
         raise NotImplemented
 
+    def update_many(self, updates):
+        '''update docs from "updates", an iterable of (id, extra_doc),
+           return a dict of counts ("updates", "failed"...).'''
+        cnt = 0
+        for id, extra_doc in updates:
+            self.update(id, extra_doc)
+            cnt += 1
+        return {'updates': cnt, 'failed': 0}
+
     def drop(self):
         raise NotImplemented
 
@@ -28,6 +42,15 @@ class GeneDocBackendBase:
     def get_from_id(self, id):
         raise NotImplemented
 
+    def copy_from(self, target_name):
+        '''replace all docs with the ones of target "target_name" (of a
+           previous build, with the same backend).'''
+        raise NotImplemented
+
+    def unset_fields(self, fields):
+        '''remove top-level "fields" from all docs.'''
+        raise NotImplemented
+
     def finalize(self):
         '''if needed, for example for bulk updates, perform flush
            at the end of updating.
@@ -103,6 +126,51 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
                                       manipulate=False, check_keys=False,
                                       upsert=False, w=0)
 
+    def update_many(self, updates, batch_bytes=MERGE_BULK_BATCH_BYTES):
+        '''same as update for each (id, extra_doc) of "updates", sent as
+           unordered bulk writes of about "batch_bytes" each, acknowledged.
+           Return a dict of counts: "updates" sent, "matched" and "modified"
+           docs, "failed" updates and "batches". Failed updates do not stop
+           the others, their errors (first ones) are in "errors".
+        '''
+        collection = self.target_collection.with_options(
+            write_concern=WriteConcern(w=1))
+        res = {'updates': 0, 'matched': 0, 'modified': 0, 'failed': 0,
+               'batches': 0, 'errors': []}
+
+        def _write(batch, ids):
+            res['batches'] += 1
+            res['updates'] += len(batch)
+            try:
+                result = collection.bulk_write(batch, ordered=False)
+                details = result.bulk_api_result
+            except BulkWriteError as err:
+                details = err.details
+                res['failed'] += len(details.get('writeErrors', []))
+                res['failed'] += len(details.get('writeConcernErrors', []))
+                for error in details.get('writeErrors', [])[:10 - len(res['errors'])]:
+                    res['errors'].append({'_id': ids[error['index']],
+                                          'code': error.get('code'),
+                                          'errmsg': error.get('errmsg')})
+            res['matched'] += details.get('nMatched', 0)
+            res['modified'] += details.get('nModified', 0) or 0
+
+        batch = []
+        ids = []
+        nbytes = 0
+        for id, extra_doc in updates:
+            batch.append(UpdateOne({'_id': id}, {'$set': extra_doc}, upsert=False))
+            ids.append(id)
+            nbytes += len(BSON.encode(extra_doc)) + len(str(id))
+            if nbytes >= batch_bytes:
+                _write(batch, ids)
+                batch = []
+                ids = []
+                nbytes = 0
+        if batch:
+            _write(batch, ids)
+        return res
+
     def update_diff(self, diff, extra={}):
         '''update a doc based on the diff returned from diff.diff_doc
             "extra" can be passed (as a dictionary) to add common fields to the
@@ -123,6 +191,22 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
     def drop(self):
         self.target_collection.drop()
 
+    def copy_from(self, target_name):
+        '''target_name is a collection in the same database, copied
+           server-side (replacing target_collection).'''
+        source = self.target_collection.database[target_name]
+        source.aggregate([{'$match': {}}, {'$out': self.target_collection.name}],
+                         allowDiskUse=True)
+
+    def unset_fields(self, fields):
+        '''return # of docs modified.'''
+        if not fields:
+            return 0
+        res = self.target_collection.update_many(
+            {'$or': [{field: {'$exists': True}} for field in fields]},
+            {'$unset': dict([(field, '') for field in fields])})
+        return res.modified_count
+
     def get_id_list(self):
         return [x['_id'] for x in self.target_collection.find(projection=[], manipulate=False)]
 
@@ -160,7 +244,7 @@ class GeneDocMongoDBBackend(GeneDocBackendBase):
 
     def finalize(self):
         '''flush all pending writes.'''
-        self.target_collection.database.client.fsync(async=True)
+        self.target_collection.database.client.fsync(**{'async': True})
 
     def remove_from_ids(self, ids, step=10000):
         for i in range(0, len(ids), step):
@@ -3,18 +3,30 @@ import sys
 import os.path
 import time
 import copy
+import heapq
+from operator import itemgetter
+import multiprocessing
 from datetime import datetime
 from pprint import pformat
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bson import json_util
 
 from biothings.utils.mongo import (get_src_db, get_target_db, get_src_master,
                          get_src_build, get_src_dump, doc_feeder)
 from biothings.utils.common import (timesofar, ask, safewfile,
                                     dump2gridfs, get_timestamp, get_random_string)
-from utils.common import setup_logfile, loadobj
-from utils.dataload import list2dict, alwayslist
-from utils.es import ESIndexer
+from utils.common import setup_logfile
+from utils.dataload import alwayslist
+from utils.es import (ESIndexer, split_index_name, tee_query, id_range_partition,
+                      get_mongodb_uri, get_mongodb_client)
+from utils.field_cost import get_field_costs, heavy_fields
+from utils.idset import IDSet
+from utils.idmapping import IDMapping, write_idmapping, load_idmapping
 import databuild.backend
-from config import LOG_FOLDER, logger as logging
+from config import LOG_FOLDER, TAXONOMY, TARGET_ES_INDEX_SUFFIX, FIELD_COSTS_SAMPLE_SIZE, \
+    MERGE_PROCESSES, MERGE_PARTITION_SIZE, IDMAPPING_FOLDER, DATA_ARCHIVE_ROOT, \
+    logger as logging
 
 '''
 #Build_Config example
@@ -54,18 +66,145 @@ Build_Config = {
 '''
 
 
+def sorted_feeder(collection, query=None, step=10000, get_key=lambda doc: str(doc['_id'])):
+    '''yield (get_key(doc), doc) of docs of "collection" sorted by _id, by
+       default _id as str. Raise a ValueError if keys are not sorted
+       (e.g. int _ids).'''
+    cur = collection.find(query, no_cursor_timeout=True).sort('_id', 1)
+    cur.batch_size(step)
+    last = None
+    try:
+        for doc in cur:
+            key = get_key(doc)
+            if last is not None and key < last:
+                raise ValueError('"{}" _ids are not sorted as str ("{}" after "{}").'.format(
+                                 collection.name, key, last))
+            last = key
+            yield key, doc
+    finally:
+        cur.close()
+
+
+def has_non_str_ids(collection, query=None):
+    '''True if some docs of "collection" matching "query" have a _id which
+       is not a str (e.g. an int), so not sorted as str by sorted_feeder.'''
+    _query = {'_id': {'$not': {'$type': 'string'}}}
+    if query:
+        _query = {'$and': [query, _query]}
+    return collection.find_one(_query, projection={'_id': 1}) is not None
+
+
+def _tag_stream(stream, n):
+    for key, doc in stream:
+        yield key, n, doc
+
+
+def merge_sorted_docs(root_docs, src_docs_li):
+    '''k-way merge of "root_docs" and each stream of "src_docs_li", all
+       iterables of (_id, doc) sorted by _id: yield each root doc once,
+       updated with docs of the same _id from each source, in order (as
+       with $set of their fields but _id and taxid). Source docs without
+       a root doc are ignored.
+    '''
+    streams = [_tag_stream(root_docs, 0)]
+    streams += [_tag_stream(src_docs, n + 1) for n, src_docs in enumerate(src_docs_li)]
+    # heapq.merge is stable: for the same _id, root doc comes first, then
+    # docs of each source in order
+    gene_doc = None
+    gene_id = None
+    for key, n, doc in heapq.merge(*streams, key=itemgetter(0)):
+        if n == 0:
+            if gene_doc is not None:
+                yield gene_doc
+            gene_doc = doc
+            gene_id = key
+        elif key == gene_id:
+            doc.pop('_id', None)
+            doc.pop('taxid', None)
+            gene_doc.update(doc)
+    if gene_doc is not None:
+        yield gene_doc
+
+
+def get_updates(docs, geneid_set, idmapping_d=None):
+    '''yield (gene id, doc) for source "docs" to merge, with their _id mapped
+       to gene ids with "idmapping_d" (if given), only for ids in "geneid_set".
+       Docs are yielded without _id and taxid (the ones of root docs are kept).
+    '''
+    for doc in docs:
+        _id = doc['_id']
+        if idmapping_d:
+            _id = idmapping_d.get(_id, None) or _id
+        for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
+            __id = str(__id)
+            if __id in geneid_set:
+                doc.pop('_id', None)
+                doc.pop('taxid', None)
+                yield __id, doc
+
+
+# geneid_set and idmapping_d of merge worker processes, set before they are
+# forked (see DataBuilder._merge_parallel)
+_merge_worker_state = {}
+
+
+def _merge_partition_worker(task):
+    '''merge docs of one _id range of a source collection into the target
+       collection (in a worker process, with its own MongoDB connections),
+       return counts of GeneDocMongoDBBackend.update_many, with # of "docs"
+       read.'''
+    id_range = {'$gte': task['lo']}
+    if task['hi'] is not None:
+        id_range['$lt'] = task['hi']
+    src_client = get_mongodb_client(task['src_uri'])
+    target_client = get_mongodb_client(task['target_uri'])
+    res = {'docs': 0}
+
+    def _get_docs():
+        cur = src_client[task['src_db']][task['collection']].find(
+            {'_id': id_range}, no_cursor_timeout=True)
+        cur.batch_size(task['step'])
+        try:
+            for doc in cur:
+                res['docs'] += 1
+                yield doc
+        finally:
+            cur.close()
+
+    try:
+        target = databuild.backend.GeneDocMongoDBBackend(
+            target_client[task['target_db']][task['target_collection']])
+        res.update(target.update_many(get_updates(_get_docs(),
+                                                  _merge_worker_state['geneid_set'],
+                                                  _merge_worker_state['idmapping_d'])))
+    finally:
+        src_client.close()
+        target_client.close()
+    return res
+
+
 class DataBuilder():
 
     def __init__(self, build_config=None, backend='mongodb'):
         self.src = get_src_db()
         self.step = 10000
         self.use_parallel = False
+        self.use_sort_merge = False   # build each doc in one pass, see _merge_sort_merge
+        self.incremental = False      # re-merge only sources changed since last build, see _merge_incremental
+        # use_parallel: number of worker processes (None for # of CPUs), and
+        # size (in docs) of the _id range merged by each task
+        self.num_processes = MERGE_PROCESSES
+        self.partition_size = MERGE_PARTITION_SIZE
         self.merge_logging = True     # save output into a logging file when merge is called.
         self.max_build_status = 10    # max no. of records kept in "build" field of src_build collection.
 
         self.using_ipython_cluster = False
         self.shutdown_ipengines_after_done = False
         self.log_folder = LOG_FOLDER
+        # id mappings, whatever the current dir (see _load_entrez_geneid_d)
+        self.idmapping_folder = IDMAPPING_FOLDER or os.path.join(DATA_ARCHIVE_ROOT, 'idmapping')
+        if not os.path.isabs(self.idmapping_folder):
+            raise ValueError('IDMAPPING_FOLDER "%s" should be an absolute path.' % self.idmapping_folder)
 
         self._build_config = build_config
         self._entrez_geneid_d = None
@@ -132,6 +271,9 @@ class DataBuilder():
                 d['target'] = self.target.target_collection.name
             elif self.target.name == 'es':
                 d['target'] = self.target.target_esidxer.ES_INDEX_NAME
+            # to tell what changed since this build (see get_incremental_plan)
+            d['config'] = self._build_signature()
+            d['src_collections'] = self.get_src_collection_info()
             logging.info(pformat(d))
             src_build.update({'_id': self._build_config['_id']}, {"$push": {'build': d}})
             _cfg = src_build.find_one({'_id': self._build_config['_id']})
@@ -179,16 +321,29 @@ class DataBuilder():
             raise ValueError('"build_config" cannot be empty.')
 
     def _load_entrez_geneid_d(self):
-        self._entrez_geneid_d = loadobj(("entrez_gene__geneid_d.pyobj", self.src), mode='gridfs')
+        # memory-mapped, copied from gridfs into idmapping_folder once
+        self._entrez_geneid_d = load_idmapping(self.src, "entrez_gene__geneid_d.idmap", self.idmapping_folder,
+                                               fallback="entrez_gene__geneid_d.pyobj")
 
     def _load_ensembl2entrez_li(self):
-        ensembl2entrez_li = loadobj(("ensembl_gene__2entrezgene_list.pyobj", self.src), mode='gridfs')
-        #filter out those deprecated entrez gene ids
-        logging.info(len(ensembl2entrez_li))
-        ensembl2entrez_li = [(ensembl_id, self._entrez_geneid_d[int(entrez_id)]) for (ensembl_id, entrez_id) in ensembl2entrez_li
-                             if int(entrez_id) in self._entrez_geneid_d]
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        ensembl2entrez_li = load_idmapping(self.src, "ensembl_gene__2entrezgene.idmap", self.idmapping_folder,
+                                           fallback="ensembl_gene__2entrezgene_list.pyobj")
         logging.info(len(ensembl2entrez_li))
-        ensembl2entrez = list2dict(ensembl2entrez_li, 0)
+        # mapping to current entrez gene ids (deprecated ones filtered out),
+        # made once for these mappings
+        filename = os.path.join(self.idmapping_folder, 'ensembl2entrez_{}_{}'.format(
+                                os.path.basename(ensembl2entrez_li.filename),
+                                os.path.basename(self._entrez_geneid_d.filename)))
+        if not os.path.exists(filename):
+            geneid_d = self._entrez_geneid_d
+            write_idmapping(filename, ((ensembl_id, geneid_d[int(entrez_id)])
+                                       for ensembl_id, entrez_ids in ensembl2entrez_li.items()
+                                       for entrez_id in alwayslist(entrez_ids)
+                                       if int(entrez_id) in geneid_d))
+        ensembl2entrez = IDMapping(filename)
+        logging.info(len(ensembl2entrez))
         self._idmapping_d_cache['ensembl_gene'] = ensembl2entrez
 
     def _save_idmapping_gridfs(self):
@@ -251,7 +406,7 @@ class DataBuilder():
             logging.info('# of ensembl Gene IDs match entrez Gene IDs: %d' % cnt_matching_ensembl_genes)
             logging.info('# of ensembl Gene IDs DO NOT match entrez Gene IDs: %d' % cnt_ensembl_only_genes)
 
-            geneid_set = set(geneid_set)
+            geneid_set = IDSet(geneid_set)
             logging.info('# of total Root Gene IDs: %d' % len(geneid_set))
             _stats = {'total_entrez_genes': cnt_total_entrez_genes,
                       'total_species': cnt_total_species,
@@ -282,6 +437,14 @@ class DataBuilder():
                 if sources:
                     raise NotImplemented("merge speficic sources not supported when using parallel")
                 self._merge_ipython_cluster(step=step)
+            elif self.incremental:
+                if sources or restart_at:
+                    raise ValueError("merge specific sources or restart not supported when using incremental build")
+                self._merge_incremental(step=step)
+            elif self.use_sort_merge:
+                if sources or restart_at:
+                    raise ValueError("merge specific sources or restart not supported when using sort-merge")
+                self._merge_sort_merge(step=step)
             else:
                 self._merge_local(step=step, restart_at=restart_at,src_collection_list=sources)
 
@@ -469,12 +632,15 @@ class DataBuilder():
         if restart_at == 0 and src_collection_list is None:
             self.target.drop()
             self.target.prepare()
+            if self.use_parallel and os.path.exists(self._merge_checkpoint()):
+                # progress of a previous merge into a collection of that name
+                os.remove(self._merge_checkpoint())
             geneid_set = self.make_genedoc_root()
         else:
             if not self._entrez_geneid_d:
                 self._load_entrez_geneid_d()
             #geneid_set = set([x['_id'] for x in target_collection.find(projection=[], manipulate=False)])
-            geneid_set = set(self.target.get_id_list())
+            geneid_set = IDSet(self.target.get_id_list())
             logging.info('\t%s' % len(geneid_set))
 
         if not src_collection_list:
@@ -495,65 +661,299 @@ class DataBuilder():
 
             if restart_at <= src_cnt:
                 if self.use_parallel:
-                    self.doc_queue = []
-                    self._merge_parallel_ipython(collection, geneid_set,
-                                                 step=step, idmapping_d=idmapping_d)
+                    self._merge_parallel(collection, geneid_set,
+                                         step=step, idmapping_d=idmapping_d)
                 else:
                     self._merge_sequential(collection, geneid_set,
                                            step=step, idmapping_d=idmapping_d)
         self.target.finalize()
+        if self.use_parallel and os.path.exists(self._merge_checkpoint()):
+            os.remove(self._merge_checkpoint())
+
+    def _merge_incremental(self, step=100000):
+        '''Same result as a full build, from a copy of the target of the
+           last successful build: fields of source collections uploaded
+           since then are removed, and these collections merged again (see
+           get_incremental_plan). Falls back to a full build if that is not
+           possible (e.g. root collections were uploaded).
+        '''
+        if self.target.name != 'mongodb':
+            raise ValueError('incremental build not supported with "%s" backend' % self.target.name)
+        last_build = self.get_last_successful_build()
+        plan = self.get_incremental_plan(last_build) if last_build else None
+        if plan is None:
+            logging.info("Cannot build incrementally, doing a full build.")
+            if self.use_sort_merge:
+                self._merge_sort_merge(step=step)
+            else:
+                self._merge_local(step=step)
+            return
 
-    def _merge_sequential(self, collection, geneid_set, step=100000, idmapping_d=None):
-        for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
-            for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc.pop('_id', None)
-                    doc.pop('taxid', None)
-                    # target_collection.update({'_id': __id}, {'$set': doc},
-                    #                           manipulate=False,
-                    #                           upsert=False) #,safe=True)
-                    self.target.update(__id, doc)
-
-    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
-        from multiprocessing import Process, Queue
-        NUMBER_OF_PROCESSES = 8
+        t0 = time.time()
+        logging.info("Copying %s..." % last_build['target'])
+        self.target.drop()
+        self.target.copy_from(last_build['target'])
+        logging.info("Done. [%s]" % timesofar(t0))
+        # root docs did not change
+        self._stats = last_build['stats']
+        self._src_version = self.get_src_version()
+        self.log_src_build({'stats': self._stats,
+                            'src_version': self._src_version,
+                            'incremental': {'from': last_build['target'],
+                                            'sources': plan['sources'],
+                                            'fields': plan['fields']}})
+        logging.info("Changed collections: %s" % ', '.join(plan['changed']))
+        if plan['fields']:
+            cnt = self.target.unset_fields(plan['fields'])
+            logging.info("Removed %s from %d docs" % (', '.join(plan['fields']), cnt))
+        if plan['sources']:
+            self._merge_local(step=step, src_collection_list=plan['sources'])
+        else:
+            self.target.finalize()
+
+    def _merge_sort_merge(self, step=100000):
+        '''Same result as _merge_local, but each gene doc is fully built in
+           memory then inserted once, instead of root docs inserted then
+           updated once per source collection: all collections are read
+           sorted by (mapped) _id and merged in one pass.
+           Docs of collections with an "id_type" (ids to map to gene ids),
+           or with non-str _ids (not sorted as str), are first staged in a
+           temp collection, keyed by (mapped) _id as str.
+        '''
+        if not self._entrez_geneid_d:
+            self._load_entrez_geneid_d()
+        # checked before the target is dropped, not halfway through the merge
+        for collection in self._build_config['gene_root']:
+            if has_non_str_ids(self.src[collection]):
+                raise ValueError('"%s" has non-str _ids, cannot be merged with sort-merge.' % collection)
+        sources = [collection for collection in self._build_config['sources']
+                   if collection not in ['entrez_gene', 'ensembl_gene']]
+        to_stage = set([collection for collection in sources
+                        if self.src_master[collection].get('id_type', None) is not None or
+                        has_non_str_ids(self.src[collection])])
+        self.target.drop()
+        self.target.prepare()
 
-        input_queue = Queue()
-        input_queue.conn_pool = []
+        _db = get_target_db()
+        staging_li = []
+        src_docs_li = []
+        try:
+            for collection in sources:
+                id_type = self.src_master[collection].get('id_type', None)
+                if collection not in to_stage:
+                    src_docs_li.append(sorted_feeder(self.src[collection], step=step))
+                else:
+                    staging = _db['tmp_{}_{}'.format(self.target.target_name, collection)]
+                    staging_li.append(staging)
+                    self._stage_mapped_docs(collection,
+                                            self.get_idmapping_d(id_type) if id_type else None,
+                                            staging, step=step)
+                    src_docs_li.append(((key, doc['doc']) for key, doc in
+                                        sorted_feeder(staging, step=step,
+                                                      get_key=lambda doc: doc['_id']['k'])))
+
+            stats = {}
+            cnt = 0
+            t0 = time.time()
+            doc_li = []
+            for doc in merge_sorted_docs(self._get_root_docs(stats, step=step), src_docs_li):
+                doc_li.append(doc)
+                if len(doc_li) >= self.step:
+                    self.target.insert(doc_li)
+                    cnt += len(doc_li)
+                    doc_li = []
+                    logging.info("\t%d gene docs [%s]" % (cnt, timesofar(t0)))
+            if doc_li:
+                self.target.insert(doc_li)
+                cnt += len(doc_li)
+            logging.info("\t%d gene docs in total [%s]" % (cnt, timesofar(t0)))
+        finally:
+            for staging in staging_li:
+                staging.drop()
 
-        def worker(q, target):
-            while True:
-                doc = q.get()
-                if doc == 'STOP':
-                    break
-                __id = doc.pop('_id')
-                doc.pop('taxid', None)
-                target.update(__id, doc)
-                # target_collection.update({'_id': __id}, {'$set': doc},
-                #                           manipulate=False,
-                #                           upsert=False) #,safe=True)
+        stats['total_genes'] = cnt
+        self._stats = stats
+        self._src_version = self.get_src_version()
+        self.log_src_build({'stats': stats, 'src_version': self._src_version})
+        self.target.finalize()
 
-        # Start worker processes
-        for i in range(NUMBER_OF_PROCESSES):
-            Process(target=worker, args=(input_queue, self.target)).start()
+    def _get_root_docs(self, stats, step=100000):
+        '''yield (_id, doc) of root docs (same as make_genedoc_root) sorted by
+           _id, counts are set in "stats" once done.'''
+        if "species" in self._build_config:
+            _query = {'taxid': {'$in': self._build_config['species']}}
+        elif "species_to_exclude" in self._build_config:
+            _query = {'taxid': {'$nin': self._build_config['species_to_exclude']}}
+        else:
+            _query = None
+        streams = []
+        species_set = set()
+        cnt = {'entrez': 0, 'ensembl': 0, 'ensembl_only': 0}
+
+        def _entrez_docs():
+            for key, doc in sorted_feeder(self.src['entrez_gene'], query=_query, step=step):
+                cnt['entrez'] += 1
+                species_set.add(doc['taxid'])
+                yield key, doc
+
+        def _ensembl_only_docs(ensembl2entrez):
+            for key, doc in sorted_feeder(self.src['ensembl_gene'], query=_query, step=step):
+                cnt['ensembl'] += 1
+                if ensembl2entrez.get(doc['_id'], None) is None:
+                    #this is an Ensembl only gene
+                    cnt['ensembl_only'] += 1
+                    yield key, doc
 
+        if "entrez_gene" in self._build_config['gene_root']:
+            streams.append(_entrez_docs())
+        if "ensembl_gene" in self._build_config['gene_root']:
+            self._load_ensembl2entrez_li()
+            streams.append(_ensembl_only_docs(self._idmapping_d_cache['ensembl_gene']))
+        for key_doc in heapq.merge(*streams, key=itemgetter(0)):
+            yield key_doc
+
+        logging.info('# of entrez Gene IDs in total: %d' % cnt['entrez'])
+        logging.info('# of species in total: %d' % len(species_set))
+        logging.info('# of ensembl Gene IDs in total: %d' % cnt['ensembl'])
+        logging.info('# of ensembl Gene IDs DO NOT match entrez Gene IDs: %d' % cnt['ensembl_only'])
+        stats.update({'total_entrez_genes': cnt['entrez'],
+                      'total_species': len(species_set),
+                      'total_ensembl_genes': cnt['ensembl'],
+                      'total_ensembl_genes_mapped_to_entrez': cnt['ensembl'] - cnt['ensembl_only'],
+                      'total_ensembl_only_genes': cnt['ensembl_only']})
+
+    def _stage_mapped_docs(self, collection, idmapping_d, staging, step=100000):
+        '''copy docs of "collection" into "staging" collection, one per gene
+           id their _id maps to (with "idmapping_d", if given), with _id
+           {"k": gene id as str, "i": #} (sorted by gene id, then in
+           "collection" order).'''
+        staging.drop()
+        t0 = time.time()
+        i = 0
+        doc_li = []
         for doc in doc_feeder(self.src[collection], step=step):
-            _id = doc['_id']
-            if idmapping_d:
-                _id = idmapping_d.get(_id, None) or _id
+            _id = (idmapping_d.get(doc['_id'], None) if idmapping_d else None) or doc['_id']
             for __id in alwayslist(_id):    # there could be cases that idmapping returns multiple entrez_gene ids.
-                __id = str(__id)
-                if __id in geneid_set:
-                    doc['_id'] = __id
-                    input_queue.put(doc)
+                doc_li.append({'_id': {'k': str(__id), 'i': i}, 'doc': doc})
+                i += 1
+            if len(doc_li) >= self.step:
+                staging.insert_many(doc_li, ordered=False)
+                doc_li = []
+        if doc_li:
+            staging.insert_many(doc_li, ordered=False)
+        logging.info("\t%s: %d docs staged [%s]" % (collection, i, timesofar(t0)))
 
-        # Tell child processes to stop
-        for i in range(NUMBER_OF_PROCESSES):
-            input_queue.put('STOP')
+    def _merge_sequential(self, collection, geneid_set, step=100000, idmapping_d=None):
+        # updates are sent in bulk, acknowledged
+        res = self.target.update_many(get_updates(doc_feeder(self.src[collection], step=step),
+                                                  geneid_set, idmapping_d))
+        logging.info("\t%s: %d updates, %d failed" % (collection, res['updates'], res['failed']))
+        if res['failed']:
+            logging.info("Warning: %d updates from %s failed, e.g.: %s" %
+                         (res['failed'], collection, pformat(res.get('errors', []))))
+        return res
+
+    def _merge_parallel(self, collection, geneid_set, step=100000, idmapping_d=None):
+        '''merge "collection" split in _id ranges, by a pool of worker
+           processes each merging one range at a time (with bulk updates).
+           Ranges merged are recorded in the checkpoint file (see
+           _merge_checkpoint), so that an interrupted merge of "collection"
+           resumes with the remaining ranges. The first error of a worker
+           stops the merge of "collection" and is raised.
+        '''
+        assert self.target.name == 'mongodb', 'Abort. Parallel merge needs "mongodb" backend.'
+        src_collection = self.src[collection]
+        target_collection = self.target.target_collection
+        checkpoint = self._merge_checkpoint()
+        progress = self._load_merge_checkpoint()
+        state = progress.get(collection)
+        if state is None:
+            t0 = time.time()
+            ranges = id_range_partition(src_collection, None, self.partition_size)
+            logging.info("\t%s: %d _id ranges [%s]" % (collection, len(ranges), timesofar(t0)))
+            state = {'ranges': [list(r) for r in ranges], 'done': {}}
+            progress[collection] = state
+        else:
+            logging.info("\t%s: resuming, %d/%d _id ranges already merged" %
+                         (collection, len(state['done']), len(state['ranges'])))
+        task_common = {'src_uri': get_mongodb_uri(src_collection),
+                       'src_db': src_collection.database.name,
+                       'collection': collection,
+                       'target_uri': get_mongodb_uri(target_collection),
+                       'target_db': target_collection.database.name,
+                       'target_collection': target_collection.name,
+                       'step': step}
+        task_list = [dict(task_common, n=n, lo=lo, hi=hi)
+                     for n, (lo, hi) in enumerate(state['ranges'])
+                     if str(n) not in state['done']]
+
+        # worker processes are forked with the (large) geneid_set and
+        # idmapping_d, instead of getting them pickled
+        _merge_worker_state.update(geneid_set=geneid_set, idmapping_d=idmapping_d)
+        errors = []
+        t0 = time.time()
+        try:
+            with ProcessPoolExecutor(max_workers=self.num_processes,
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                jobs = dict((executor.submit(_merge_partition_worker, task), task['n'])
+                            for task in task_list)
+                for job in as_completed(jobs):
+                    if job.cancelled():
+                        continue
+                    if job.exception():
+                        errors.append((jobs[job], job.exception()))
+                        # stop at first error, ranges running get done
+                        for _job in jobs:
+                            _job.cancel()
+                        continue
+                    state['done'][str(jobs[job])] = job.result()
+                    self._save_merge_checkpoint(progress)
+                    if len(state['done']) % 10 == 0 or len(state['done']) == len(state['ranges']):
+                        logging.info("\t%s: %d/%d ranges done [%s]" % (
+                                     collection, len(state['done']), len(state['ranges']),
+                                     timesofar(t0)))
+        finally:
+            _merge_worker_state.clear()
+        if errors:
+            for n, err in errors:
+                logging.info("Error: %s, _id range %s: %s" % (collection, state['ranges'][n], err))
+            logging.info('Run again to resume from "%s".' % checkpoint)
+            raise errors[0][1]
+
+        res = {}
+        for _res in state['done'].values():
+            for k in ['docs', 'updates', 'matched', 'modified', 'failed']:
+                res[k] = res.get(k, 0) + _res.get(k, 0)
+        logging.info("\t%s: %d updates, %d failed" % (collection, res['updates'], res['failed']))
+        if res['failed']:
+            logging.info("Warning: %d updates from %s failed, e.g.: %s" %
+                         (res['failed'], collection,
+                          pformat([e for _res in state['done'].values() for e in _res['errors']][:10])))
+        src_cnt = src_collection.count()
+        if res['docs'] != src_cnt:
+            logging.info("Warning: %d docs read from _id ranges, should be %d." % (res['docs'], src_cnt))
+        return res
+
+    def _merge_checkpoint(self):
+        '''return the file recording the progress of a parallel merge into
+           the target collection.'''
+        return os.path.join(self.log_folder, 'merge_{}.json'.format(self.target.target_name))
+
+    def _load_merge_checkpoint(self):
+        '''return progress of the parallel merge: {collection: {"ranges":
+           [[lo, hi], ...], "done": {range #: counts}}}.'''
+        checkpoint = self._merge_checkpoint()
+        if not os.path.exists(checkpoint):
+            return {}
+        with open(checkpoint) as in_f:
+            return json_util.loads(in_f.read())
+
+    def _save_merge_checkpoint(self, progress):
+        checkpoint = self._merge_checkpoint()
+        tmp_fn = checkpoint + '.tmp'
+        with open(tmp_fn, 'w') as out_f:
+            out_f.write(json_util.dumps(progress))
+        os.replace(tmp_fn, checkpoint)
 
     def _merge_parallel_ipython(self, collection, geneid_set, step=100000, idmapping_d=None):
         from IPython.parallel import Client, require
@@ -611,6 +1011,93 @@ class DataBuilder():
                 src_version[src['_id']] = version
         return src_version
 
+    def get_src_collection_info(self):
+        '''return {collection: {"timestamp", "fields"}} for source
+           collections of build config, "timestamp" being when it was last
+           uploaded, and "fields" its top-level fields (from its mapping).
+        '''
+        self.get_src_master()
+        info = {}
+        for collection in self._build_config['sources']:
+            meta = self.src_master.get(collection, {})
+            info[collection] = {'timestamp': meta.get('timestamp'),
+                                'fields': sorted(meta.get('mapping', {}).keys())}
+        return info
+
+    def _build_signature(self):
+        '''build config options giving different root docs if changed.'''
+        return dict([(key, self._build_config.get(key))
+                     for key in ('gene_root', 'species', 'species_to_exclude')])
+
+    def get_last_successful_build(self):
+        '''return the last successful build record (from src_build) with
+           the same backend, if its target still exists.'''
+        src_build = getattr(self, 'src_build', None)
+        if src_build and self.target.name == 'mongodb':
+            _cfg = src_build.find_one({'_id': self._build_config['_id']})
+            target_names = set(get_target_db().collection_names())
+            for build in reversed(_cfg.get('build', [])):
+                if build.get('status', None) == 'success' and \
+                   build.get('target_backend', None) == self.target.name and \
+                   build.get('target', None) in target_names:
+                    return build
+
+    def get_incremental_plan(self, last_build):
+        '''return what to do to get from the target of "last_build" (a
+           src_build record) the same target as a full build now:
+           {"changed": collections uploaded (or added/removed) since,
+            "fields": fields to remove first, "sources": collections to
+            merge again, in build config order}.
+           As a source collection sets top-level fields (replacing previous
+           values), collections sharing fields with changed ones are merged
+           again as well.
+           Return None (reason is logged) if a full build is needed: root
+           collections (root docs and id mappings) changed, or build config,
+           or fields of some collection are unknown (no mapping).
+        '''
+        def full_build(reason):
+            logging.info("Full build needed: %s" % reason)
+
+        prev = last_build.get('src_collections', None)
+        if not prev or not last_build.get('stats', None):
+            return full_build("source collections or stats not recorded in last build")
+        if last_build.get('config', None) != self._build_signature():
+            return full_build("build config changed")
+        current = self.get_src_collection_info()
+        roots = ['entrez_gene', 'ensembl_gene']
+        changed = sorted([collection for collection in set(prev) | set(current)
+                          if prev.get(collection) != current.get(collection)])
+        if set(changed) & set(roots):
+            return full_build("root collections changed: %s" % ', '.join(set(changed) & set(roots)))
+
+        def _fields(collection):
+            return set(prev.get(collection, {}).get('fields', [])) | \
+                set(current.get(collection, {}).get('fields', []))
+        no_fields = [collection for collection in changed if not _fields(collection)]
+        if no_fields:
+            return full_build("fields unknown (no mapping) for: %s" % ', '.join(no_fields))
+
+        to_merge = set(changed)
+        fields = set()
+        while True:
+            for collection in to_merge:
+                fields |= _fields(collection)
+            sharing = set([collection for collection in current
+                           if collection not in to_merge and collection not in roots and
+                           _fields(collection) & fields])
+            if not sharing:
+                break
+            to_merge |= sharing
+        root_fields = set()
+        for collection in roots:
+            root_fields |= _fields(collection)
+        if fields & root_fields:
+            return full_build("fields of root collections changed: %s" % ', '.join(fields & root_fields))
+        return {'changed': changed,
+                'fields': sorted(fields),
+                'sources': [collection for collection in self._build_config['sources']
+                            if collection in to_merge and collection in current]}
+
     def get_last_src_build_stats(self):
         src_build = getattr(self, 'src_build', None)
         if src_build:
@@ -682,6 +1169,17 @@ class DataBuilder():
         #                      'compress_threshold': '1kb'}
         return mapping
 
+    def get_field_costs(self, collection, mapping, sample_size=FIELD_COSTS_SAMPLE_SIZE):
+        '''return the cost of each top-level field of "mapping", from a random
+           sample of "sample_size" docs of "collection" (see utils.field_cost).
+        '''
+        docs = collection.aggregate([{'$sample': {'size': sample_size}}])
+        field_costs = get_field_costs(mapping, docs)
+        logging.info("Largest fields not indexed (candidates for ES_SOURCE_DEFAULT_EXCLUDES): %s" %
+                     ', '.join(['%s (%d bytes)' % (f, field_costs[f]['avg_bytes'])
+                                for f in heavy_fields(field_costs)]))
+        return field_costs
+
     def update_mapping_meta(self):
         '''updating _meta field of ES mapping data, including index stats, versions.
            This is for GeneDocESBackend only.
@@ -762,10 +1260,16 @@ class DataBuilder():
         else:
             logging.info("Error: target collection is not ready yet or failed to build.")
 
-    def build_index2(self, build_config='mygene_allspecies', last_build_idx=-1, use_parallel=False, es_host=None, es_index_name=None, noconfirm=False):
+    def build_index2(self, build_config='mygene_allspecies', last_build_idx=-1, use_parallel=False, es_host=None, es_index_name=None, noconfirm=False, swap_alias=True, with_tier1=True):
         """Build ES index from last successfully-merged mongodb collection.
             optional "es_host" argument can be used to specified another ES host, otherwise default ES_HOST.
-            optional "es_index_name" argument can be used to pass an alternative index name, otherwise same as mongodb collection name
+            optional "es_index_name" argument can be used to pass an alternative index name, otherwise same as
+            last build target collection name (e.g. "genedoc_mygene_allspecies_20161018_abcdefgh").
+            Once built and validated, the "genedoc_*_current" alias (read by the API) is moved to the new index,
+            unless "swap_alias" is False. The previous index is kept, see ESIndexer.rollback_alias.
+            When building "mygene_allspecies" with "with_tier1", the tier-1 index (docs of TAXONOMY species,
+            e.g. "genedoc_mygene_20161018_abcdefgh", alias "genedoc_mygene_current") is built from the same
+            pass, docs routed by taxid.
         """
         self.load_build_config(build_config)
         assert "build" in self._build_config, "Abort. No such build records for config %s" % build_config
@@ -802,31 +1306,63 @@ class DataBuilder():
             _meta['stats'] = self._stats
         if 'timestamp' in last_build:
             _meta['timestamp'] = last_build['timestamp']
+        _meta['field_costs'] = self.get_field_costs(target_collection, _mapping)
         if _meta:
             _mapping['_meta'] = _meta
-        es_index_name = es_index_name or target_collection.name
+        es_index_name = es_index_name or last_build['target']
+        alias = target_collection.name
         es_idxer = ESIndexer(mapping=_mapping,
                              es_index_name=es_index_name,
                              es_host=es_host,
                              step=5000)
         if build_config == 'mygene_allspecies':
             es_idxer.number_of_shards = 10   # default 5
-        es_idxer.check()
+        indexers = [(es_idxer, alias, target_collection, None)]
+        if build_config == 'mygene_allspecies' and with_tier1:
+            _split = split_index_name(es_idxer.ES_INDEX_NAME)
+            assert _split, 'Abort. Cannot name tier-1 index after "%s".' % es_idxer.ES_INDEX_NAME
+            tier1_idxer = ESIndexer(mapping=_mapping,
+                                    es_index_name=es_idxer.ES_INDEX_NAME.replace(_split[0], 'genedoc_mygene', 1),
+                                    es_host=es_host,
+                                    step=5000)
+            taxids = set(TAXONOMY.values())
+            es_idxer.tee_indices.append((tier1_idxer, taxids))
+            indexers.append((tier1_idxer, 'genedoc_mygene' + TARGET_ES_INDEX_SUFFIX,
+                             target_collection, tee_query(None, taxids)))
+        for _idxer, _alias, _, _ in indexers:
+            _idxer.check()
+            if swap_alias:
+                logging.info('Alias: %s -> %s' % (_alias, _idxer.ES_INDEX_NAME))
+                if _idxer.exists_index(_alias) and not _idxer.get_alias_indices(_alias):
+                    logging.info('Abort. "%s" is an index, not an alias: delete it first, '
+                                 'or build with swap_alias=False.' % _alias)
+                    return
         if noconfirm or ask("Continue to build ES index?") == 'Y':
             es_idxer.use_parallel = use_parallel
             #es_idxer.s = 609000
-            if es_idxer.exists_index(es_idxer.ES_INDEX_NAME):
-                if noconfirm or ask('Index "{}" exists. Delete?'.format(es_idxer.ES_INDEX_NAME)) == 'Y':
-                    es_idxer.conn.indices.delete(es_idxer.ES_INDEX_NAME)
-                else:
-                    logging.info("Abort.")
-                    return
-            es_idxer.create_index()
+            for _idxer, _alias, _, _ in indexers:
+                if _idxer.exists_index(_idxer.ES_INDEX_NAME):
+                    if _idxer.ES_INDEX_NAME in _idxer.get_alias_indices(_alias):
+                        logging.info('Abort. Index "%s" is in use (alias "%s").' % (_idxer.ES_INDEX_NAME, _alias))
+                        return
+                    if noconfirm or ask('Index "{}" exists. Delete?'.format(_idxer.ES_INDEX_NAME)) == 'Y':
+                        _idxer.conn.indices.delete(_idxer.ES_INDEX_NAME)
+                    else:
+                        logging.info("Abort.")
+                        return
+                _idxer.create_index()
             #es_idxer.delete_index_type(es_idxer.ES_INDEX_TYPE, noconfirm=True)
             es_idxer.build_index(target_collection, verbose=False)
-            # time.sleep(10)    # pausing 10 second here
-            # if es_idxer.wait_till_all_shards_ready():
-            #     print "Optimizing...", es_idxer.optimize()
+            if not swap_alias:
+                return
+            for _idxer, _alias, _collection, _query in indexers:
+                logging.info('Validating "%s"...' % _idxer.ES_INDEX_NAME)
+                if not _idxer.validate_index(_collection, query=_query):
+                    logging.info('Abort. Alias "%s" not moved to invalid index "%s".' % (_alias, _idxer.ES_INDEX_NAME))
+                    return
+            for _idxer, _alias, _, _ in indexers:
+                previous = _idxer.swap_alias(_alias)
+                logging.info('Alias "%s" moved to "%s" (from: %s).' % (_alias, _idxer.ES_INDEX_NAME, ', '.join(previous) or 'none'))
 
     def sync_index(self, use_parallel=True):
         from utils import diff
@@ -844,23 +1380,36 @@ class DataBuilder():
 
 
 def main():
-    if len(sys.argv) > 1:
-        config = sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if args:
+        config = args[0]
     else:
         config = 'mygene_allspecies'
+    # merge with a pool of local worker processes (see DataBuilder._merge_parallel)
     use_parallel = '-p' in sys.argv
+    # merge with an IPython cluster
+    use_ipython_cluster = '--ipython' in sys.argv
+    # build each doc in one pass (see DataBuilder._merge_sort_merge)
+    use_sort_merge = '-s' in sys.argv
+    # re-merge only sources uploaded since last build (see DataBuilder._merge_incremental)
+    incremental = '-i' in sys.argv
     sources = None  # will build all sources
     target = None   # will generate a new collection name
     # "target_col:src_col1,src_col2" will specifically merge src_col1
-    # and src_col2 into existing target_col (instead of merging everything)
-    if not use_parallel and len(sys.argv) > 2:
-        target,tmp = sys.argv[2].split(":")
+    # and src_col2 into existing target_col (instead of merging everything).
+    # With "-p", ranges of these collections already merged into target_col
+    # (by an interrupted merge) are skipped.
+    if not (use_ipython_cluster or use_sort_merge or incremental) and len(args) > 1:
+        target,tmp = args[1].split(":")
         sources = tmp.split(",")
 
     t0 = time.time()
     bdr = DataBuilder(backend='mongodb')
     bdr.load_build_config(config)
-    bdr.using_ipython_cluster = use_parallel
+    bdr.use_parallel = use_parallel
+    bdr.using_ipython_cluster = use_ipython_cluster
+    bdr.use_sort_merge = use_sort_merge
+    bdr.incremental = incremental
     bdr.merge(sources=sources,target=target)
 
     logging.info("Finished. %s" % timesofar(t0))
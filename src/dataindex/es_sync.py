@@ -8,6 +8,7 @@ from pprint import pprint
 
 from config import TARGET_ES_INDEX_SUFFIX, ES_HOST
 from utils.es import ESIndexer
+from utils.idset import IDSet
 from biothings.utils.mongo import get_target_db, get_src_build
 from utils.common import loadobj  # the one from biothings doesn't work for now
 from biothings.utils.common import timesofar, ask, iter_n
@@ -57,6 +58,13 @@ class ESIndexer2(ESIndexer):
         get_changes_stats(changes)
         print('\033[34;06m{}\033[0m:'.format('[Target ES]'))
         self.check()
+        # changes are applied through the alias (if any) to the index it
+        # points to, which must be a single one
+        indices = self.get_alias_indices(self.ES_INDEX_NAME)
+        if indices:
+            assert len(indices) == 1, \
+                'Alias "{}" points to several indices: {}'.format(self.ES_INDEX_NAME, indices)
+            print("Alias target:", indices[0])
 
     def apply_changes(self, changes, verify=True, noconfirm=False):
         if verify:
@@ -163,13 +171,12 @@ class ESIndexer2(ESIndexer):
                 }
             }
         }
-        cur = self.doc_feeder(query=q, fields=[], step=10000)
-        _li1 = sorted(changes['add'] + [x['_id'] for x in changes['update']])
-        _li2 = sorted([x['_id'] for x in cur])
-        if _li1 == _li2:
-            print("{}=={}...OK".format(len(_li1), len(_li2)))
+        _ids1 = IDSet(changes['add'] + [x['_id'] for x in changes['update']])
+        _ids2 = self.get_id_set(query=q)
+        if _ids1 == _ids2:
+            print("{}=={}...OK".format(len(_ids1), len(_ids2)))
         else:
-            print('ERROR!!!\n\t Should be "{}", but get "{}"'.format(len(_li1), len(_li2)))
+            print('ERROR!!!\n\t Should be "{}", but get "{}"'.format(len(_ids1), len(_ids2)))
 
 
 #esi = utils.es.ESIndexer2('genedoc_mygene' + TARGET_ES_INDEX_SUFFIX, es_host='su02:9500')
@@ -35,6 +35,17 @@ def test(build_config):
         validate(build_config)
 
 
+def rollback(config_li, es_host, noconfirm=False):
+    from utils.es import ESIndexer
+    from config import TARGET_ES_INDEX_SUFFIX
+    esi = ESIndexer(es_host=es_host)
+    for _conf in config_li:
+        alias = 'genedoc_' + _conf + TARGET_ES_INDEX_SUFFIX
+        print('"{}" -> {}'.format(alias, ', '.join(esi.get_alias_indices(alias))))
+        if noconfirm or ask('Roll back "{}" to the previous index?'.format(alias)) == 'Y':
+            print('"{}" -> {}'.format(alias, esi.rollback_alias(alias)))
+
+
 def main():
     parser = OptionParser()
     parser.add_option("-c", "--conf", dest="config",
@@ -46,6 +57,12 @@ def main():
     parser.add_option("-e", "--es-index", dest="es_index_name",
                       action="store", default=None,
                       help="provide an alternative ES index name")
+    parser.add_option("-n", "--no-alias", dest="noalias",
+                      action="store_true", default=False,
+                      help="do not move \"genedoc_*_current\" alias to the new ES index")
+    parser.add_option("-r", "--rollback", dest="rollback",
+                      action="store_true", default=False,
+                      help="move \"genedoc_*_current\" alias back to the previous ES index")
     # parser.add_option("", "--no-cleanup", dest="nocleanup",
     #                   action="store_true", default=False,
     #                   help="do not clean up old ES indices")
@@ -62,8 +79,15 @@ def main():
         bdr = DataBuilder(backend='es')
         if options.config:
             config_li = [options.config]
-        else:
+        elif options.rollback:
             config_li = ['mygene', 'mygene_allspecies']
+        else:
+            # "mygene" (tier-1) index is built from the same pass
+            config_li = ['mygene_allspecies']
+
+        if options.rollback:
+            rollback(config_li, es_host, noconfirm=options.noconfirm)
+            return
 
         if not options.noconfirm:
             print('\n'.join(["Ready to build these ES indices on %s (tunnel=%s):" % (es_host, tunnel.ok)] +
@@ -77,7 +101,8 @@ def main():
             print('>"{}">>>>>>'.format(_conf))
             bdr.build_index2(_conf,
                              es_index_name=options.es_index_name,
-                             es_host=es_host,noconfirm=options.noconfirm)
+                             es_host=es_host,noconfirm=options.noconfirm,
+                             swap_alias=not options.noalias)
             print('<<<<<<"{}"...done. {}'.format(_conf, timesofar(t0)))
 
         print('=' * 20)
@@ -9,6 +9,7 @@ import importlib
 from biothings.utils.mongo import get_src_conn, get_src_dump, get_data_folder
 from biothings.utils.common import get_timestamp, get_random_string, timesofar, dump2gridfs, iter_n
 from config import DATA_SRC_DATABASE, DATA_SRC_MASTER_COLLECTION
+from utils.idmapping import dump_idmapping2gridfs
 
 
 __sources_dict__ = {
@@ -139,12 +140,16 @@ class GeneDocSource(dict):
                 t0 = time.time()
                 geneid_d = self.get_geneid_d()
                 dump2gridfs(geneid_d, self.__collection__ + '__geneid_d.pyobj', self.db)
+                # same mapping, to be memory-mapped by DataBuilder
+                dump_idmapping2gridfs(geneid_d.items(), self.__collection__ + '__geneid_d.idmap', self.db)
                 print('Done[%s]' % timesofar(t0))
             if getattr(self, 'ENSEMBL_GENEDOC_ROOT', False):
                 print('Uploading "mapping2entrezgene" to GridFS...', end='')
                 t0 = time.time()
                 x2entrezgene_list = self.get_mapping_to_entrez()
                 dump2gridfs(x2entrezgene_list, self.__collection__ + '__2entrezgene_list.pyobj', self.db)
+                dump_idmapping2gridfs(((x, int(entrez_id)) for x, entrez_id in x2entrezgene_list),
+                                      self.__collection__ + '__2entrezgene.idmap', self.db)
                 print('Done[%s]' % timesofar(t0))
 
         if update_master:
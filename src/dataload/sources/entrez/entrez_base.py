@@ -2,7 +2,8 @@ from __future__ import print_function
 import os.path
 import datetime
 from config import SPECIES_LI, TAXONOMY
-from utils.common import file_newer, loadobj, dump
+from utils.common import file_newer
+from utils.idmapping import IDMapping, write_idmapping
 from dataload import get_data_folder
 from utils.dataload import (load_start, load_done,
                             tab2dict, tab2list, value_convert,
@@ -133,7 +134,8 @@ def get_geneid_d(species_li=None, load_cache=True, save_cache=True):
 
        if species_li is None, genes from all species are loaded.
 
-       Note that all ids are int type.
+       Note that all ids are int type. Unless "save_cache" is False, the
+       mapping is returned as an IDMapping of the (memory-mapped) cache file.
     '''
     if species_li:
         taxid_set = set([TAXONOMY[species] for species in species_li])
@@ -144,14 +146,15 @@ def get_geneid_d(species_li=None, load_cache=True, save_cache=True):
     os.chdir(DATA_FOLDER)
 
     # check cache file
-    _cache_file = 'gene/geneid_d.pyobj'
+    _cache_file = 'gene/geneid_d.idmap'
+    _taxids = sorted(taxid_set) if taxid_set else None
     if load_cache and os.path.exists(_cache_file) and \
        file_newer(_cache_file, 'gene/gene_info.gz') and \
        file_newer(_cache_file, 'gene/gene_history.gz'):
 
         print('Loading "geneid_d" from cache file...', end='')
-        _taxid_set, out_d = loadobj(_cache_file)
-        assert _taxid_set == taxid_set
+        out_d = IDMapping(os.path.join(DATA_FOLDER, _cache_file))
+        assert out_d.meta['taxids'] == _taxids
         print('Done.')
         os.chdir(orig_cwd)
         return out_d
@@ -185,10 +188,8 @@ def get_geneid_d(species_li=None, load_cache=True, save_cache=True):
         out_d[_g] = _g
 
     if save_cache:
-        if species_li:
-            dump((taxid_set, out_d), _cache_file)
-        else:
-            dump((None, out_d), _cache_file)
+        write_idmapping(_cache_file, out_d.items(), meta={'taxids': _taxids})
+        out_d = IDMapping(os.path.join(DATA_FOLDER, _cache_file))
 
     os.chdir(orig_cwd)
     return out_d
@@ -0,0 +1,96 @@
+'''
+Unit tests of databuild.backend, with a fake collection (no MongoDB needed).
+'''
+import unittest
+from unittest import mock
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from databuild.backend import GeneDocMongoDBBackend, GeneDocMemeoryBackend
+
+
+class FakeCollection(object):
+    '''records bulk writes, failing the updates of ids in "failing", matching
+       all the others (modified unless in "unchanged").'''
+    name = 'genedoc_test'
+
+    def __init__(self, failing=(), unchanged=()):
+        self.failing = set(failing)
+        self.unchanged = set(unchanged)
+        self.batches = []
+        self.write_concern = None
+
+    def with_options(self, write_concern=None):
+        self.write_concern = write_concern
+        return self
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append(requests)
+        ids = [op._filter['_id'] for op in requests]
+        matched = [_id for _id in ids if _id not in self.failing]
+        details = {'nMatched': len(matched),
+                   'nModified': len([_id for _id in matched if _id not in self.unchanged]),
+                   'writeErrors': [{'index': i, 'code': 11000, 'errmsg': 'failed %s' % _id}
+                                   for i, _id in enumerate(ids) if _id in self.failing],
+                   'writeConcernErrors': []}
+        if details['writeErrors']:
+            raise BulkWriteError(details)
+        return mock.Mock(bulk_api_result=details)
+
+
+class UpdateManyTest(unittest.TestCase):
+
+    def _updates(self, n):
+        return [(i, {'x': i}) for i in range(n)]
+
+    def test_update_many(self):
+        collection = FakeCollection(unchanged=[2])
+        res = GeneDocMongoDBBackend(collection).update_many(self._updates(5))
+        self.assertEqual(res, {'updates': 5, 'matched': 5, 'modified': 4, 'failed': 0,
+                               'batches': 1, 'errors': []})
+        self.assertEqual(collection.write_concern.document, {'w': 1})
+        self.assertEqual(collection.batches[0][0],
+                         UpdateOne({'_id': 0}, {'$set': {'x': 0}}, upsert=False))
+
+    def test_batches(self):
+        collection = FakeCollection()
+        # 13 bytes per update (BSON doc and id)
+        res = GeneDocMongoDBBackend(collection).update_many(self._updates(10), batch_bytes=50)
+        self.assertEqual([[op._filter['_id'] for op in b] for b in collection.batches],
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(res['batches'], 3)
+        self.assertEqual(res['updates'], 10)
+        self.assertEqual(res['matched'], 10)
+
+    def test_failed(self):
+        collection = FakeCollection(failing=range(5, 30))
+        res = GeneDocMongoDBBackend(collection).update_many(self._updates(40), batch_bytes=200)
+        self.assertGreater(res['batches'], 1)
+        # failures do not stop the other updates
+        self.assertEqual(res['updates'], 40)
+        self.assertEqual(res['failed'], 25)
+        self.assertEqual(res['matched'], 15)
+        # only the first errors, with the id of the doc
+        self.assertEqual(len(res['errors']), 10)
+        self.assertEqual(res['errors'][0], {'_id': 5, 'code': 11000, 'errmsg': 'failed 5'})
+        self.assertEqual([e['_id'] for e in res['errors']], list(range(5, 15)))
+
+    def test_empty(self):
+        collection = FakeCollection()
+        res = GeneDocMongoDBBackend(collection).update_many(iter([]))
+        self.assertEqual(res['updates'], 0)
+        self.assertEqual(res['batches'], 0)
+        self.assertEqual(collection.batches, [])
+
+    def test_base_update_many(self):
+        backend = GeneDocMemeoryBackend()
+        backend.insert([{'_id': 1, 'a': 1}, {'_id': 2, 'a': 2}])
+        res = backend.update_many([(1, {'b': 1}), (3, {'b': 3})])
+        self.assertEqual(res, {'updates': 2, 'failed': 0})
+        self.assertEqual(backend.get_from_id(1), {'_id': 1, 'a': 1, 'b': 1})
+        self.assertEqual(sorted(backend.get_id_list()), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+'''
+Unit tests of databuild.builder, with fake collections (no MongoDB needed).
+'''
+import copy
+import unittest
+from datetime import datetime
+
+from databuild.builder import (DataBuilder, sorted_feeder, has_non_str_ids,
+                               merge_sorted_docs, get_updates)
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.closed = False
+
+    def sort(self, key, direction):
+        # as MongoDB: numbers before strings
+        self.docs = sorted(self.docs, key=lambda doc: (isinstance(doc[key], str), doc[key]))
+        return self
+
+    def batch_size(self, step):
+        pass
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCollection(object):
+    name = 'test'
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.cursors = []
+
+    def find(self, query=None, no_cursor_timeout=False):
+        cur = FakeCursor([doc for doc in self.docs
+                          if not query or all(doc.get(k) == v for k, v in query.items())])
+        self.cursors.append(cur)
+        return cur
+
+    def find_one(self, query, projection=None):
+        # only the queries of has_non_str_ids
+        if '$and' in query:
+            extra, query = query['$and']
+        else:
+            extra = {}
+        for doc in self.find(extra):
+            if not isinstance(doc['_id'], str):
+                return {'_id': doc['_id']}
+
+
+class SortedFeederTest(unittest.TestCase):
+
+    def test_sorted(self):
+        collection = FakeCollection([{'_id': 'b'}, {'_id': 'a'}, {'_id': '10'}, {'_id': '9'}])
+        self.assertEqual([key for key, _ in sorted_feeder(collection)], ['10', '9', 'a', 'b'])
+        self.assertTrue(collection.cursors[0].closed)
+        res = list(sorted_feeder(FakeCollection([{'_id': 'a', 'taxid': 1}, {'_id': 'b'}]),
+                                 query={'taxid': 1}))
+        self.assertEqual(res, [('a', {'_id': 'a', 'taxid': 1})])
+
+    def test_not_sorted(self):
+        # int _ids are not sorted as str: fails instead of a wrong merge
+        collection = FakeCollection([{'_id': 9}, {'_id': 10}])
+        self.assertRaises(ValueError, list, sorted_feeder(collection))
+        self.assertTrue(collection.cursors[0].closed)
+
+    def test_has_non_str_ids(self):
+        self.assertFalse(has_non_str_ids(FakeCollection([{'_id': 'a'}, {'_id': '1'}])))
+        self.assertTrue(has_non_str_ids(FakeCollection([{'_id': 'a'}, {'_id': 1}])))
+        collection = FakeCollection([{'_id': 'a', 'taxid': 1}, {'_id': 1, 'taxid': 2}])
+        self.assertFalse(has_non_str_ids(collection, query={'taxid': 1}))
+        self.assertTrue(has_non_str_ids(collection, query={'taxid': 2}))
+
+
+class MergeSortedDocsTest(unittest.TestCase):
+
+    def _docs(self, *docs):
+        return [(doc['_id'], doc) for doc in docs]
+
+    def test_merge(self):
+        root = self._docs({'_id': '1', 'taxid': 9606, 'symbol': 'A'},
+                          {'_id': '2', 'taxid': 9606, 'symbol': 'B'},
+                          {'_id': '3', 'taxid': 9606, 'symbol': 'C'})
+        src1 = self._docs({'_id': '1', 'taxid': 0, 'x': 1}, {'_id': '3', 'x': 3})
+        src2 = self._docs({'_id': '2', 'y': 2}, {'_id': '3', 'y': 3})
+        res = list(merge_sorted_docs(root, [src1, src2]))
+        self.assertEqual(res, [{'_id': '1', 'taxid': 9606, 'symbol': 'A', 'x': 1},
+                               {'_id': '2', 'taxid': 9606, 'symbol': 'B', 'y': 2},
+                               {'_id': '3', 'taxid': 9606, 'symbol': 'C', 'x': 3, 'y': 3}])
+
+    def test_sources_in_order(self):
+        # for the same _id: root doc first, then sources in order, the last wins
+        root = self._docs({'_id': '1', 'a': 'root', 'b': 'root', 'c': 'root'})
+        src1 = self._docs({'_id': '1', 'b': 'src1', 'c': 'src1'})
+        src2 = self._docs({'_id': '1', 'c': 'src2'})
+        res = list(merge_sorted_docs(root, [src1, src2]))
+        self.assertEqual(res, [{'_id': '1', 'a': 'root', 'b': 'src1', 'c': 'src2'}])
+        # several docs of the same _id in a source: in order too
+        src = self._docs({'_id': '1', 'c': 'first'}, {'_id': '1', 'c': 'second'})
+        res = list(merge_sorted_docs(self._docs({'_id': '1'}), [src]))
+        self.assertEqual(res, [{'_id': '1', 'c': 'second'}])
+
+    def test_no_root_doc(self):
+        root = self._docs({'_id': '2', 'a': 2}, {'_id': '4', 'a': 4})
+        src = self._docs({'_id': '1', 'x': 1}, {'_id': '2', 'x': 2},
+                         {'_id': '3', 'x': 3}, {'_id': '5', 'x': 5})
+        res = list(merge_sorted_docs(root, [src]))
+        self.assertEqual(res, [{'_id': '2', 'a': 2, 'x': 2}, {'_id': '4', 'a': 4}])
+
+    def test_empty(self):
+        self.assertEqual(list(merge_sorted_docs([], [self._docs({'_id': '1'})])), [])
+        root = self._docs({'_id': '1'})
+        self.assertEqual(list(merge_sorted_docs(root, [])), [{'_id': '1'}])
+        self.assertEqual(list(merge_sorted_docs(root, [[], []])), [{'_id': '1'}])
+
+
+class GetUpdatesTest(unittest.TestCase):
+
+    def test_get_updates(self):
+        docs = [{'_id': 1, 'taxid': 9606, 'x': 1}, {'_id': '2', 'x': 2}, {'_id': 3, 'x': 3}]
+        res = list(get_updates(docs, set(['1', '2'])))
+        self.assertEqual(res, [('1', {'x': 1}), ('2', {'x': 2})])
+
+    def test_idmapping(self):
+        docs = [{'_id': 'ENSG1', 'x': 1}, {'_id': 'ENSG2', 'x': 2}, {'_id': '3', 'x': 3}]
+        idmapping_d = {'ENSG1': 1, 'ENSG2': [2, 4]}
+        res = list(get_updates(docs, set(['1', '2', '3', '4']), idmapping_d))
+        # not mapped: own _id
+        self.assertEqual(res, [('1', {'x': 1}), ('2', {'x': 2}), ('4', {'x': 2}), ('3', {'x': 3})])
+
+
+class IncrementalPlanTest(unittest.TestCase):
+    old = datetime(2016, 9, 1)
+    new = datetime(2016, 10, 1)
+
+    def setUp(self):
+        self.builder = DataBuilder.__new__(DataBuilder)
+        self.builder._build_config = {
+            'sources': ['entrez_gene', 'entrez_generif', 'entrez_go', 'reporter', 'cpdb'],
+            'gene_root': ['entrez_gene']}
+        self.src_master = {
+            'entrez_gene': {'timestamp': self.old, 'mapping': {'symbol': {}, 'name': {}}},
+            'entrez_generif': {'timestamp': self.old, 'mapping': {'generif': {}}},
+            'entrez_go': {'timestamp': self.old, 'mapping': {'go': {}}},
+            'reporter': {'timestamp': self.old, 'mapping': {'reporter': {}, 'pathway': {}}},
+            'cpdb': {'timestamp': self.old, 'mapping': {'pathway': {}}}}
+        self.builder.get_src_master = lambda: setattr(self.builder, 'src_master', self.src_master)
+        self.last_build = {'src_collections': self.builder.get_src_collection_info(),
+                           'stats': {'total_genes': 10},
+                           'config': self.builder._build_signature()}
+        self.src_master = copy.deepcopy(self.src_master)
+
+    def plan(self):
+        return self.builder.get_incremental_plan(self.last_build)
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.plan(), {'changed': [], 'fields': [], 'sources': []})
+
+    def test_changed(self):
+        self.src_master['entrez_generif']['timestamp'] = self.new
+        self.assertEqual(self.plan(), {'changed': ['entrez_generif'], 'fields': ['generif'],
+                                       'sources': ['entrez_generif']})
+
+    def test_shared_fields(self):
+        # "pathway" set by both: merged again, with all their fields
+        self.src_master['cpdb']['timestamp'] = self.new
+        self.assertEqual(self.plan(), {'changed': ['cpdb'], 'fields': ['pathway', 'reporter'],
+                                       'sources': ['reporter', 'cpdb']})
+        # closure: sharing a field of a collection merged for a shared field
+        self.src_master['entrez_go']['mapping']['reporter'] = {}
+        self.last_build['src_collections']['entrez_go']['fields'].append('reporter')
+        self.assertEqual(self.plan()['sources'], ['entrez_go', 'reporter', 'cpdb'])
+
+    def test_new_fields(self):
+        # fields removed or added since are both removed first
+        self.src_master['entrez_go']['mapping'] = {'gene_ontology': {}}
+        self.assertEqual(self.plan()['fields'], ['gene_ontology', 'go'])
+
+    def test_removed_source(self):
+        self.builder._build_config['sources'].remove('entrez_go')
+        self.assertEqual(self.plan(), {'changed': ['entrez_go'], 'fields': ['go'],
+                                       'sources': []})
+
+    def test_root_changed(self):
+        self.src_master['entrez_gene']['timestamp'] = self.new
+        self.assertIsNone(self.plan())
+
+    def test_root_fields(self):
+        # a root field set by a changed collection
+        self.src_master['cpdb']['mapping'] = {'pathway': {}, 'symbol': {}}
+        self.assertIsNone(self.plan())
+
+    def test_unknown_fields(self):
+        self.src_master['cpdb'] = {'timestamp': self.new}
+        self.last_build['src_collections']['cpdb']['fields'] = []
+        self.assertIsNone(self.plan())
+
+    def test_not_recorded(self):
+        for key in ('src_collections', 'stats'):
+            last_build = dict(self.last_build)
+            del last_build[key]
+            self.assertIsNone(self.builder.get_incremental_plan(last_build))
+
+    def test_config_changed(self):
+        self.builder._build_config['species'] = [9606]
+        self.assertIsNone(self.plan())
+
+
+if __name__ == '__main__':
+    unittest.main()
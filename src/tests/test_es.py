@@ -0,0 +1,261 @@
+'''
+Unit tests of utils.es, not needing ES.
+'''
+import unittest
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from elasticsearch.exceptions import TransportError
+
+from utils.es import (ESQueryBuilder, ESIndexer, bulk_with_retries, _doc_actions,
+                      _index_partition_worker)
+from tests.test_es_bulk import FakeES
+
+
+def _hit(_id, score, **source):
+    return {'_id': _id, '_score': score, '_source': source}
+
+
+def _res(*hits, **kwargs):
+    total = kwargs.get('total', len(hits))
+    return {'took': 1, 'hits': {'total': total, 'max_score': None, 'hits': list(hits)}}
+
+
+class RegroupTermsIdResTest(unittest.TestCase):
+
+    def _regroup(self, ids, responses, scopes=None, **query_options):
+        qbdr = ESQueryBuilder(**query_options)
+        _, id_keys = qbdr.build_terms_id_query(ids, scopes)
+        return qbdr.regroup_terms_id_res(id_keys, responses)
+
+    def _ids(self, res):
+        return [[hit['_id'] for hit in r['hits']['hits']] for r in res]
+
+    def test_one_response_per_id(self):
+        res = self._regroup([1017, 'ENSG00000123374'], [_res(
+            _hit('1017', 5., entrezgene=1017, ensembl={'gene': 'ENSG00000123374'}),
+            _hit('12566', 1., entrezgene=12566, ensembl=[{'gene': 'ENSMUSG1'}]))])
+        self.assertEqual(self._ids(res), [['1017'], ['1017']])
+        self.assertEqual(res[0]['took'], 1)
+        self.assertEqual(res[0]['hits']['total'], 1)
+        self.assertEqual(res[0]['hits']['max_score'], 5.)
+
+    def test_unknown_ids(self):
+        res = self._regroup([1017, 'ENSGXXX', 1], [_res(_hit('1017', 5., entrezgene=1017))])
+        self.assertEqual(self._ids(res), [['1017'], [], []])
+        self.assertEqual(res[1]['hits'], {'total': 0, 'max_score': None, 'hits': []})
+        # no hits at all
+        res = self._regroup(['a', 'b'], [_res()])
+        self.assertEqual(self._ids(res), [[], []])
+
+    def test_duplicate_ids(self):
+        hit = _hit('1017', 5., symbol='CDK2')
+        res = self._regroup(['cdk2', 'CDK2', 'cdk2'], [_res(hit)], scopes='symbol')
+        self.assertEqual(self._ids(res), [['1017'], ['1017'], ['1017']])
+        # hits get annotated per query term: not the same objects
+        hits = [r['hits']['hits'][0] for r in res]
+        self.assertEqual(len(set(id(h) for h in hits)), 3)
+        hits[0]['query'] = 'cdk2'
+        self.assertNotIn('query', hits[1])
+
+    def test_id_in_several_fields(self):
+        # matching both "entrezgene" and "retired": once
+        res = self._regroup([1017], [_res(
+            _hit('1017', 5., entrezgene=1017, retired=[1017, 5]),
+            _hit('5', 2., entrezgene=5, retired=1017))])
+        self.assertEqual(self._ids(res), [['1017', '5']])
+
+    def test_sorted_by_score_and_size(self):
+        hits = [_hit(str(i), float(i), symbol='CDK2') for i in range(5)]
+        res = self._regroup(['cdk2'], [_res(*hits)], scopes='symbol', size=3)
+        self.assertEqual(self._ids(res), [['4', '3', '2']])
+        self.assertEqual(res[0]['hits']['total'], 3)
+
+    def test_several_responses(self):
+        res = self._regroup([1, 2], [_res(_hit('2', 1., entrezgene=2)),
+                                     _res(_hit('1', 1., entrezgene=1))])
+        self.assertEqual(self._ids(res), [['1'], ['2']])
+
+    def test_added_fields_removed(self):
+        res = self._regroup(
+            ['ENSG1'], [_res(_hit('1', 1., symbol='A', ensembl={'gene': 'ENSG1'}))],
+            _source=['symbol'])
+        self.assertEqual(res[0]['hits']['hits'][0]['_source'], {'symbol': 'A'})
+        res = self._regroup(
+            ['ENSG1'], [_res(_hit('1', 1., symbol='A', ensembl={'gene': 'ENSG1'}))],
+            _source=['symbol', 'ensembl'])
+        self.assertEqual(res[0]['hits']['hits'][0]['_source'],
+                         {'symbol': 'A', 'ensembl': {'gene': 'ENSG1'}})
+
+    def test_id_scope(self):
+        res = self._regroup(['1017', 'X'], [_res(_hit('1017', 1.))], scopes='_id')
+        self.assertEqual(self._ids(res), [['1017'], []])
+
+    def test_incomplete_responses(self):
+        # ids must then be looked up one by one
+        self.assertIsNone(self._regroup([1], [{'error': 'failed'}]))
+        self.assertIsNone(self._regroup(
+            [1], [_res(_hit('1', 1., entrezgene=1), total=2)]))
+
+
+def _pending(docs, tee_indices=()):
+    return OrderedDict(action for doc in docs
+                       for action in _doc_actions(doc, 'idx', 'gene', False, tee_indices))
+
+
+def _docs(n):
+    return [{'_id': str(i), 'taxid': 9606 if i % 2 else 10090} for i in range(n)]
+
+
+@mock.patch('utils.es_bulk.time.sleep')
+class BulkWithRetriesTest(unittest.TestCase):
+
+    def test_indexed(self, sleep):
+        client = FakeES()
+        pending = _pending(_docs(4), tee_indices=[('idx_human', set([9606]))])
+        cnt, dead = bulk_with_retries(client, pending, 'idx')
+        # docs of the main index only
+        self.assertEqual(cnt, 4)
+        self.assertEqual(dead, [])
+        self.assertEqual(client.requests, [['0', '1', '1', '2', '3', '3']])
+
+    def test_transient_errors_resent(self, sleep):
+        client = FakeES(statuses={'1': [503, 503], '2': [429] * 11})
+        cnt, dead = bulk_with_retries(client, _pending(_docs(4)), 'idx', max_attempts=3)
+        self.assertEqual(cnt, 4)
+        self.assertEqual(dead, [])
+        # only failed docs are resent
+        self.assertEqual(client.requests[-2:], [['1', '2'], ['1']])
+
+    def test_dead(self, sleep):
+        client = FakeES(statuses={'1': [400], '2': [503] * 5})
+        cnt, dead = bulk_with_retries(client, _pending(_docs(4)), 'idx', max_attempts=3)
+        self.assertEqual(cnt, 2)
+        self.assertEqual(sorted((d['doc_id'], d['status'], d['attempts']) for d in dead),
+                         [('1', 400, 1), ('2', 503, 3)])
+        self.assertEqual(dead[0]['index'], 'idx')
+
+    def test_whole_request_failed(self, sleep):
+        client = FakeES(errors=[TransportError(503, 'unavailable')])
+        cnt, dead = bulk_with_retries(client, _pending(_docs(2)), 'idx')
+        self.assertEqual(cnt, 2)
+        self.assertEqual(dead, [])
+        client = FakeES(errors=[TransportError(503, 'unavailable')] * 2)
+        cnt, dead = bulk_with_retries(client, _pending(_docs(2)), 'idx', max_attempts=2)
+        self.assertEqual(cnt, 0)
+        self.assertEqual([(d['doc_id'], d['attempts']) for d in dead], [('0', 2), ('1', 2)])
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, step):
+        pass
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def close(self):
+        pass
+
+
+class FakeMongoClient(object):
+    def __init__(self, docs):
+        self.collection = mock.Mock()
+        self.collection.find.return_value = FakeCursor(docs)
+        self.closed = False
+
+    def __getitem__(self, name):
+        return {'genedoc': self.collection}
+
+    def close(self):
+        self.closed = True
+
+
+@mock.patch('utils.es_bulk.time.sleep')
+class IndexPartitionWorkerTest(unittest.TestCase):
+
+    def _run(self, client, docs, **kwargs):
+        task = {'mongo_uri': 'mongodb://localhost:27017', 'db': 'genedoc_db',
+                'collection': 'genedoc', 'query': None, 'lo': '0', 'hi': None,
+                'es_host': 'localhost:9200', 'index_name': 'idx', 'doc_type': 'gene',
+                'step': 3, 'bulk_threads': 2, 'max_attempts': 3,
+                'routing_by_taxid': False, 'tee_indices': [], 'tee_names': []}
+        task.update(kwargs)
+        mongo_client = FakeMongoClient(docs)
+        with mock.patch('utils.es.get_mongodb_client', return_value=mongo_client), \
+                mock.patch('utils.es.get_es', return_value=client):
+            res = _index_partition_worker(task)
+        self.assertTrue(mongo_client.closed)
+        return res
+
+    def test_indexed(self, sleep):
+        client = FakeES()
+        res = self._run(client, _docs(8), tee_indices=[('idx_human', [9606])])
+        self.assertEqual((res['docs'], res['indexed'], res['failed']), (8, 8, []))
+        self.assertEqual(len(client.requests), 3)
+
+    def test_rejected_resent(self, sleep):
+        # rejections when ES is busy: resent, not lost
+        client = FakeES(statuses={'1': [429] * 11, '5': [503]})
+        res = self._run(client, _docs(8))
+        self.assertEqual((res['docs'], res['indexed'], res['failed']), (8, 8, []))
+
+    def test_failed(self, sleep):
+        client = FakeES(statuses={'1': [400], '5': [503] * 3})
+        res = self._run(client, _docs(8))
+        self.assertEqual((res['docs'], res['indexed']), (8, 6))
+        self.assertEqual(sorted((d['doc_id'], d['attempts']) for d in res['failed']),
+                         [('1', 1), ('5', 3)])
+
+
+class BuildIndexParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = ESIndexer.__new__(ESIndexer)
+        self.indexer.ES_INDEX_NAME = 'idx'
+        self.indexer.ES_INDEX_TYPE = 'gene'
+        self.indexer.es_host = 'localhost:9200'
+        self.indexer.step = 10
+        self.indexer.routing_by_taxid = False
+        self.indexer.tee_indices = []
+        self.indexer.partition_size = 5
+        self.indexer.num_processes = 2
+        self.indexer.dead_letter_collection = mock.Mock(name='dead_letter')
+        self.collection = mock.Mock()
+        self.collection.find.return_value.count.return_value = 8
+
+    def _build(self, results):
+        def worker(task):
+            return results[task['lo']]
+        with mock.patch('utils.es.id_range_partition', return_value=[('0', '5'), ('5', None)]), \
+                mock.patch('utils.es.get_mongodb_uri', return_value='mongodb://localhost:27017'), \
+                mock.patch('utils.es.ProcessPoolExecutor', ThreadPoolExecutor), \
+                mock.patch('utils.es._index_partition_worker', worker):
+            return self.indexer._build_index_parallel(self.collection)
+
+    def test_indexed(self):
+        cnt = self._build({'0': {'docs': 5, 'indexed': 5, 'failed': []},
+                           '5': {'docs': 3, 'indexed': 3, 'failed': []}})
+        self.assertEqual(cnt, 8)
+        self.assertFalse(self.indexer.dead_letter_collection.insert_many.called)
+
+    def test_failed(self):
+        failure = {'doc_id': '6', 'index': 'idx', 'status': 400, 'error': 'invalid',
+                   'attempts': 1}
+        cnt = self._build({'0': {'docs': 5, 'indexed': 5, 'failed': []},
+                           '5': {'docs': 3, 'indexed': 2, 'failed': [failure]}})
+        self.assertEqual(cnt, 7)
+        records = self.indexer.dead_letter_collection.insert_many.call_args[0][0]
+        self.assertEqual([r['doc_id'] for r in records], ['6'])
+
+    def test_docs_lost(self):
+        self.assertRaises(ValueError, self._build,
+                          {'0': {'docs': 5, 'indexed': 5, 'failed': []},
+                           '5': {'docs': 3, 'indexed': 2, 'failed': []}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+'''
+Unit tests of utils.es_bulk, with a fake ES client (no ES needed).
+'''
+import json
+import unittest
+from unittest import mock
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import TransportError
+
+from utils.es_bulk import BulkSizeController, BulkStats, adaptive_bulk
+
+
+class FakeES(object):
+    '''records bulk requests, answering each doc with the next status of
+       "statuses" (a dict of _id -> list of statuses, default 201), or
+       raising "errors" (a list of exceptions) for whole requests first.'''
+    def __init__(self, statuses=None, errors=None, took=10):
+        self.transport = mock.Mock(serializer=JSONSerializer())
+        self.nodes = mock.Mock()
+        self.nodes.stats.return_value = {'nodes': {}}
+        self.statuses = statuses or {}
+        self.errors = list(errors or [])
+        self.took = took
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        lines = body.rstrip('\n').split('\n')
+        actions = [json.loads(line)['index'] for line in lines[::2]]
+        ids = [action['_id'] for action in actions]
+        self.requests.append(ids)
+        if self.errors:
+            raise self.errors.pop(0)
+        items = []
+        for action in actions:
+            statuses = self.statuses.get(action['_id'])
+            status = statuses.pop(0) if statuses else 201
+            items.append({'index': {'_index': action['_index'], '_id': action['_id'],
+                                    'status': status}})
+        return {'took': self.took, 'items': items}
+
+
+def _actions(n, size=0):
+    return [{'_index': 'idx', '_type': 'gene', '_id': str(i), 'x': 'a' * size}
+            for i in range(n)]
+
+
+class BulkSizeControllerTest(unittest.TestCase):
+
+    def _controller(self, **kwargs):
+        options = dict(chunk_bytes=1000, min_bytes=100, max_bytes=2000,
+                       target_took=1.)
+        options.update(kwargs)
+        return BulkSizeController(**options)
+
+    def test_grow_and_shrink(self):
+        controller = self._controller()
+        controller.update(0.1)
+        self.assertEqual(controller.chunk_bytes, 1250)
+        # between half and full target: unchanged
+        controller.update(0.7)
+        self.assertEqual(controller.chunk_bytes, 1250)
+        controller.update(1.5)
+        self.assertEqual(controller.chunk_bytes, 625)
+        controller.update(None, rejected=True)
+        self.assertEqual(controller.chunk_bytes, 312)
+        self.assertEqual(controller.rejections, 1)
+
+    def test_bounds(self):
+        controller = self._controller()
+        for _ in range(10):
+            controller.update(0.)
+        self.assertEqual(controller.chunk_bytes, 2000)
+        for _ in range(10):
+            controller.update(5.)
+        self.assertEqual(controller.chunk_bytes, 100)
+
+    @mock.patch('utils.es_bulk.time.sleep')
+    def test_backoff(self, sleep):
+        controller = self._controller(max_backoff=5.)
+        delays = []
+        for _ in range(5):
+            controller.update(None, rejected=True)
+            delays.append(controller.backoff())
+        # exponential (with jitter in [delay / 2, delay]), up to max_backoff
+        for delay, expected in zip(delays, [1, 2, 4, 5, 5]):
+            self.assertTrue(expected / 2. <= delay <= expected, (delay, expected))
+        self.assertEqual(sleep.call_count, 5)
+        # reset once docs are accepted again
+        controller.update(0.5)
+        self.assertLessEqual(controller.backoff(), 1.)
+
+    def test_thread_pool_rejections(self):
+        conn = mock.Mock()
+        conn.nodes.stats.side_effect = [
+            {'nodes': {'n1': {'thread_pool': {'bulk': {'rejected': 3}}}}},
+            {'nodes': {'n1': {'thread_pool': {'bulk': {'rejected': 3}}}}},
+            {'nodes': {'n1': {'thread_pool': {'bulk': {'rejected': 5}}},
+                       'n2': {'thread_pool': {}}}},
+            TransportError(500, 'error'),
+        ]
+        controller = self._controller(conn=conn)
+        controller.thread_pool_check_interval = 0
+        # first check: rejections before are not counted
+        controller.update(0.1)
+        self.assertEqual(controller.chunk_bytes, 1250)
+        controller.update(0.1)
+        self.assertEqual(controller.chunk_bytes, 1562)
+        controller.update(0.1)
+        self.assertEqual(controller.chunk_bytes, 781)
+        # stats not available: not a rejection
+        controller.update(0.1)
+        self.assertEqual(controller.chunk_bytes, 976)
+
+
+@mock.patch('utils.es_bulk.time.sleep')
+class AdaptiveBulkTest(unittest.TestCase):
+
+    def _bulk(self, client, actions, chunk_bytes=10 ** 6, **kwargs):
+        controller = BulkSizeController(chunk_bytes=chunk_bytes, min_bytes=1,
+                                        max_bytes=10 ** 6, target_took=1.)
+        stats = BulkStats()
+        res = list(adaptive_bulk(client, actions, controller, stats, **kwargs))
+        return res, controller, stats
+
+    def test_all_indexed(self, sleep):
+        client = FakeES()
+        res, _, stats = self._bulk(client, _actions(5))
+        self.assertEqual([ok for ok, _ in res], [True] * 5)
+        self.assertEqual([item['index']['_id'] for _, item in res], ['0', '1', '2', '3', '4'])
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual(stats.docs, 5)
+        self.assertFalse(sleep.called)
+
+    def test_chunked_by_bytes(self, sleep):
+        client = FakeES(took=500)
+        # ~140 bytes per action, one action per chunk of 200 bytes
+        res, _, _ = self._bulk(client, _actions(3, size=50), chunk_bytes=200)
+        self.assertEqual(client.requests, [['0'], ['1'], ['2']])
+        self.assertEqual(len(res), 3)
+        # an action larger than the chunk size is still sent
+        client = FakeES(took=500)
+        res, _, _ = self._bulk(client, _actions(2, size=500), chunk_bytes=200)
+        self.assertEqual(client.requests, [['0'], ['1']])
+
+    def test_rejected_docs_resent(self, sleep):
+        client = FakeES(statuses={'1': [429, 429], '3': [429]})
+        res, controller, stats = self._bulk(client, _actions(5))
+        # only rejected docs are resent
+        self.assertEqual(client.requests, [['0', '1', '2', '3', '4'], ['1', '3'], ['1']])
+        self.assertEqual(sorted(item['index']['_id'] for ok, item in res if ok),
+                         ['0', '1', '2', '3', '4'])
+        self.assertEqual(stats.rejected, 3)
+        self.assertEqual(stats.docs, 5)
+        self.assertEqual(controller.rejections, 2)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_rejected_max_retries(self, sleep):
+        client = FakeES(statuses={'1': [429] * 10})
+        res, _, stats = self._bulk(client, _actions(3), max_retries=2)
+        self.assertEqual(len(client.requests), 3)
+        failed = [item for ok, item in res if not ok]
+        self.assertEqual(failed, [{'index': {'_index': 'idx', '_id': '1', 'status': 429}}])
+        self.assertEqual(stats.failed, 1)
+
+    def test_errors_not_resent(self, sleep):
+        client = FakeES(statuses={'2': [400]})
+        res, _, stats = self._bulk(client, _actions(3))
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual([ok for ok, _ in res], [True, True, False])
+        self.assertEqual(stats.failed, 1)
+
+    def test_whole_request_rejected(self, sleep):
+        client = FakeES(errors=[TransportError(429, 'rejected')])
+        res, controller, stats = self._bulk(client, _actions(2))
+        self.assertEqual(client.requests, [['0', '1'], ['0', '1']])
+        self.assertEqual([ok for ok, _ in res], [True, True])
+        self.assertEqual(stats.rejected, 2)
+        self.assertEqual(controller.rejections, 1)
+
+    def test_whole_request_error_raised(self, sleep):
+        client = FakeES(errors=[TransportError(500, 'error')])
+        self.assertRaises(TransportError, self._bulk, client, _actions(2))
+        client = FakeES(errors=[TransportError(429, 'rejected')] * 3)
+        self.assertRaises(TransportError, self._bulk, client, _actions(2), max_retries=2)
+
+    def test_no_actions(self, sleep):
+        client = FakeES()
+        res, _, _ = self._bulk(client, [])
+        self.assertEqual(res, [])
+        self.assertEqual(client.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+'''
+Unit tests of utils.idmapping and utils.idset (no MongoDB or ES needed).
+'''
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from utils.idmapping import IDMapping, write_idmapping, load_idmapping
+from utils.idset import IDSet
+
+
+class IDMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _idmapping(self, items, meta=None, name='test.idmap'):
+        filename = os.path.join(self.folder, name)
+        write_idmapping(filename, items, meta=meta)
+        return IDMapping(filename)
+
+    def test_round_trip(self):
+        items = [(1017, 1017), (3, 30), ('ENSG00000123456', 1017),
+                 ('ENSG00000000003', 7105), (-5, 0)]
+        idmapping = self._idmapping(items, meta={'taxids': [9606]})
+        self.assertEqual(len(idmapping), 5)
+        for key, value in items:
+            self.assertIn(key, idmapping)
+            self.assertEqual(idmapping[key], value)
+            self.assertEqual(idmapping.get(key), value)
+        self.assertEqual(idmapping.meta, {'taxids': [9606]})
+        # keys sorted, int ones first
+        self.assertEqual(list(idmapping.keys()),
+                         [-5, 3, 1017, 'ENSG00000000003', 'ENSG00000123456'])
+        self.assertEqual(dict(idmapping.items()), dict(items))
+        idmapping.close()
+
+    def test_missing_keys(self):
+        idmapping = self._idmapping([(1, 10), ('b', 20)])
+        for key in (0, 2, 'a', 'c', '', 1.5, None):
+            self.assertNotIn(key, idmapping)
+            self.assertIsNone(idmapping.get(key))
+            self.assertEqual(idmapping.get(key, -1), -1)
+        self.assertRaises(KeyError, lambda: idmapping[2])
+
+    def test_int_and_str_keys(self):
+        # '1017' is not the same key as 1017
+        idmapping = self._idmapping([(1017, 1), ('1017', 2)])
+        self.assertEqual(len(idmapping), 2)
+        self.assertEqual(idmapping[1017], 1)
+        self.assertEqual(idmapping['1017'], 2)
+        idmapping = self._idmapping([('1017', 2)], name='str.idmap')
+        self.assertNotIn(1017, idmapping)
+        self.assertEqual(idmapping['1017'], 2)
+
+    def test_duplicate_keys(self):
+        # values of a key in the order they came, as a list
+        idmapping = self._idmapping([('a', 3), (1, 5), ('a', 1), ('b', 2),
+                                     (1, 4), ('a', 2)])
+        self.assertEqual(len(idmapping), 3)
+        self.assertEqual(idmapping['a'], [3, 1, 2])
+        self.assertEqual(idmapping[1], [5, 4])
+        self.assertEqual(idmapping['b'], 2)
+        self.assertEqual(dict(idmapping.items()), {1: [5, 4], 'a': [3, 1, 2], 'b': 2})
+
+    def test_empty(self):
+        idmapping = self._idmapping([])
+        self.assertEqual(len(idmapping), 0)
+        self.assertEqual(list(idmapping.items()), [])
+        self.assertNotIn(1, idmapping)
+        self.assertNotIn('a', idmapping)
+        self.assertIsNone(idmapping.meta)
+        for items in ([(1, 1)], [('a', 1)]):
+            idmapping = self._idmapping(items, name='one.idmap')
+            self.assertEqual(len(idmapping), 1)
+
+    def test_unicode_keys(self):
+        idmapping = self._idmapping([('é', 1), ('e', 2), ('z', 3)])
+        self.assertEqual([idmapping[k] for k in ('e', 'z', 'é')], [2, 3, 1])
+
+    def test_not_an_idmapping(self):
+        filename = os.path.join(self.folder, 'other')
+        with open(filename, 'wb') as out_f:
+            out_f.write(b'not an id mapping')
+        self.assertRaises(ValueError, IDMapping, filename)
+
+    def test_pickle(self):
+        idmapping = self._idmapping([(1, 10), ('a', 2), ('a', 3)])
+        obj = pickle.loads(pickle.dumps(idmapping))
+        self.assertEqual(type(obj), dict)
+        self.assertEqual(obj, {1: 10, 'a': [2, 3]})
+
+
+class FakeGridFile(object):
+    def __init__(self, data, upload_date):
+        self.data = data
+        self.length = len(data)
+        self.upload_date = upload_date
+
+    def __iter__(self):
+        for i in range(0, len(self.data), 3):
+            yield self.data[i:i + 3]
+
+
+class FakeGridFS(object):
+    files = {}
+
+    def __init__(self, db):
+        pass
+
+    def exists(self, _id):
+        return _id in self.files
+
+    def get(self, _id):
+        return self.files[_id]
+
+
+class LoadIDMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        FakeGridFS.files = {}
+        self.db = mock.Mock(name='db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _load(self, filename, fallback=None, loaded=None):
+        folder = os.path.join(self.folder, 'idmapping')
+        with mock.patch('gridfs.GridFS', FakeGridFS), \
+                mock.patch('utils.common.loadobj', return_value=loaded) as loadobj:
+            idmapping = load_idmapping(self.db, filename, folder, fallback=fallback)
+        return idmapping, loadobj
+
+    def test_from_gridfs(self):
+        filename = os.path.join(self.folder, 'src.idmap')
+        write_idmapping(filename, [(1, 2), ('a', 3)])
+        with open(filename, 'rb') as in_f:
+            FakeGridFS.files['x.idmap'] = FakeGridFile(in_f.read(), datetime(2016, 10, 18))
+        idmapping, _ = self._load('x.idmap')
+        self.assertEqual(dict(idmapping.items()), {1: 2, 'a': 3})
+        self.assertTrue(os.path.basename(idmapping.filename).endswith('_x.idmap'))
+        # copied once
+        mtime = os.path.getmtime(idmapping.filename)
+        idmapping2, _ = self._load('x.idmap')
+        self.assertEqual(idmapping2.filename, idmapping.filename)
+        self.assertEqual(os.path.getmtime(idmapping2.filename), mtime)
+
+    def test_fallback_dict(self):
+        FakeGridFS.files['x.pyobj'] = FakeGridFile(b'pickled', datetime(2016, 10, 18))
+        idmapping, loadobj = self._load('x.idmap', fallback='x.pyobj',
+                                        loaded={1: 1, 2: [3, 4], 5: (6,)})
+        self.assertEqual(loadobj.call_args[0][0], ('x.pyobj', self.db))
+        self.assertEqual(dict(idmapping.items()), {1: 1, 2: [3, 4], 5: 6})
+        self.assertEqual(idmapping.meta['source'], 'x.pyobj')
+        # converted once
+        idmapping, loadobj = self._load('x.idmap', fallback='x.pyobj', loaded={})
+        self.assertFalse(loadobj.called)
+        self.assertEqual(len(idmapping), 3)
+
+    def test_fallback_list(self):
+        FakeGridFS.files['x.pyobj'] = FakeGridFile(b'pickled', datetime(2016, 10, 18))
+        idmapping, _ = self._load('x.idmap', fallback='x.pyobj',
+                                  loaded=[('ENSG1', 1), ('ENSG2', 2), ('ENSG1', 3)])
+        self.assertEqual(dict(idmapping.items()), {'ENSG1': [1, 3], 'ENSG2': 2})
+
+    def test_missing(self):
+        self.assertRaises(ValueError, self._load, 'x.idmap')
+
+
+class IDSetTest(unittest.TestCase):
+
+    def test_contains(self):
+        ids = IDSet(['1017', 'ENSG00000123456', 3, '01017', '0'])
+        self.assertEqual(len(ids), 5)
+        for _id in ('1017', 1017, 'ENSG00000123456', '3', 3, '01017', '0'):
+            self.assertIn(_id, ids)
+        for _id in ('1018', 'ENSG', '017', '', '00', 'ENSG000001234567'):
+            self.assertNotIn(_id, ids)
+
+    def test_unique_and_order(self):
+        ids = IDSet(['b', '10', 'a', '9', '10', 'b'])
+        self.assertEqual(len(ids), 4)
+        # int-like ids first, numerically sorted
+        self.assertEqual(list(ids), ['9', '10', 'a', 'b'])
+
+    def test_large_int_ids(self):
+        # too large for an int64: kept as str
+        big = '1' * 30
+        ids = IDSet([big, '123456789012345678'])
+        self.assertIn(big, ids)
+        self.assertIn('123456789012345678', ids)
+        self.assertEqual(len(ids), 2)
+
+    def test_empty(self):
+        ids = IDSet()
+        self.assertEqual(len(ids), 0)
+        self.assertEqual(list(ids), [])
+        self.assertNotIn('1', ids)
+        self.assertNotIn('a', ids)
+        self.assertEqual(ids.nbytes(), 8)
+
+    def test_equality(self):
+        self.assertEqual(IDSet(['1', 'a']), IDSet(['a', '1', 'a']))
+        self.assertEqual(IDSet(['1', 'a']), ['a', '1'])
+        self.assertNotEqual(IDSet(['1', 'a']), IDSet(['1', 'b']))
+        self.assertNotEqual(IDSet(['1']), IDSet(['01']))
+        self.assertNotEqual(IDSet(['ab', 'c']), IDSet(['a', 'bc']))
+        self.assertEqual(IDSet(), IDSet([]))
+
+    def test_set_algebra(self):
+        a = IDSet(['1', '2', 'x', 'y'])
+        b = IDSet(['2', '3', 'y', 'z'])
+        self.assertEqual(set(a - b), {'1', 'x'})
+        self.assertEqual(set(a & b), {'2', 'y'})
+        self.assertEqual(set(a | b), {'1', '2', '3', 'x', 'y', 'z'})
+        self.assertIsInstance(a - b, IDSet)
+        self.assertIsInstance(a | b, IDSet)
+        # with other iterables of ids
+        self.assertEqual(set(a - {'1', 'y'}), {'2', 'x'})
+        self.assertEqual(set(a & set()), set())
+        self.assertEqual(a | [], a)
+
+
+if __name__ == '__main__':
+    unittest.main()
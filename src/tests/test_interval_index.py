@@ -0,0 +1,130 @@
+'''
+Unit tests of utils.interval_index (no ES needed).
+'''
+import unittest
+
+from utils.interval_index import GenomicIntervalIndex, GenomicIntervalIndexLoader
+
+
+def _doc(_id, chr, start, end, taxid=9606, field='genomic_pos'):
+    return {'_id': _id, 'taxid': taxid,
+            field: {'chr': chr, 'start': start, 'end': end}}
+
+
+class GenomicIntervalIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = GenomicIntervalIndex.from_docs([
+            _doc('a', '1', 100, 200),
+            _doc('b', '1', 300, 400),
+            # long gene, starting far before the others
+            _doc('long', '1', 10, 10000),
+            _doc('c', 'X', 100, 200),
+            _doc('m', '1', 100, 200, taxid=10090),
+        ], taxids=[9606, 10090])
+
+    def search(self, chr, gstart, gend, taxid=9606, field='genomic_pos'):
+        res = self.index.search(field, taxid, chr, gstart, gend)
+        return None if res is None else sorted(res)
+
+    def test_overlaps(self):
+        self.assertEqual(self.search('1', 150, 350), ['a', 'b', 'long'])
+        self.assertEqual(self.search('1', 210, 290), ['long'])
+        self.assertEqual(self.search('1', 1, 5), [])
+        self.assertEqual(self.search('1', 20000, 30000), [])
+
+    def test_boundaries_inclusive(self):
+        # query ending on gene start, starting on gene end
+        self.assertEqual(self.search('1', 50, 100), ['a', 'long'])
+        self.assertEqual(self.search('1', 200, 250), ['a', 'long'])
+        self.assertEqual(self.search('1', 400, 400), ['b', 'long'])
+        self.assertEqual(self.search('1', 201, 299), ['long'])
+        self.assertEqual(self.search('1', 10000, 10001), ['long'])
+        self.assertEqual(self.search('1', 10001, 10002), [])
+
+    def test_max_len_lookback(self):
+        # "long" starts 9990 before the query, found thanks to max. length
+        self.assertEqual(self.search('1', 9000, 9001), ['long'])
+
+    def test_chr_taxid_field(self):
+        self.assertEqual(self.search('x', 150, 150), ['c'])
+        self.assertEqual(self.search('X', 150, 150), ['c'])
+        self.assertEqual(self.search('2', 150, 150), [])
+        self.assertEqual(self.search('1', 150, 150, taxid=10090), ['m'])
+        # not indexed: query ES instead
+        self.assertIsNone(self.search('1', 150, 150, taxid=10116))
+        self.assertEqual(self.search('1', 150, 150, field='genomic_pos_hg19'), [])
+
+    def test_several_positions(self):
+        doc = {'_id': 'dup', 'taxid': 9606,
+               'genomic_pos': [{'chr': '1', 'start': 100, 'end': 200},
+                               {'chr': '1', 'start': 150, 'end': 250},
+                               {'chr': '2', 'start': 100, 'end': 200}],
+               'genomic_pos_hg19': {'chr': '1', 'start': 1000, 'end': 2000}}
+        index = GenomicIntervalIndex.from_docs([doc], taxids=[9606])
+        self.assertEqual(index.size, 4)
+        # once, even if several of its intervals overlap
+        self.assertEqual(index.search('genomic_pos', 9606, '1', 100, 300), ['dup'])
+        self.assertEqual(index.search('genomic_pos', 9606, '2', 150, 150), ['dup'])
+        self.assertEqual(index.search('genomic_pos_hg19', 9606, '1', 1500, 1500), ['dup'])
+        self.assertEqual(index.search('genomic_pos_hg19', 9606, '1', 150, 150), [])
+
+    def test_invalid_positions(self):
+        docs = [{'_id': 'x', 'taxid': 9606, 'genomic_pos': {'chr': '1', 'start': 'n/a', 'end': 5}},
+                {'_id': 'y', 'taxid': 9606, 'genomic_pos': {'chr': '1', 'start': 1}},
+                {'_id': 'z', 'genomic_pos': {'chr': '1', 'start': 1, 'end': 5}},
+                {'_id': 'w', 'taxid': 9606, 'genomic_pos': None},
+                _doc('ok', '1', '1', '5')]
+        index = GenomicIntervalIndex.from_docs(docs, taxids=[9606])
+        self.assertEqual(index.size, 1)
+        self.assertEqual(index.search('genomic_pos', 9606, '1', 1, 10), ['ok'])
+
+    def test_empty(self):
+        index = GenomicIntervalIndex.from_docs([], taxids=[9606])
+        self.assertEqual(index.search('genomic_pos', 9606, '1', 1, 10), [])
+        self.assertEqual(index.stats(), {'taxids': [9606], 'chromosomes': 0, 'intervals': 0})
+
+
+class GenomicIntervalIndexLoaderTest(unittest.TestCase):
+
+    def test_rebuilt_when_version_changes(self):
+        version = ['v1']
+        docs = [_doc('a', '1', 100, 200)]
+        feeds = []
+
+        def feeder(taxids):
+            feeds.append(taxids)
+            return list(docs)
+        loader = GenomicIntervalIndexLoader([9606], feeder, lambda: version[0])
+        self.assertIsNone(loader.index)
+        loader._refresh()
+        self.assertEqual(loader.index.search('genomic_pos', 9606, '1', 150, 150), ['a'])
+        # same version, not rebuilt
+        loader._refresh()
+        self.assertEqual(len(feeds), 1)
+        version[0] = 'v2'
+        docs.append(_doc('b', '1', 150, 300))
+        loader._refresh()
+        self.assertEqual(len(feeds), 2)
+        self.assertEqual(sorted(loader.index.search('genomic_pos', 9606, '1', 150, 150)), ['a', 'b'])
+        self.assertEqual(loader.stats()['builds'], 2)
+
+    def test_failed_build_keeps_index(self):
+        version = ['v1']
+        loader = GenomicIntervalIndexLoader([9606], lambda taxids: [_doc('a', '1', 1, 2)],
+                                            lambda: version[0])
+        loader._refresh()
+        index = loader.index
+
+        def failing_feeder(taxids):
+            raise IOError('ES down')
+        loader.feeder = failing_feeder
+        version[0] = 'v2'
+        loader._refresh()
+        self.assertIs(loader.index, index)
+        self.assertEqual(loader._version, 'v1')
+        self.assertFalse(loader._refreshing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Unit tests of utils.userfilters, with a fake ES client (no ES needed).
+'''
+import unittest
+
+from utils.userfilters import UserFilters, UserFiltersCache
+
+
+class FakeES(object):
+    '''named filters stored as a dict of _id -> (version, doc), searched
+       with from/size, or scrolled (search_type "scan" as with ES 2.x).'''
+    def __init__(self, filters):
+        self.filters = filters
+        self.scrolls = {}
+
+    def _hits(self, version=False, _source=True):
+        hits = []
+        for _id, (_version, doc) in sorted(self.filters.items()):
+            hit = {'_id': _id}
+            if version:
+                hit['_version'] = _version
+            if _source:
+                hit['_source'] = doc
+            hits.append(hit)
+        return hits
+
+    def _res(self, hits, scroll_id=None):
+        res = {'_shards': {'total': 1, 'failed': 0},
+               'hits': {'total': len(self.filters), 'hits': hits}}
+        if scroll_id:
+            res['_scroll_id'] = scroll_id
+        return res
+
+    def search(self, index=None, doc_type=None, body=None, from_=0, size=10,
+               scroll=None, search_type=None, version=False, _source=True, **kwargs):
+        hits = self._hits(version, _source)
+        if scroll:
+            scroll_id = str(len(self.scrolls))
+            self.scrolls[scroll_id] = (hits, size)
+            if search_type == 'scan':
+                return self._res([], scroll_id)
+            return self.scroll(scroll_id)
+        return self._res(hits[from_:from_ + size])
+
+    def scroll(self, scroll_id, **kwargs):
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return self._res(hits[:size], scroll_id)
+
+    def clear_scroll(self, body=None, **kwargs):
+        for scroll_id in body['scroll_id']:
+            del self.scrolls[scroll_id]
+
+    def count(self, index=None, doc_type=None):
+        return {'count': len(self.filters)}
+
+
+def _filter(ids):
+    return {'terms': {'entrezgene': ids}}
+
+
+class UserFiltersCacheTest(unittest.TestCase):
+
+    def test_load(self):
+        conn = FakeES({'f1': (1, {'_id': 'f1', 'filter': _filter([1017])}),
+                       # _id not stored in the doc
+                       'f2': (1, {'filter': _filter([1018])}),
+                       'nofilter': (1, {})})
+        cache = UserFiltersCache(UserFilters(conn=conn))
+        self.assertEqual(cache.get('f1')['filter'], _filter([1017]))
+        self.assertEqual(cache.get_json('f2'), '{"terms": {"entrezgene": [1018]}}')
+        self.assertIsNone(cache.get('nofilter'))
+        self.assertIsNone(cache.get('f3'))
+        self.assertEqual(cache.stats(), {'filters': 2, 'version': 1})
+
+    def test_reloaded_when_changed(self):
+        conn = FakeES({'f1': (1, {'filter': _filter([1017])})})
+        cache = UserFiltersCache(UserFilters(conn=conn))
+        cache.load()
+        cache.load()
+        self.assertEqual(cache.version, 1)
+        conn.filters['f1'] = (2, {'filter': _filter([1018])})
+        cache.load()
+        self.assertEqual(cache.version, 2)
+        self.assertEqual(cache.get('f1')['filter'], _filter([1018]))
+
+    def test_many_filters(self):
+        # more than one page of hits: all loaded, changes of all of them seen
+        conn = FakeES(dict(('f%d' % i, (1, {'filter': _filter([i])})) for i in range(2500)))
+        cache = UserFiltersCache(UserFilters(conn=conn))
+        self.assertEqual(cache.get('f2499')['filter'], _filter([2499]))
+        self.assertEqual(cache.stats()['filters'], 2500)
+        conn.filters['f2499'] = (2, {'filter': _filter([1])})
+        cache.load()
+        self.assertEqual(cache.get('f2499')['filter'], _filter([1]))
+        self.assertEqual(cache.version, 2)
+        # scroll contexts are cleared
+        self.assertEqual(conn.scrolls, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
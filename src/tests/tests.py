@@ -1,4 +1,4 @@
-import random, os, httplib2
+import random, os, httplib2, json
 from biothings.tests.test_helper import BiothingTestHelperMixin, _d, TornadoRequestHelper
 from nose.tools import ok_, eq_
 
@@ -176,6 +176,45 @@ class MyGeneTest(BiothingTestHelperMixin):
         eq_(res[0]['_id'], '1017')
         eq_(res[1]['_id'], '1018')
 
+        # empty id lists
+        for data in [{'q': '[]', 'jsoninput': 'true'}, {'q': ','}]:
+            res = self.json_ok(self.post_ok(self.api + '/query', data),
+                               checkerror=False)
+            assert 'error' in res, res
+
+        # exact id scopes, with duplicated and unknown ids
+        res = self.json_ok(self.post_ok(self.api + '/query',
+                                        {'q': '1017,cdk2,1017,not_a_gene',
+                                         'scopes': 'entrezgene,symbol',
+                                         'species': 'human',
+                                         'fields': 'name'}))
+        eq_(len(res), 4)
+        eq_([r['query'] for r in res], ['1017', 'cdk2', '1017', 'not_a_gene'])
+        eq_(res[0]['_id'], '1017')
+        eq_(res[1]['_id'], '1017')
+        eq_(set(res[1].keys()), set(['query', '_score', '_id', 'name']))
+        ok_(res[3]['notfound'])
+
+        # large batches are streamed, same response
+        ids = [str(i) for i in range(1017, 2217)]
+        res = self.json_ok(self.post_ok(self.api + '/query',
+                                        {'q': ','.join(ids),
+                                         'scopes': 'entrezgene',
+                                         'fields': 'symbol'}))
+        eq_(res[0]['_id'], '1017')
+        eq_(len(set(r['query'] for r in res)), len(ids))
+
+    def test_export(self):
+        content = self.get_ok(self.api + '/export?q=cdk2&species=human,mouse&fields=symbol')
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        records = [json.loads(line) for line in content.splitlines()]
+        eq_(records[-1], {'_cursor': None})
+        genes = [r for r in records if '_cursor' not in r]
+        ok_(len(genes) >= 2)
+        ok_('1017' in [g['_id'] for g in genes])
+        ok_(all(set(g) <= set(['_id', 'symbol']) for g in genes))
+
     def test_query_interval(self):
         res = self.json_ok(self.get_ok(self.api +
                            '/query?q=chr1:1000-100000&species=human'))
@@ -257,6 +296,10 @@ class MyGeneTest(BiothingTestHelperMixin):
         eq_(res[0]['_id'], '1017')
         eq_(res[1]['_id'], '1018')
 
+        res = self.json_ok(self.post_ok(self.api + '/gene', {'ids': ','}),
+                           checkerror=False)
+        assert 'error' in res, res
+
         res = self.json_ok(self.post_ok(self.api + '/gene',
                            {'ids': '1017,1018',
                             'fields': 'symbol,name,entrezgene'}))
@@ -282,6 +325,15 @@ class MyGeneTest(BiothingTestHelperMixin):
         self.get_ok(self.host + '/status')
         self.head_ok(self.host + '/status')
 
+    def test_response_cache(self):
+        # same response whether it comes from ES or from the cache
+        res = self.json_ok(self.get_ok(self.api + '/gene/1017?fields=symbol,name'))
+        res2 = self.json_ok(self.get_ok(self.api + '/gene/1017?fields=name,symbol'))
+        eq_(res, res2)
+        stats = self.json_ok(self.get_ok(self.host + '/status/cache'))
+        assert 'hits' in stats['response_cache']
+        assert 'coalescing_ratio' in stats['single_flight']
+
     def test_metadata(self):
         root = self.json_ok(self.get_ok(self.host + '/metadata'))
         v3 = self.json_ok(self.get_ok(self.api + '/metadata'))
@@ -0,0 +1,62 @@
+'''
+Benchmark for "chr:start-end" interval queries: ES nested range query vs
+in-process GenomicIntervalIndex (+ ES "ids" query). Both must return the
+same genes. Needs the ES server from config.
+
+    cd src; python tools/bench_interval_index.py [n] [taxid] [assembly] [width]
+'''
+from __future__ import print_function
+import sys
+import time
+import random
+
+from utils.es import ESQuery, ESQueryBuilder
+from utils.interval_index import GenomicIntervalIndex
+
+
+def get_ids(esq, _q, species):
+    _q['size'] = 10000
+    _q['_source'] = False
+    t0 = time.time()
+    res = esq._search(_q, species=species)
+    return set(hit['_id'] for hit in res['hits']['hits']), time.time() - t0
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    taxid = int(sys.argv[2]) if len(sys.argv) > 2 else 9606
+    assembly = sys.argv[3] if len(sys.argv) > 3 else None
+    width = int(sys.argv[4]) if len(sys.argv) > 4 else 1000000
+    esq = ESQuery()
+    t0 = time.time()
+    index = GenomicIntervalIndex.from_docs(esq.genomic_pos_feeder([taxid]), [taxid])
+    print('index built in {:.1f}s: {}'.format(time.time() - t0, index.stats()))
+    field = {'hg19': 'genomic_pos_hg19', 'mm9': 'genomic_pos_mm9'}.get(assembly, 'genomic_pos')
+    chroms = [(key[2], max(index._intervals[key][1])) for key in index._intervals
+              if key[0] == field and key[1] == taxid]
+    es_time = idx_time = lookup_time = 0
+    for i in range(n):
+        chr, chr_len = random.choice(chroms)
+        gstart = random.randint(1, max(1, chr_len - width))
+        gend = gstart + width
+        ESQueryBuilder.genomic_interval_index = None
+        _q = ESQueryBuilder(species=[taxid]).build_genomic_pos_query(chr, gstart, gend, assembly)
+        es_ids, t = get_ids(esq, _q, [taxid])
+        es_time += t
+        t0 = time.time()
+        ESQueryBuilder.genomic_interval_index = index
+        _q = ESQueryBuilder(species=[taxid]).build_genomic_pos_query(chr, gstart, gend, assembly)
+        lookup_time += time.time() - t0
+        idx_ids, _ = get_ids(esq, _q, [taxid])
+        idx_time += time.time() - t0
+        assert es_ids == idx_ids, (chr, gstart, gend, es_ids ^ idx_ids)
+    ESQueryBuilder.genomic_interval_index = None
+    print('{} intervals of {}bp, taxid {}, {}'.format(n, width, taxid, field))
+    print('\tES nested query:\t{:.1f} ms/query'.format(es_time * 1000 / n))
+    print('\tinterval index + ids:\t{:.1f} ms/query (lookup {:.3f} ms)'.format(
+        idx_time * 1000 / n, lookup_time * 1000 / n))
+    print('\tspeedup:\t\t{:.1f}x'.format(es_time / idx_time))
+
+
+if __name__ == '__main__':
+    main()
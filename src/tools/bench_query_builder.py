@@ -0,0 +1,51 @@
+'''
+Microbenchmark for ESQueryBuilder: queries/sec (on one core) for building
+the body of a common symbol query, with and without compiled query templates.
+No ES server is needed, queries are only built and serialized.
+
+    cd src; python tools/bench_query_builder.py [n] [query]
+'''
+from __future__ import print_function
+import sys
+import json
+import time
+
+from utils.es import ESQueryBuilder, query_body
+
+
+def build_body(q, use_template=True, **query_options):
+    esqb = ESQueryBuilder(**query_options)
+    if not use_template:
+        esqb._render_query_template = lambda q: None
+    # serialization is part of the cost of each request
+    body = query_body(esqb.query(q))
+    return body if isinstance(body, str) else json.dumps(body)
+
+
+def bench(n, q, use_template, **query_options):
+    build_body(q, use_template, **query_options)  # warm up/compile
+    t0 = time.time()
+    for i in range(n):
+        build_body(q, use_template, **query_options)
+    return n / (time.time() - t0)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    q = sys.argv[2] if len(sys.argv) > 2 else 'cdk2'
+    query_options = {'species': [9606, 10090, 10116],
+                     '_source': ['name', 'symbol', 'taxid', 'entrezgene'],
+                     'size': 10}
+    # make sure both ways build the same query
+    assert json.loads(build_body(q, True, **query_options)) == \
+        json.loads(build_body(q, False, **query_options))
+    before = bench(n, q, False, **query_options)
+    after = bench(n, q, True, **query_options)
+    print('query "{}", {} runs'.format(q, n))
+    print('\twithout templates:\t{:.0f} queries/sec'.format(before))
+    print('\twith templates:\t\t{:.0f} queries/sec'.format(after))
+    print('\tspeedup:\t\t{:.1f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+'''
+Bounded in-process caches used by the web API.
+'''
+import time
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.gen import convert_yielded
+
+
+class LRUCache(object):
+    '''A least-recently-used cache bounded by the total "size" of its entries,
+       with an optional time-to-live (in seconds) for each entry.
+
+       "sizeof" is a function returning the size of a value. By default every
+       entry has a size of 1, i.e. "max_size" is the max. number of entries.
+       Cached values are shared, callers must not modify them.
+    '''
+    def __init__(self, max_size, ttl=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self._d = OrderedDict()     # key -> (value, size, expires_at)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return self.get(key, touch=False) is not None
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None, touch=True):
+        with self._lock:
+            entry = self._d.get(key)
+            if entry is None:
+                if touch:
+                    self.misses += 1
+                return default
+            value, size, expires_at = entry
+            if expires_at and expires_at < time.time():
+                self._remove(key)
+                self.expirations += 1
+                if touch:
+                    self.misses += 1
+                return default
+            if touch:
+                self._d.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            # never cache a single value larger than the whole cache
+            return False
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._d:
+                self._remove(key)
+            self._d[key] = (value, size, expires_at)
+            self._size += size
+            while self._size > self.max_size:
+                oldest_key = next(iter(self._d))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        _, size, _ = self._d.pop(key)
+        self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self._size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self._d),
+                'size': self._size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits * 1. / total, 4) if total else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+def _json_size(value):
+    return len(json.dumps(value))
+
+
+class ResponseCache(LRUCache):
+    '''Cache of API responses, bounded by the size (in bytes) of their
+       JSON serialization.
+
+       If "index_version" is given, it is called at most once every
+       "check_interval" seconds (on lookups, in a background thread, as it
+       blocks) to get the version of the ES index(es) serving the
+       responses, and the cache is emptied when it changes (e.g. after an
+       index rebuild or an alias swap).
+    '''
+    # query parameters which only change how a response is serialized
+    ignored_params = set(['callback', 'msgpack', '_'])
+    # query parameters taking comma-separated values whose order does not
+    # change the response
+    list_params = set(['fields', 'species', 'scopes', 'species_facet_filter',
+                       'userfilter', 'exists', 'missing'])
+
+    def __init__(self, max_size, ttl=None, index_version=None,
+                 check_interval=60):
+        super(ResponseCache, self).__init__(max_size, ttl=ttl,
+                                            sizeof=_json_size)
+        self.index_version = index_version
+        self.check_interval = check_interval
+        self.invalidations = 0
+        self._version = None
+        self._last_check = 0
+        self._check_lock = threading.Lock()
+        self._checking = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def make_key(self, endpoint, term, params):
+        '''return a hashable, canonical key for a request to "endpoint" for
+           "term" (a gene id, a query string or a list of ids) with
+           query "params".
+        '''
+        if isinstance(term, (list, tuple)):
+            term = tuple(term)
+        _params = []
+        for k, v in params.items():
+            if k in self.ignored_params or v is None:
+                continue
+            if k in self.list_params:
+                if isinstance(v, str):
+                    v = v.split(',')
+                if isinstance(v, (list, tuple)):
+                    v = [str(x).strip() for x in v]
+                    if k == 'species':
+                        v = [x.lower() for x in v]
+                    v = tuple(sorted(set(v)))
+            elif k in ('size', 'from'):
+                try:
+                    v = int(v)
+                except (TypeError, ValueError):
+                    pass
+            elif isinstance(v, (list, dict)):
+                v = json.dumps(v, sort_keys=True)
+            _params.append((k, v))
+        return (endpoint, term, tuple(sorted(_params, key=lambda x: x[0])))
+
+    def check_index_version(self):
+        '''check in background if the ES index version changed, unless
+           checked less than "check_interval" seconds ago.'''
+        if not self.index_version:
+            return
+        now = time.time()
+        with self._check_lock:
+            if self._checking or now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            self._checking = True
+        self._executor.submit(self._check_index_version)
+
+    def _check_index_version(self):
+        '''empty the cache if the ES index version changed since last check.'''
+        try:
+            version = self.index_version()
+        except Exception:
+            # keep serving from cache if ES cannot tell its version now
+            return
+        finally:
+            self._checking = False
+        if version != self._version:
+            if self._version is not None:
+                self.clear()
+                self.invalidations += 1
+            self._version = version
+
+    def get(self, key, default=None, touch=True):
+        if touch:
+            self.check_index_version()
+        return super(ResponseCache, self).get(key, default=default, touch=touch)
+
+    def stats(self):
+        _stats = super(ResponseCache, self).stats()
+        _stats['invalidations'] = self.invalidations
+        _stats['index_version'] = self._version
+        return _stats
+
+
+class SingleFlight(object):
+    '''Coalesce concurrent identical calls: while a call for a given key is
+       in flight, other callers for the same key wait for its result instead
+       of making their own call. Nothing is kept once the call is done.
+       As with LRUCache, results are shared, callers must not modify them.
+
+       Meant to be used from coroutines running on the same IOLoop.
+    '''
+    def __init__(self):
+        self._inflight = {}     # key -> Future
+        self.calls = 0
+        self.executed = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, func, *args, **kwargs):
+        '''return the result of "func(*args, **kwargs)" (a coroutine function),
+           shared with all callers awaiting the same key.
+        '''
+        self.calls += 1
+        future = self._inflight.get(key)
+        if future is None:
+            self.executed += 1
+            future = convert_yielded(func(*args, **kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        return await future
+
+    def stats(self):
+        coalesced = self.calls - self.executed
+        return {'calls': self.calls,
+                'executed': self.executed,
+                'coalesced': coalesced,
+                'coalescing_ratio': round(coalesced * 1. / self.calls, 4) if self.calls else None,
+                'in_flight': len(self._inflight)}
@@ -7,25 +7,48 @@ from __future__ import print_function
 # http://www.elasticsearch.org/guide/reference/query-dsl/custom-boost-factor-query.html
 # http://www.elasticsearch.org/guide/reference/query-dsl/boosting-query.html
 import sys
+import os
 
 import json
 import re
 import time
 import copy
+import heapq
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait, FIRST_COMPLETED)
+from queue import Queue, Full
+from urllib.parse import quote_plus
 import requests
 
 from config import (ES_INDEX_NAME_TIER1, ES_INDEX_NAME,
                     SOURCE_TRANSLATORS, GENOME_ASSEMBLY,
-                    TAXONOMY, ES_HOST,  ES_INDEX_TYPE)
+                    TAXONOMY, ES_HOST,  ES_INDEX_TYPE,
+                    ES_SCROLL_SIZE, ES_SCROLL_TIME,
+                    USERFILTERS_CHECK_INTERVAL, ES_INDEXER_PROCESSES,
+                    ES_INDEXER_PARTITION_SIZE, ES_INDEXER_BULK_THREADS,
+                    ES_INDEXER_MAX_ATTEMPTS, ES_INDEXER_DEAD_LETTER_COLLECTION,
+                    ES_INDEX_BUILD_PROFILE, ES_ROUTING_BY_TAXID,
+                    ES_SOURCE_DEFAULT_EXCLUDES, DATA_SERVER_USERNAME,
+                    DATA_SERVER_PASSWORD)
 from biothings.utils.common import (ask, is_int, is_str,
-                                    is_seq, timesofar)
+                                    is_seq, timesofar, iter_n)
 from biothings.www.api.es import ESQuery, QueryError, ESQueryBuilder, \
                                  parse_facets_option
 from elasticsearch import Elasticsearch
-from .userfilters import UserFilters
+from elasticsearch.exceptions import TransportError, NotFoundError
+from .userfilters import UserFilters, UserFiltersCache
+from .cache import LRUCache
+from .interval_index import GENOMIC_POS_FIELDS
+from .es_pool import get_es_client
+from .es_bulk import BulkSizeController, BulkStats, adaptive_bulk
+from .idset import IDSet
+from .field_cost import SourceStats, source_excludes
 
 from elasticsearch import helpers
-from biothings.utils.mongo import doc_feeder
+from biothings.utils.mongo import doc_feeder, get_target_db
 
 
 import logging
@@ -57,9 +80,156 @@ def safe_genome_pos(s):
         raise ValueError('invalid type "%s" for "save_genome_pos"' % type(s))
 
 
+# SOURCE_TRANSLATORS compiled once, applied on every query term
+_SOURCE_TRANSLATORS_RE = [(re.compile(src, re.I), regex)
+                          for (src, regex) in SOURCE_TRANSLATORS.items()]
+# a query term without ":" can skip translation if all patterns need one
+_SOURCE_TRANSLATORS_NEED_COLON = all(':' in src for src in SOURCE_TRANSLATORS)
+# translated field names (for scopes, multi_match fields...)
+_translated_fields = LRUCache(10000)
+
+# placeholder for the user query term in compiled query templates
+_TERM_PLACEHOLDER = '__mygene_query_term__'
+# placeholder for a named filter, replaced by the filter pre-serialized
+# when serializing msearch queries
+_USERFILTER_PLACEHOLDER = '__mygene_userfilter__'
+_USERFILTER_PLACEHOLDER_RE = re.compile(
+    r'\{\s*"%s"\s*:\s*"([^"]*)"\s*\}' % _USERFILTER_PLACEHOLDER)
+
+# named filters ("userfilter" parameter), shared by all query builders
+user_filters = UserFiltersCache(UserFilters(conn=get_es_client()),
+                                check_interval=USERFILTERS_CHECK_INTERVAL)
+
+# hits returned without fields excluded by default (ES_SOURCE_DEFAULT_EXCLUDES)
+source_stats = SourceStats()
+
+# id scopes which can be looked up with exact "terms" queries, with how an
+# id is normalized for each of them ("symbol" and "ensembl.gene" use the
+# "string_lowercase" analyzer, i.e. the whole string, lowercased)
+_TERMS_ID_FIELDS = {
+    '_id': str,
+    'entrezgene': int,
+    'retired': int,
+    'ensembl.gene': lambda x: str(x).lower(),
+    'symbol': lambda x: str(x).lower(),
+}
+# max. number of ids per "terms" query, and max. number of hits per
+# query (ES "index.max_result_window")
+_TERMS_ID_CHUNK_SIZE = 1000
+_TERMS_ID_MAX_HITS = 10000
+
+
+def _get_dotted_values(doc, field):
+    '''return the list of values of dotted "field" in "doc" (lists are
+       flattened at any level).'''
+    values = [doc]
+    for key in field.split('.'):
+        _values = []
+        for v in values:
+            if isinstance(v, dict) and key in v:
+                v = v[key]
+                _values.extend(v if isinstance(v, list) else [v])
+        values = _values
+    return values
+
+
+def _pop_dotted_field(doc, field):
+    '''remove dotted "field" from "doc", and its parents left empty.'''
+    key, _, rest = field.partition('.')
+    if isinstance(doc, list):
+        for d in doc:
+            _pop_dotted_field(d, field)
+    elif isinstance(doc, dict) and key in doc:
+        if rest:
+            _pop_dotted_field(doc[key], rest)
+            if isinstance(doc[key], list):
+                doc[key] = [d for d in doc[key] if d]
+            if not doc[key]:
+                del doc[key]
+        else:
+            del doc[key]
+
+
+class QueryTemplate(object):
+    '''A query body pre-serialized into JSON fragments around the user
+       query term, so that rendering it for a given term is only a
+       string concatenation.
+    '''
+    def __init__(self, query):
+        body = json.dumps(query)
+        self._fragments = body.split(json.dumps(_TERM_PLACEHOLDER))
+
+    def render(self, term, options=None):
+        '''return the JSON body for "term", with extra top-level
+           query "options" (size, from, _source...) if any.
+        '''
+        body = json.dumps(term).join(self._fragments)
+        if options:
+            body = body[:-1] + ', ' + json.dumps(options)[1:]
+        return body
+
+
+class JSONQuery(dict):
+    '''A query dict carrying its JSON serialization (rendered from a
+       QueryTemplate), so it does not need to be serialized again before
+       being sent to ES. The serialization is dropped as soon as the query
+       is modified (top-level keys only, nested values must not be modified).
+    '''
+    def __init__(self, body):
+        super(JSONQuery, self).__init__(json.loads(body))
+        self.body = body
+
+    def _modified(method):
+        def wrapper(self, *args, **kwargs):
+            self.body = None
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    __setitem__ = _modified(dict.__setitem__)
+    __delitem__ = _modified(dict.__delitem__)
+    update = _modified(dict.update)
+    pop = _modified(dict.pop)
+    popitem = _modified(dict.popitem)
+    setdefault = _modified(dict.setdefault)
+    clear = _modified(dict.clear)
+    del _modified
+
+
+def query_body(q):
+    '''return the body to send to ES for query "q".'''
+    if isinstance(q, JSONQuery) and q.body is not None:
+        return q.body
+    return q
+
+
+def taxid_routing(doc):
+    '''return the routing value of "doc" in an index routed by taxid,
+       None if it has no taxid.'''
+    taxid = doc.get('taxid')
+    return None if taxid is None else str(taxid)
+
+
+def msearch_routing(body, routing):
+    '''set "routing" in the header of each query of msearch "body" (a str
+       of header/query lines, or a list of headers and queries).'''
+    if is_str(body):
+        lines = body.rstrip('\n').split('\n')
+        for i in range(0, len(lines), 2):
+            header = json.loads(lines[i])
+            header['routing'] = routing
+            lines[i] = json.dumps(header)
+        return '\n'.join(lines) + '\n'
+    body = list(body)
+    for i in range(0, len(body), 2):
+        body[i] = dict(body[i], routing=routing)
+    return body
+
+
 class ESQuery(ESQuery):
     def __init__(self):
         super(ESQuery, self).__init__()
+        # all ESQuery instances of the process share one connection pool
+        self._es = get_es_client()
         self._default_fields = ['name', 'symbol', 'taxid', 'entrezgene']
         self._default_species = [9606, 10090, 10116]  # human, mouse, rat
         self._tier_1_species = set(TAXONOMY.values())
@@ -69,25 +239,49 @@ class ESQuery(ESQuery):
         if kwargs.get("scroll"):
             scroll_options["size"] = kwargs.get("size")
             scroll_options["scroll"] = kwargs.get("scroll")
+        routing = self._get_routing(species)
+        if routing:
+            scroll_options["routing"] = routing
         self._set_index(species)
         res = self._es.search(index=self._index, doc_type=self._doc_type,
-                              body=q, **scroll_options)
+                              body=query_body(q), **scroll_options)
         self._index = ES_INDEX_NAME  # reset self._index
+        if ES_SOURCE_DEFAULT_EXCLUDES:
+            source_stats.add_res(source_excludes(q), res)
         return res
 
     def _msearch(self, **kwargs):
-        self._set_index(kwargs.get('species', 'all'))
+        species = kwargs.get('species', 'all')
+        routing = self._get_routing(species)
+        if routing and kwargs.get('body'):
+            kwargs['body'] = msearch_routing(kwargs['body'], routing)
+        self._set_index(species)
         # logging.debug("_msearch: %s" % kwargs['body'])
         res = super(ESQuery, self)._msearch(**kwargs)
         self._index = ES_INDEX_NAME     # reset self._index
+        if ES_SOURCE_DEFAULT_EXCLUDES and kwargs.get('body'):
+            source_stats.add_res(source_excludes(kwargs['body']), res)
         return res
 
-    def _set_index(self, species):
-        '''set proper index for given species parameter.'''
+    def _get_routing(self, species):
+        '''return routing values (comma-separated taxids) for given species
+           parameter, to only search the shards holding docs of these
+           species, or None to search all shards.'''
+        if not ES_ROUTING_BY_TAXID or species is None or species == 'all' or \
+           not is_seq(species) or not all(is_int(s) for s in species):
+            return None
+        return ','.join(sorted(set(str(s) for s in species)))
+
+    def _get_index(self, species):
+        '''return proper index for given species parameter.'''
         if species == 'all' or len(set(species)-self._tier_1_species) > 0:
-            self._index = ES_INDEX_NAME
+            return ES_INDEX_NAME
         else:
-            self._index = ES_INDEX_NAME_TIER1
+            return ES_INDEX_NAME_TIER1
+
+    def _set_index(self, species):
+        '''set proper index for given species parameter.'''
+        self._index = self._get_index(species)
 
     def _get_query_builder(self, **kwargs):
         return ESQueryBuilder(**kwargs)
@@ -160,7 +354,10 @@ class ESQuery(ESQuery):
         mapping = self._es.indices.get_mapping(self._index, self._doc_type)
         if raw:
             return mapping
+        return self._format_metadata(mapping)
 
+    def _format_metadata(self, mapping):
+        '''return metadata from the raw mapping of the index.'''
         def get_fields(properties):
             for k, v in list(properties.items()):
                 if 'properties' in v:
@@ -187,6 +384,38 @@ class ESQuery(ESQuery):
             metadata["source"] = None
         return metadata
 
+    def field_costs(self):
+        '''return the cost of each top-level field (see
+           utils.field_cost.get_field_costs) recorded in the index
+           metadata, None if not recorded.'''
+        mapping = self._es.indices.get_mapping(ES_INDEX_NAME, self._doc_type)
+        mapping = list(mapping.values())[0]['mappings'][self._doc_type]
+        return mapping.get('_meta', {}).get('field_costs')
+
+    def index_version(self):
+        '''return the concrete index names and uuids behind ES_INDEX_NAME
+           and ES_INDEX_NAME_TIER1. It changes when an index is rebuilt
+           or an alias is moved to another index.
+        '''
+        res = self._es.indices.get_settings(
+            index=','.join([ES_INDEX_NAME, ES_INDEX_NAME_TIER1]),
+            name='index.uuid')
+        return tuple(sorted((index, v['settings']['index']['uuid'])
+                            for index, v in res.items()))
+
+    def genomic_pos_feeder(self, taxids):
+        '''yield docs (_id, taxid and genomic positions) of all genes from
+           "taxids", to build a GenomicIntervalIndex.'''
+        _q = {"query": {"terms": {"taxid": list(taxids)}},
+              "_source": ['taxid'] + GENOMIC_POS_FIELDS}
+        for hit in helpers.scan(self._es, query=_q,
+                                index=self._get_index(list(taxids)),
+                                doc_type=self._doc_type,
+                                scroll=ES_SCROLL_TIME, size=ES_SCROLL_SIZE):
+            doc = hit['_source']
+            doc['_id'] = hit['_id']
+            yield doc
+
     def get_gene(self, geneid, **kwargs):
         '''for /gene/<geneid>'''
         options = self._get_cleaned_annotation_options(kwargs)
@@ -201,6 +430,12 @@ class ESQuery(ESQuery):
 
 
 class ESQueryBuilder(ESQueryBuilder):
+    # compiled query templates, shared by all builders. Keys include the
+    # version of named userfilters, so that their changes are picked up.
+    _query_templates = LRUCache(1024)
+    # optional GenomicIntervalIndexLoader answering interval queries
+    genomic_interval_index = None
+
     def __init__(self, **query_options):
         """You can pass these options:
             fields     default ['name', 'symbol', 'taxid', 'entrezgene']
@@ -235,6 +470,9 @@ class ESQueryBuilder(ESQueryBuilder):
         # userfilter
         userfilter = self._query_options.pop('userfilter', None)
         self.userfilter = userfilter.split(',') if userfilter else None
+        # name -> serialized filter, when userfilters are added as
+        # placeholders (see _dumps)
+        self._userfilter_json = None
         # exist filter
         existsfilter = self._query_options.pop('exists', None)
         self.existsfilter = existsfilter.split(',') if existsfilter else None
@@ -257,6 +495,11 @@ class ESQueryBuilder(ESQueryBuilder):
                 self._query_options['fields'] is not None:
             self._query_options['_source'] = self._query_options['fields']
             del self._query_options['fields']
+        # all fields but the costliest ones, unless asked for
+        if self._query_options.get('_source') is None and \
+                ES_SOURCE_DEFAULT_EXCLUDES:
+            self._query_options['_source'] = {
+                'exclude': list(ES_SOURCE_DEFAULT_EXCLUDES)}
 
         # this is a fake query to make sure to return empty hits
         self._nohits_query = {
@@ -266,6 +509,18 @@ class ESQueryBuilder(ESQueryBuilder):
         }
 
     def _translate_datasource(self, q, trim_from="", unescape=False):
+        if not (trim_from or unescape):
+            if _SOURCE_TRANSLATORS_NEED_COLON and ':' not in q:
+                return q
+            for pat, regex in _SOURCE_TRANSLATORS_RE:
+                q = pat.sub(regex, q)
+            return q
+        # field names, the same few are translated over and over
+        key = (q, trim_from, unescape)
+        _q = _translated_fields.get(key)
+        if _q is not None:
+            return _q
+        _q = q
         for src in SOURCE_TRANSLATORS.keys():
             regex = SOURCE_TRANSLATORS[src]
             if trim_from:
@@ -274,8 +529,9 @@ class ESQueryBuilder(ESQueryBuilder):
             if unescape:
                 regex = regex.replace("\\","")
                 src = src.replace("\\","")
-            q = re.sub(src, regex, q, flags=re.I)
-        return q
+            _q = re.sub(src, regex, _q, flags=re.I)
+        _translated_fields.set(key, _q)
+        return _q
 
     def _parse_interval_query(self, query):
         '''Check if the input query string matches interval search regex,
@@ -546,9 +802,14 @@ class ESQueryBuilder(ESQueryBuilder):
             })
 
         if self.userfilter:
-            _uf = UserFilters()
             for _fname in self.userfilter:
-                _filter = _uf.get(_fname)
+                if self._userfilter_json is not None:
+                    _json = user_filters.get_json(_fname)
+                    if _json:
+                        self._userfilter_json[_fname] = _json
+                        filters.append({_USERFILTER_PLACEHOLDER: _fname})
+                    continue
+                _filter = user_filters.get(_fname)
                 if _filter:
                     filters.append(_filter['filter'])
 
@@ -654,6 +915,9 @@ class ESQueryBuilder(ESQueryBuilder):
                                  'Specify a single species.')
 
         else:
+            _q = self._render_query_template(q)
+            if _q is not None:
+                return _q
             _query = self.generate_query(q)
             # TODO: this is actually not used, how useful ?
             # _query = self.string_query(q)
@@ -666,6 +930,51 @@ class ESQueryBuilder(ESQueryBuilder):
             # logging.debug("_q = %s" % json.dumps(_q))
             return _q
 
+    def _query_template_key(self, query_type):
+        def _tuple(x):
+            return tuple(x) if is_seq(x) else x
+        return (query_type, _tuple(self.species),
+                _tuple(self.species_facet_filter),
+                self.entrezonly, self.ensemblonly, _tuple(self.userfilter),
+                user_filters.version if self.userfilter else None,
+                _tuple(self.existsfilter), _tuple(self.missingfilter))
+
+    def _compile_query_template(self, query_type):
+        if query_type == 'wildcard':
+            _query = self.wildcard_query(_TERM_PLACEHOLDER)
+        else:
+            _query = self.dis_max_query(_TERM_PLACEHOLDER)
+        _query = self.add_query_filters(_query)
+        _query = self.add_species_custom_filters_score(_query)
+        return QueryTemplate(self.add_facet_filters({'query': _query}))
+
+    def _render_query_template(self, q):
+        '''return the same query as generate_query and query would build for
+           "q", but rendered from a compiled template, or None if "q" is not
+           a wildcard or a plain text (dis_max) query.
+           Templates are compiled once per combination of query type and
+           filters (species, entrezonly, userfilter...).
+        '''
+        # same checks, in the same order as in generate_query
+        if self._is_user_query() or q == '__all__' or \
+           self._is_raw_string_query(q):
+            return
+        if self._is_wildcard_query(q):
+            query_type = 'wildcard'
+            term = q.lower()
+        else:
+            query_type = 'dis_max'
+            term = q.replace('"', '').replace('\\', '')
+            if is_int(term):
+                # entrezgene term query, different structure
+                return
+        key = self._query_template_key(query_type)
+        template = self._query_templates.get(key)
+        if template is None:
+            template = self._compile_query_template(query_type)
+            self._query_templates.set(key, template)
+        return JSONQuery(template.render(term, self._query_options))
+
     # keepit (but similar)
     def build_id_query(self, id, scopes=None):
         id_is_int = is_int(id)
@@ -761,6 +1070,162 @@ class ESQueryBuilder(ESQueryBuilder):
 
         return _q
 
+    def _replace_userfilters(self, body):
+        '''replace named filter placeholders in serialized query "body" with
+           the pre-serialized filters.'''
+        if not self._userfilter_json:
+            return body
+        return _USERFILTER_PLACEHOLDER_RE.sub(
+            lambda m: self._userfilter_json[m.group(1)], body)
+
+    def build_multiple_id_query(self, id_list, scopes=None):
+        '''make a query body for msearch query.'''
+        # the same named filters are in every query, serialize them once
+        self._userfilter_json = {}
+        try:
+            return self._replace_userfilters(
+                super(ESQueryBuilder, self).build_multiple_id_query(id_list, scopes))
+        finally:
+            self._userfilter_json = None
+
+    def _id_query_fields(self, id, scopes=None):
+        '''return the fields build_id_query looks up "id" in.'''
+        id_is_int = is_int(id)
+        if scopes is None:
+            return ['entrezgene', 'retired'] if id_is_int else ['ensembl.gene']
+        elif is_str(scopes):
+            if scopes in ['entrezgene', 'retired']:
+                return [scopes] if id_is_int else []
+            return [self._translate_datasource(scopes, trim_from=":", unescape=True)]
+        elif is_seq(scopes):
+            int_fields = [f for f in scopes if f in ['entrezgene', 'retired']]
+            if id_is_int:
+                return int_fields
+            return [self._translate_datasource(f, trim_from=":", unescape=True)
+                    for f in scopes if f not in int_fields]
+        else:
+            raise ValueError('"scopes" cannot be "%s" type' % type(scopes))
+
+    def build_terms_id_query(self, id_list, scopes=None):
+        '''Same lookup as build_multiple_id_query, when all scopes are exact
+           match fields (see _TERMS_ID_FIELDS): instead of one query per id,
+           one "terms" query per chunk of ids, as a msearch query body.
+           Return a tuple (query body, id keys), id keys to be passed to
+           regroup_terms_id_res with the responses, or None if ids cannot
+           be looked up this way.
+        '''
+        if set(self._query_options) - set(['_source', 'size', 'from', 'dotfield']) or \
+           self._query_options.get('from'):
+            # hits paging/sorting/aggs are per id
+            return
+        id_keys = []
+        for id in id_list:
+            fields = self._id_query_fields(id, scopes)
+            if not set(fields) <= set(_TERMS_ID_FIELDS):
+                return
+            try:
+                id_keys.append([(f, _TERMS_ID_FIELDS[f](id)) for f in fields])
+            except ValueError:
+                return
+        try:
+            size = int(self._query_options.get('size', 10))
+        except ValueError:
+            return
+        # the fields ids are looked up in are needed to regroup hits
+        self._terms_id_size = size
+        self._terms_id_added_fields = []
+        _source = self._query_options.get('_source')
+        if isinstance(_source, dict):
+            # fields ids are looked up in must be returned
+            for f in set(f for keys in id_keys for f, _ in keys):
+                if any(f == x or f.startswith(x + '.') for x in _source.get('exclude', [])):
+                    return
+        elif _source:
+            _source = _source.split(',') if is_str(_source) else list(_source)
+            for f in OrderedDict.fromkeys(f for keys in id_keys for f, _ in keys):
+                if f != '_id' and not any(f == x or f.startswith(x + '.') for x in _source):
+                    _source.append(f)
+                    self._terms_id_added_fields.append(f)
+        # chunks of unique keys
+        keys = list(OrderedDict.fromkeys(k for keys in id_keys for k in keys))
+        chunk_size = max(1, min(_TERMS_ID_CHUNK_SIZE, _TERMS_ID_MAX_HITS // max(size, 1)))
+        _q = []
+        self._userfilter_json = {}
+        for i in range(0, len(keys), chunk_size):
+            values = OrderedDict()
+            for f, v in keys[i:i + chunk_size]:
+                values.setdefault(f, []).append(v)
+            _queries = [{"ids": {"values": v}} if f == '_id' else {"terms": {f: v}}
+                        for f, v in values.items()]
+            if len(_queries) == 1:
+                _query = _queries[0]
+            else:
+                _query = {"bool": {"should": _queries, "minimum_should_match": 1}}
+            _query = self.add_query_filters(_query)
+            _query = self.add_species_custom_filters_score(_query)
+            _body = dict(self._query_options, query=_query,
+                         size=min(_TERMS_ID_MAX_HITS, len(keys[i:i + chunk_size]) * size))
+            _body.pop('from', None)
+            if _source:
+                _body['_source'] = _source
+            _q.extend(['{}', self._replace_userfilters(json.dumps(_body))])
+        self._userfilter_json = None
+        _q.append('')
+        return '\n'.join(_q), id_keys
+
+    def regroup_terms_id_res(self, id_keys, responses):
+        '''Regroup the msearch "responses" to a query from build_terms_id_query
+           into one response per id (same as responses to the query from
+           build_multiple_id_query). Return None if a response has an error
+           or is missing hits (ids must then be looked up one by one).
+        '''
+        for res in responses:
+            if 'error' in res or res['hits']['total'] > len(res['hits']['hits']):
+                return
+        fields = set(f for keys in id_keys for f, _ in keys)
+        hits_by_key = {}
+        for res in responses:
+            for hit in res['hits']['hits']:
+                hit_keys = set()
+                for f in fields:
+                    if f == '_id':
+                        hit_keys.add(('_id', hit['_id']))
+                        continue
+                    for v in _get_dotted_values(hit.get('_source', {}), f):
+                        try:
+                            hit_keys.add((f, _TERMS_ID_FIELDS[f](v)))
+                        except (TypeError, ValueError):
+                            pass
+                for key in hit_keys:
+                    hits_by_key.setdefault(key, []).append(hit)
+        template = dict((k, v) for (k, v) in responses[0].items() if k != 'hits') \
+            if responses else {}
+        used = set()
+        _responses = []
+        for keys in id_keys:
+            hits = []
+            for key in keys:
+                hits.extend(hits_by_key.get(key, []))
+            if len(keys) > 1:
+                hits = list(dict((id(h), h) for h in hits).values())
+            # same order as a query per id
+            hits.sort(key=lambda h: -h['_score'])
+            hits = hits[:self._terms_id_size]
+            _hits = []
+            for hit in hits:
+                # hits get annotated with their query term
+                if id(hit) in used:
+                    hit = copy.deepcopy(hit)
+                used.add(id(hit))
+                for f in self._terms_id_added_fields:
+                    _pop_dotted_field(hit.get('_source', {}), f)
+                _hits.append(hit)
+            _responses.append(dict(template, hits={
+                'total': len(_hits),
+                'max_score': _hits[0]['_score'] if _hits else None,
+                'hits': _hits}))
+        return _responses
+
     def build_genomic_pos_query(self, chr, gstart, gend, assembly=None):
         '''By default if assembly is None, the lastest assembly is used.
            for some species (e.g. human) we support multiple assemblies,
@@ -778,7 +1243,33 @@ class ESQueryBuilder(ESQueryBuilder):
             if assembly == 'mm9':
                 genomic_pos_field = "genomic_pos_mm9"
 
-        _query = {
+        _ids = None
+        if self.genomic_interval_index and is_seq(self.species) and \
+           len(self.species) == 1:
+            _ids = self.genomic_interval_index.search(
+                genomic_pos_field, self.species[0], chr, gstart, gend)
+        if _ids is not None:
+            # genes found from the in-process interval index
+            _query = {"ids": {"values": _ids}}
+        else:
+            _query = self._genomic_pos_nested_query(genomic_pos_field, chr,
+                                                    gstart, gend)
+        # _query = {
+        #     'filtered': {
+        #         'query': _query,
+        #         'filter' : {
+        #             "term" : {"taxid" : taxid}
+        #         }
+        #     }
+        # }
+        _query = self.add_query_filters(_query)
+        _q = {'query': _query}
+        if self._query_options:
+            _q.update(self._query_options)
+        return _q
+
+    def _genomic_pos_nested_query(self, genomic_pos_field, chr, gstart, gend):
+        return {
             "nested": {
                 "path": genomic_pos_field,
                 "query": {
@@ -795,19 +1286,6 @@ class ESQueryBuilder(ESQueryBuilder):
                 }
             }
         }
-        # _query = {
-        #     'filtered': {
-        #         'query': _query,
-        #         'filter' : {
-        #             "term" : {"taxid" : taxid}
-        #         }
-        #     }
-        # }
-        _query = self.add_query_filters(_query)
-        _q = {'query': _query}
-        if self._query_options:
-            _q.update(self._query_options)
-        return _q
 
 # ################# #
 # FROM MYGENE.HUB   #
@@ -832,10 +1310,202 @@ def lastexception():
     return str(exc_type)+':'+''.join([str(x) for x in excArgs])
 
 
+def tee_query(query, taxids):
+    '''MongoDB query for docs matching "query" from "taxids" species.'''
+    _query = {'taxid': {'$in': sorted(taxids)}}
+    if query:
+        _query = {'$and': [query, _query]}
+    return _query
+
+
+def _is_transient_error(status):
+    '''True if a doc failing with "status" may be indexed when resent: on
+       rejections (429), ES node errors (5xx) and connection errors (no
+       status), not on invalid docs (4xx).'''
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+def _id_type(_id):
+    # MongoDB range queries only match _ids of the same (BSON) type
+    return 'number' if isinstance(_id, (int, float)) else type(_id).__name__
+
+
+def id_range_partition(collection, query=None, size=100000):
+    '''split docs of "collection" matching "query" into consecutive _id ranges
+       of "size" docs, returned as (first _id, first _id of next range) pairs,
+       the last one of each _id type having None as upper bound.
+    '''
+    cur = collection.find(query, projection={'_id': 1}).sort('_id', 1)
+    cur.batch_size(10000)
+    bounds = []
+    cnt = 0
+    try:
+        for doc in cur:
+            _id = doc['_id']
+            if cnt % size == 0 or _id_type(_id) != _id_type(bounds[-1]):
+                bounds.append(_id)
+                cnt = 0
+            cnt += 1
+    finally:
+        cur.close()
+    ranges = []
+    for i, lo in enumerate(bounds):
+        hi = bounds[i + 1] if i + 1 < len(bounds) else None
+        if hi is not None and _id_type(hi) != _id_type(lo):
+            hi = None
+        ranges.append((lo, hi))
+    return ranges
+
+
+def get_mongodb_uri(collection):
+    '''return a URI to connect to the server of "collection" from another
+       process, with get_mongodb_client. It has no credentials (it ends up
+       in tasks sent to worker processes), they are added from config.'''
+    host, port = collection.database.client.address
+    return "mongodb://%s:%s" % (host, port)
+
+
+def get_mongodb_client(uri):
+    '''return a MongoClient connected to "uri" (from get_mongodb_uri),
+       authenticated as DATA_SERVER_USERNAME if set.'''
+    from pymongo import MongoClient
+    if DATA_SERVER_USERNAME:
+        credentials = quote_plus(DATA_SERVER_USERNAME)
+        if DATA_SERVER_PASSWORD:
+            credentials += ':' + quote_plus(DATA_SERVER_PASSWORD)
+        uri = uri.replace('mongodb://', 'mongodb://%s@' % credentials, 1) + '/admin'
+    return MongoClient(uri)
+
+
+def _doc_actions(doc, index_name, doc_type, routing_by_taxid, tee_indices):
+    '''yield ((tee index name or '', _id), action) to index "doc" into
+       "index_name", and into each of "tee_indices" ((name, taxids) pairs)
+       of its species.'''
+    doc.update({
+        "_index": index_name,
+        "_type": doc_type,
+    })
+    if routing_by_taxid and taxid_routing(doc):
+        doc['_routing'] = taxid_routing(doc)
+    yield ('', str(doc.get('_id'))), doc
+    for name, taxids in tee_indices:
+        if doc.get('taxid') in taxids:
+            yield (name, str(doc.get('_id'))), \
+                dict(doc, _index=name, _routing=taxid_routing(doc))
+
+
+def bulk_with_retries(conn, pending, index_name, controller=None, stats=None,
+                      max_attempts=ES_INDEXER_MAX_ATTEMPTS):
+    '''index "pending" actions (an OrderedDict as from _doc_actions) with
+       adaptive_bulk. Actions failing with a transient error (rejected, ES
+       node error or unreachable) are resent, only them, up to "max_attempts"
+       times in total. Return (# of docs indexed into "index_name", failures
+       of docs which could not be indexed, as for ESIndexer.dead_letter).
+    '''
+    controller = controller or BulkSizeController(conn=conn)
+    tee_names = set(name for name, _ in pending if name)
+    cnt = 0
+    dead = []
+    attempt = 0
+    while pending:
+        attempt += 1
+        done = set()
+        failed = {}
+        try:
+            for ok, item in adaptive_bulk(conn, pending.values(), controller, stats):
+                info = list(item.values())[0]
+                # main index may be an alias, tee ones are not
+                key = (info.get('_index') if info.get('_index') in tee_names else '',
+                       str(info.get('_id')))
+                if ok:
+                    done.add(key)
+                else:
+                    failed[key] = (info.get('status'), info.get('error'))
+        except TransportError as err:
+            # whole bulk request failed, docs not sent yet too
+            for key in pending:
+                if key not in done and key not in failed:
+                    failed[key] = (err.status_code, str(err))
+        cnt += len([key for key in done if not key[0]])
+        retry = OrderedDict()
+        for key, (status, error) in failed.items():
+            if key in pending and attempt < max_attempts and \
+               _is_transient_error(status):
+                retry[key] = pending[key]
+            else:
+                dead.append({'doc_id': key[1], 'index': key[0] or index_name,
+                             'status': status, 'error': error,
+                             'attempts': attempt})
+        pending = retry
+        if pending:
+            print("\tRetrying {} failed docs...".format(len(pending)))
+            controller.backoff()
+    return cnt, dead
+
+
+def _index_partition_worker(task):
+    '''index docs of one _id range of a MongoDB collection (in a worker
+       process, with its own MongoDB and ES connections), resending failed
+       docs as index_bulk. Failures are returned, to be dead-lettered.'''
+    id_range = {'$gte': task['lo']}
+    if task['hi'] is not None:
+        id_range['$lt'] = task['hi']
+    query = {'_id': id_range}
+    if task['query']:
+        query = {'$and': [task['query'], query]}
+    mongo_client = get_mongodb_client(task['mongo_uri'])
+    collection = mongo_client[task['db']][task['collection']]
+    es = get_es(task['es_host'])
+    tee_indices = [(name, set(taxids)) for name, taxids in task['tee_indices']]
+    controller = BulkSizeController(conn=es)
+    stats = BulkStats()
+    res = {'docs': 0, 'indexed': 0, 'failed': []}
+
+    def _get_docs():
+        cur = collection.find(query, no_cursor_timeout=True)
+        cur.batch_size(task['step'])
+        try:
+            for doc in cur:
+                res['docs'] += 1
+                yield doc
+        finally:
+            cur.close()
+
+    def _index(batch):
+        pending = OrderedDict(action for doc in batch
+                              for action in _doc_actions(doc, task['index_name'],
+                                                         task['doc_type'],
+                                                         task['routing_by_taxid'],
+                                                         tee_indices))
+        return bulk_with_retries(es, pending, task['index_name'], controller, stats,
+                                 task['max_attempts'])
+
+    def _collect(jobs):
+        for job in jobs:
+            indexed, dead = job.result()
+            res['indexed'] += indexed
+            res['failed'].extend(dead)
+
+    try:
+        # batches sent from "bulk_threads" threads, read from one cursor
+        with ThreadPoolExecutor(max_workers=task['bulk_threads']) as executor:
+            running = set()
+            for batch in iter_n(_get_docs(), task['step']):
+                running.add(executor.submit(_index, batch))
+                if len(running) >= task['bulk_threads']:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    _collect(finished)
+            _collect(running)
+    finally:
+        mongo_client.close()
+    return res
+
+
 class ESIndexer(object):
     def __init__(self, es_index_name=None, es_index_type=None, mapping=None,
                  es_host=None, step=5000):
         self.conn = get_es(es_host)
+        self.es_host = es_host
         self.ES_INDEX_NAME = es_index_name or ES_INDEX_NAME
         self.ES_INDEX_TYPE = es_index_type or ES_INDEX_TYPE
         # if self.ES_INDEX_NAME:
@@ -849,12 +1519,64 @@ class ESIndexer(object):
         # useful to continue indexing after an error.
         self.s = None
         self.use_parallel = False
+        # parallel mode: number of worker processes (None for # of CPUs),
+        # and size (in docs) of the _id range indexed by each task
+        self.num_processes = ES_INDEXER_PROCESSES
+        self.partition_size = ES_INDEXER_PARTITION_SIZE
+        # bulk requests are sized and paced by the controller (from ES
+        # response times and rejections), current rates are in bulk_stats
+        self.bulk_controller = BulkSizeController(conn=self.conn)
+        self.bulk_stats = BulkStats()
+        # index settings while building the index, and after
+        self.build_profile = ES_INDEX_BUILD_PROFILE
+        # other indices docs of some species are indexed into at the same
+        # time, routed by taxid, as (ESIndexer, set of taxids)
+        self.tee_indices = []
+        # docs of this index routed by taxid (tee indices always are): None
+        # to tell from the index mapping (see routing_by_taxid)
+        self._routing_by_taxid = None
+        self._routing_required = {}
+        # collection of docs failing indexing, None for the default one
+        self.dead_letter_collection = None
         self._mapping = mapping
 
     def _get_es_version(self):
         info = self.conn.info()
         return info['version']['number']
 
+    @property
+    def routing_by_taxid(self):
+        '''True if docs of this index are routed by taxid: as set, or if
+           "_routing" is required by the index mapping (set when routed, see
+           verify_mapping), or for an index not created yet,
+           ES_ROUTING_BY_TAXID.'''
+        if self._routing_by_taxid is not None:
+            return self._routing_by_taxid
+        required = self.routing_required()
+        return ES_ROUTING_BY_TAXID if required is None else required
+
+    @routing_by_taxid.setter
+    def routing_by_taxid(self, value):
+        self._routing_by_taxid = value
+
+    def routing_required(self, index_name=None):
+        '''True if index (or alias) "index_name" requires "_routing" for
+           its docs, None if it does not exist or has no mapping yet.'''
+        index_name = index_name or self.ES_INDEX_NAME
+        if index_name not in self._routing_required:
+            try:
+                res = self.conn.indices.get_mapping(index=index_name,
+                                                    doc_type=self.ES_INDEX_TYPE)
+            except NotFoundError:
+                return None
+            mappings = [m['mappings'][self.ES_INDEX_TYPE] for m in res.values()
+                        if self.ES_INDEX_TYPE in m.get('mappings', {})]
+            if not mappings:
+                return None
+            self._routing_required[index_name] = any(
+                m.get('_routing', {}).get('required', False) for m in mappings)
+        return self._routing_required[index_name]
+
     def check(self):
         '''print out ES server info for verification.'''
         # print "Servers:", self.conn.servers
@@ -883,6 +1605,84 @@ class ESIndexer(object):
     def exists_index(self, index):
         return self.conn.indices.exists(index)
 
+    def get_alias_indices(self, alias):
+        '''return the list of indices "alias" points to.'''
+        try:
+            return sorted(self.conn.indices.get_alias(name=alias).keys())
+        except NotFoundError:
+            return []
+
+    def swap_alias(self, alias, index=None):
+        '''point "alias" to "index" (default: ES_INDEX_NAME) instead of the
+           indices it points to now, in one atomic call. Previous indices
+           are kept (see rollback_alias), and returned.'''
+        conn = self.conn
+        index = index or self.ES_INDEX_NAME
+        if conn.indices.exists(alias) and not conn.indices.exists_alias(name=alias):
+            raise ValueError('"{}" is an index, not an alias. '.format(alias) +
+                             'Delete it (or reindex it) first.')
+        previous = [_index for _index in self.get_alias_indices(alias)
+                    if _index != index]
+        actions = [{"remove": {"index": _index, "alias": alias}}
+                   for _index in previous]
+        actions.append({"add": {"index": index, "alias": alias}})
+        conn.indices.update_aliases(body={"actions": actions})
+        return previous
+
+    def rollback_alias(self, alias):
+        '''point "alias" back to the index built before the one it points
+           to now (indices named as "<prefix>_<yyyymmdd>_<random>").
+           Return the index "alias" now points to.'''
+        current = self.get_alias_indices(alias)
+        if len(current) != 1 or not split_index_name(current[0]):
+            raise ValueError('Cannot roll back "{}" (points to {})'.format(
+                             alias, current))
+        prefix, timestamp = split_index_name(current[0])
+        previous = []
+        for index in self.conn.indices.get_aliases().keys():
+            _split = split_index_name(index)
+            if _split and _split[0] == prefix and (_split[1], index) < (timestamp, current[0]):
+                previous.append((_split[1], index))
+        if not previous:
+            raise ValueError('No index to roll "{}" back to.'.format(alias))
+        index = sorted(previous)[-1][1]
+        self.swap_alias(alias, index)
+        return index
+
+    def validate_index(self, collection, query=None, sample_size=100):
+        '''compare the index to the "collection" it was built from: total
+           counts, then "sample_size" random docs. Return True if they match.'''
+        self.conn.indices.refresh(self.ES_INDEX_NAME)
+        target_cnt = collection.find(query).count()
+        es_cnt = self.count()['count']
+        if target_cnt != es_cnt:
+            print("Error: {} docs in index, should be {}.".format(es_cnt, target_cnt))
+            return False
+        pipeline = [{"$sample": {"size": sample_size}}]
+        if query:
+            pipeline.insert(0, {"$match": query})
+        docs = list(collection.aggregate(pipeline))
+        # an ids query finds docs whatever their routing (unlike mget)
+        res = self.conn.search(index=self.ES_INDEX_NAME,
+                               doc_type=self.ES_INDEX_TYPE,
+                               body={'query': {'ids': {'values': [doc['_id'] for doc in docs]}},
+                                     'size': len(docs)})
+        es_docs = dict((hit['_id'], hit['_source']) for hit in res['hits']['hits'])
+        es_docs = [es_docs.get(str(doc['_id'])) for doc in docs]
+        mismatched = []
+        for doc, es_doc in zip(docs, es_docs):
+            # _timestamp is not part of indexed docs
+            doc.pop('_timestamp', None)
+            _id = doc.pop('_id')
+            if es_doc is None or es_doc != doc:
+                mismatched.append(_id)
+        if mismatched:
+            print("Error: {}/{} sample docs do not match: {}".format(
+                  len(mismatched), len(docs), mismatched))
+            return False
+        print("OK [{} docs, {} sample docs match]".format(es_cnt, len(docs)))
+        return True
+
     def delete_index_type(self, index_type, noconfirm=False):
         '''Delete all indexes for a given index_type.'''
         index_name = self.ES_INDEX_NAME
@@ -922,14 +1722,21 @@ class ESIndexer(object):
 
         if update_mapping:
             print("Updating mapping...", end='')
+            routing_by_taxid = self.routing_by_taxid
             if not empty_mapping:
                 print("\n\tRemoving existing mapping...", end='')
                 print(conn.indices.delete_mapping(
                     index=index_name, doc_type=doc_type))
             self.get_field_mapping()
+            body = self._mapping
+            if routing_by_taxid:
+                # writes without routing fail, instead of being sent to
+                # another shard than the doc
+                body = dict(body, _routing={'required': True})
             print(conn.indices.put_mapping(index=index_name,
                                            doc_type=doc_type,
-                                           body=self._mapping))
+                                           body=body))
+            self._routing_required.pop(index_name, None)
 
     def update_mapping_meta(self, meta):
         index_name = self.ES_INDEX_NAME
@@ -947,9 +1754,9 @@ class ESIndexer(object):
             raise ValueError(
                     'Input "meta" should have and only have "_meta" field.')
 
-    def count(self, query=None, index_type=None):
+    def count(self, query=None, index_type=None, index_name=None):
         conn = self.conn
-        index_name = self.ES_INDEX_NAME
+        index_name = index_name or self.ES_INDEX_NAME
         index_type = index_type or self.ES_INDEX_TYPE
         if query:
             if isinstance(query, dict) and 'query' in query:
@@ -974,13 +1781,21 @@ class ESIndexer(object):
         index_name = self.ES_INDEX_NAME
         index_type = self.ES_INDEX_TYPE
         step = step or self.step
+        routing_by_taxid = self.routing_by_taxid
         for i in range(0, len(ids), step):
             _ids = ids[i:i + step]
-            body = {'ids': _ids}
+            if routing_by_taxid:
+                # docs are not in the shard of their _id
+                routing = self.get_routing(_ids)
+                body = {'docs': [{'_id': _id, '_routing': routing[_id]} if _id in routing
+                                 else {'_id': _id} for _id in _ids]}
+            else:
+                body = {'ids': _ids}
             res = conn.mget(
                     body=body, index=index_name, doc_type=index_type, **kwargs)
             for doc in res['docs']:
-                if doc['found']:
+                # docs not found by get_routing have no routing, and fail
+                if doc.get('found'):
                     yield doc['_source']
                 else:
                     yield None
@@ -992,39 +1807,100 @@ class ESIndexer(object):
         return self.conn.index(
                 self.ES_INDEX_NAME, self.ES_INDEX_TYPE, doc, id=id)
 
-    def index_bulk(self, docs, step=None):
+    def index_bulk(self, docs, step=None, max_attempts=None):
+        '''index "docs" by batches of "step" docs, return (# of docs indexed,
+           # of docs failed). Docs failing with a transient error (rejected,
+           ES node error or unreachable) are resent, only them, up to
+           "max_attempts" times in total. Docs which still failed are
+           recorded in the dead-letter collection (see dead_letter).
+           Docs are also indexed into tee_indices (counts are of the main
+           index only).
+        '''
         index_name = self.ES_INDEX_NAME
         doc_type = self.ES_INDEX_TYPE
         step = step or self.step
+        max_attempts = max_attempts or ES_INDEXER_MAX_ATTEMPTS
+        self.bulk_stats = BulkStats()
 
-        def _get_bulk(doc):
-            doc.update({
-                "_index": index_name,
-                "_type": doc_type,
-            })
-            return doc
-        actions = (_get_bulk(doc) for doc in docs)
+        routing_by_taxid = self.routing_by_taxid
+        tee_indices = [(tee.ES_INDEX_NAME, taxids) for tee, taxids in self.tee_indices]
+
+        cnt = 0
+        failed_cnt = 0
+        for batch in iter_n(docs, step):
+            pending = OrderedDict(action for doc in batch
+                                  for action in _doc_actions(doc, index_name, doc_type,
+                                                             routing_by_taxid, tee_indices))
+            indexed, dead = bulk_with_retries(self.conn, pending, index_name,
+                                              self.bulk_controller, self.bulk_stats,
+                                              max_attempts)
+            cnt += indexed
+            if dead:
+                failed_cnt += len([x for x in dead if x['index'] == index_name])
+                self.dead_letter(dead)
+        return cnt, failed_cnt
+
+    def dead_letter(self, failures):
+        '''record docs which could not be indexed ("failures", as dicts with
+           "doc_id", "status", "error" and "attempts") in the dead-letter
+           collection: ES_INDEXER_DEAD_LETTER_COLLECTION in the target db,
+           unless "dead_letter_collection" is set.'''
+        collection = self.dead_letter_collection
+        if collection is None:
+            collection = get_target_db()[ES_INDEXER_DEAD_LETTER_COLLECTION]
+        timestamp = datetime.now()
+        records = []
+        for failure in failures:
+            record = {'index': self.ES_INDEX_NAME,
+                      'doc_type': self.ES_INDEX_TYPE,
+                      'timestamp': timestamp}
+            record.update(failure)
+            records.append(record)
+        print("Error: {} docs failed indexing, see \"{}\" collection.".format(
+              len(records), collection.name))
         try:
-            return helpers.bulk(self.conn, actions, chunk_size=step)
-        except helpers.BulkIndexError as e:
-            # try again...
-            print("Bulk error, try again...")
-            return self.index_bulk(docs,step)
-            ##return helpers.bulk(self.conn, actions, chunk_size=step)
-        except Exception as e:
-            print("Err...")
-            import pickle
-            pickle.dump(e,open("err","wb"))
+            collection.insert_many(records)
+        except Exception as err:
+            # do not lose failed ids if MongoDB is not available either
+            print("Error: cannot record failed docs: {}".format(err))
+            print('\t' + ', '.join([str(r['doc_id']) for r in records]))
 
     def add_docs(self, docs, step=None):
-        self.index_bulk(docs, step=step)
+        res = self.index_bulk(docs, step=step)
         self.conn.indices.flush()
         self.conn.indices.refresh()
+        return res
 
     def delete_doc(self, index_type, id):
         '''delete a doc from the index based on passed id.'''
         return self.conn.delete(self.ES_INDEX_NAME, index_type, id)
 
+    def get_routing(self, ids):
+        '''return a dict of _id -> routing value of docs with given ids
+           (only of docs with a custom routing, see routing_by_taxid).'''
+        res = self.conn.search(index=self.ES_INDEX_NAME,
+                               doc_type=self.ES_INDEX_TYPE,
+                               body={'query': {'ids': {'values': list(ids)}},
+                                     '_source': False, 'size': len(ids)})
+        return dict((hit['_id'], hit['_routing'])
+                    for hit in res['hits']['hits'] if '_routing' in hit)
+
+    def _with_routing(self, actions, step):
+        '''set "_routing" of "actions" on existing docs, when docs are
+           routed by taxid (otherwise they would be looked up in the shard
+           of their _id).'''
+        if not self.routing_by_taxid:
+            return actions
+
+        def _get_actions():
+            for batch in iter_n(actions, step):
+                routing = self.get_routing([action['_id'] for action in batch])
+                for action in batch:
+                    if action['_id'] in routing:
+                        action['_routing'] = routing[action['_id']]
+                    yield action
+        return _get_actions()
+
     def delete_docs(self, ids, step=None):
         index_name = self.ES_INDEX_NAME
         doc_type = self.ES_INDEX_TYPE
@@ -1038,7 +1914,7 @@ class ESIndexer(object):
                 "_id": _id
             }
             return doc
-        actions = (_get_bulk(_id) for _id in ids)
+        actions = self._with_routing((_get_bulk(_id) for _id in ids), step)
         return helpers.bulk(self.conn, actions, chunk_size=step,
                             stats_only=True, raise_on_error=False)
 
@@ -1083,7 +1959,8 @@ class ESIndexer(object):
                 "doc": doc
             }
             return doc
-        actions = (_get_bulk(doc) for doc in partial_docs)
+        actions = self._with_routing((_get_bulk(doc) for doc in partial_docs),
+                                     self.step)
         return helpers.bulk(self.conn, actions, chunk_size=self.step, **kwargs)
 
     def wait_till_all_shards_ready(self, timeout=None, interval=5):
@@ -1112,31 +1989,29 @@ class ESIndexer(object):
 
         self.verify_mapping(update_mapping=update_mapping)
         # update some settings for bulk indexing
-        body = {
-            "index": {
-                # disable refresh temporarily
-                "refresh_interval": "-1",
-                "auto_expand_replicas": "0-all",
-                # "number_of_replicas": 0,
-                #"refresh_interval": "30s",
-            }
-        }
-        conn.indices.put_settings(body, index_name)
+        conn.indices.put_settings(self.build_profile['bulk_settings'],
+                                  index_name)
+        for tee, _ in self.tee_indices:
+            # docs of tee indices are routed by taxid (required by mapping)
+            tee.routing_by_taxid = True
+            tee.verify_mapping(update_mapping=update_mapping)
+            tee.conn.indices.put_settings(tee.build_profile['bulk_settings'],
+                                          tee.ES_INDEX_NAME)
         try:
             print("Building index...")
             if self.use_parallel:
-                cnt = self._build_index_parallel(collection, verbose)
+                cnt = self._build_index_parallel(collection, verbose,
+                                                 query=query)
             else:
                 cnt = self._build_index_sequential(collection, verbose,
                                                    query=query, bulk=bulk)
         finally:
-            # restore some settings after bulk indexing is done.
-            body = {
-                "index": {
-                    "refresh_interval": "1s"              # default settings
-                }
-            }
-            conn.indices.put_settings(body, index_name)
+            # restore settings after bulk indexing is done.
+            conn.indices.put_settings(self.build_profile['settings'],
+                                      index_name)
+            for tee, _ in self.tee_indices:
+                tee.conn.indices.put_settings(tee.build_profile['settings'],
+                                              tee.ES_INDEX_NAME)
 
             try:
                 print("Flushing...", conn.indices.flush())
@@ -1153,32 +2028,84 @@ class ESIndexer(object):
             else:
                 print("\nWarning: total count of gene documents does not " +
                       "match [{}, should be {}]".format(es_cnt, target_cnt))
+            for tee, taxids in self.tee_indices:
+                print('Validating "{}"...'.format(tee.ES_INDEX_NAME), end='')
+                target_cnt = collection.find(tee_query(query, taxids)).count()
+                es_cnt = tee.count()['count']
+                if target_cnt == es_cnt:
+                    print("OK [total count={}]".format(target_cnt))
+                else:
+                    print("\nWarning: total count of gene documents does not " +
+                          "match [{}, should be {}]".format(es_cnt, target_cnt))
 
         if cnt:
             print('Done! - {} docs indexed.'.format(cnt))
-            print("Optimizing...", self.optimize())
+            self.finalize_index()
+            for tee, _ in self.tee_indices:
+                tee.finalize_index()
+
+    def finalize_index(self):
+        '''get a freshly built index ready to serve queries: merge its
+           segments, then add replicas (copying merged segments instead of
+           merging on each replica), and warm its caches up.'''
+        conn = self.conn
+        index_name = self.ES_INDEX_NAME
+        profile = self.build_profile
+        t0 = time.time()
+        print("Merging segments...", end='')
+        conn.indices.forcemerge(index_name,
+                                max_num_segments=profile['max_num_segments'],
+                                request_timeout=profile['timeout'])
+        print("done.[{}]".format(timesofar(t0)))
+        t0 = time.time()
+        print("Adding replicas...", end='')
+        conn.indices.put_settings(profile['replica_settings'], index_name)
+        res = conn.cluster.health(index_name, wait_for_status='green',
+                                  timeout='{}s'.format(profile['timeout']),
+                                  request_timeout=profile['timeout'])
+        if res.get('timed_out'):
+            print("\nWarning: index is not green yet [{}]".format(res['status']))
+        else:
+            print("done.[{}]".format(timesofar(t0)))
+        self.warmup()
+
+    def warmup(self, queries=None):
+        '''run "queries" (default: build profile "warmup_queries") on each
+           node, to load caches of all shard copies.'''
+        conn = self.conn
+        queries = self.build_profile['warmup_queries'] if queries is None else queries
+        if not queries:
+            return
+        t0 = time.time()
+        print("Warming up...", end='')
+        node_ids = list(conn.nodes.info(metric='name')['nodes'].keys())
+        for node_id in node_ids:
+            for query in queries:
+                try:
+                    conn.search(index=self.ES_INDEX_NAME,
+                                doc_type=self.ES_INDEX_TYPE, body=query,
+                                preference='_only_node:' + node_id)
+                except TransportError as err:
+                    print("\n\tWarning: warmup query failed: {}".format(err))
+        print("done.[{} queries on {} nodes, {}]".format(
+              len(queries), len(node_ids), timesofar(t0)))
 
     def _build_index_sequential(self, collection, verbose=False,
                                 query=None, bulk=True):
 
-        def rate_control(cnt, t):
-            delay = 0
-            if t > 90:
-                delay = 30
-            elif t > 60:
-                delay = 10
-            if delay:
-                print("\tPausing for {}s...".format(delay), end='')
-                time.sleep(delay)
-                print("done.")
+        def print_stats(cnt, t):
+            print("\t{} [bulk size: {:.1f} MB]".format(
+                  self.bulk_stats,
+                  self.bulk_controller.chunk_bytes / 1024. / 1024))
 
         src_docs = doc_feeder(collection, step=self.step, s=self.s,
-                              batch_callback=rate_control, query=query)
+                              batch_callback=print_stats if bulk else None,
+                              query=query)
         if bulk:
-            res = self.index_bulk(src_docs)
-            if len(res[1]) > 0:
-                print("Error: {} docs failed indexing.".format(len(res[1])))
-            return res[0]
+            cnt, failed_cnt = self.index_bulk(src_docs)
+            if failed_cnt:
+                print("Error: {} docs failed indexing.".format(failed_cnt))
+            return cnt
         else:
             cnt = 0
             for doc in src_docs:
@@ -1188,154 +2115,330 @@ class ESIndexer(object):
                     print(cnt, ':', doc['_id'])
             return cnt
 
-    def _build_index_parallel(self, collection, verbose=False):
-        raise NotImplementedError
-        from utils.parallel import (run_jobs_on_ipythoncluster,
-                                    collection_partition,
-                                    require)
-        kwargs_common = {'ES_HOST': ES_HOST,
-                         'ES_INDEX_NAME': self.ES_INDEX_NAME,
-                         'ES_INDEX_TYPE': self.ES_INDEX_TYPE,
-                         }
+    def _build_index_parallel(self, collection, verbose=False, query=None):
+        '''index "collection" split in _id ranges, by a pool of worker
+           processes each sending bulk requests from several threads.
+           Return the number of docs indexed, docs which could not be
+           (after retries) are dead-lettered. Raise a ValueError if some
+           docs read are neither.'''
+        print("\tPartitioning...", end='')
+        t0 = time.time()
+        ranges = id_range_partition(collection, query, self.partition_size)
+        print("done.[{} _id ranges, {}]".format(len(ranges), timesofar(t0)))
+        task_common = {'mongo_uri': get_mongodb_uri(collection),
+                       'db': collection.database.name,
+                       'collection': collection.name,
+                       'query': query,
+                       'es_host': self.es_host,
+                       'index_name': self.ES_INDEX_NAME,
+                       'doc_type': self.ES_INDEX_TYPE,
+                       'step': self.step,
+                       'bulk_threads': ES_INDEXER_BULK_THREADS,
+                       'max_attempts': ES_INDEXER_MAX_ATTEMPTS,
+                       'routing_by_taxid': self.routing_by_taxid,
+                       'tee_indices': [(tee.ES_INDEX_NAME, sorted(taxids))
+                                       for tee, taxids in self.tee_indices]}
+        task_common['tee_names'] = [name for name, _ in task_common['tee_indices']]
         task_list = []
-        for kwargs in collection_partition(collection, step=self.step):
-            kwargs.update(kwargs_common)
-            task_list.append(kwargs)
-
-        @require('pymongo', 'pyes')
-        def worker(kwargs):
-            import pymongo
-            import pyes
-            server = kwargs['server']
-            port = kwargs['port']
-            src_db = kwargs['src_db']
-            src_collection = kwargs['src_collection']
-            skip = kwargs['skip']
-            limit = kwargs['limit']
-
-            mongo_conn = pymongo.MongoClient(server, port)
-            src = mongo_conn[src_db]
-
-            ES_HOST = kwargs['ES_HOST']
-            ES_INDEX_NAME = kwargs['ES_INDEX_NAME']
-            ES_INDEX_TYPE = kwargs['ES_INDEX_TYPE'],
-
-            es_conn = pyes.ES(ES_HOST, default_indices=[ES_INDEX_NAME],
-                              timeout=120.0, max_retries=10)
-
-            cur = src[src_collection].find(skip=skip, limit=limit,
-                                           timeout=False)
-            cur.batch_size(1000)
-            cnt = 0
-            try:
-                for doc in cur:
-                    es_conn.index(doc, ES_INDEX_NAME, ES_INDEX_TYPE,
-                                  doc['_id'], bulk=True)
-                    cnt += 1
-            finally:
-                cur.close()
-            es_conn.indices.flush()   # this is important to avoid missing docs
-            es_conn.indices.refresh()
-            return cnt
+        for lo, hi in ranges:
+            task = dict(task_common, lo=lo, hi=hi)
+            task_list.append(task)
 
-        job_results = run_jobs_on_ipythoncluster(worker, task_list)
-        if job_results:
-            cnt = sum(job_results)
-            return cnt
+        docs_cnt = 0
+        cnt = 0
+        failed = []
+        t0 = time.time()
+        with ProcessPoolExecutor(max_workers=self.num_processes) as executor:
+            jobs = [executor.submit(_index_partition_worker, task)
+                    for task in task_list]
+            for i, job in enumerate(as_completed(jobs), 1):
+                res = job.result()
+                docs_cnt += res['docs']
+                cnt += res['indexed']
+                failed.extend(res['failed'])
+                if verbose or i % 10 == 0 or i == len(jobs):
+                    print("\t{}/{} ranges done, {} docs indexed [{}]".format(
+                          i, len(jobs), cnt, timesofar(t0)))
+
+        if failed:
+            self.dead_letter(failed)
+        failed_cnt = len([x for x in failed if x['index'] == self.ES_INDEX_NAME])
+        # every doc read is either indexed or dead-lettered (after retries)
+        if cnt + failed_cnt != docs_cnt:
+            raise ValueError("{} docs read from _id ranges, but {} indexed and {} failed.".format(
+                             docs_cnt, cnt, failed_cnt))
+        target_cnt = collection.find(query).count()
+        if docs_cnt != target_cnt:
+            print("Warning: {} docs read from _id ranges, should be {}.".format(
+                  docs_cnt, target_cnt))
+        if failed_cnt:
+            print("Warning: {} docs could not be indexed.".format(failed_cnt))
+        return cnt
 
     def doc_feeder(self, index_type=None, index_name=None, step=10000,
-                   verbose=True, query=None, scroll='10m', **kwargs):
+                   verbose=True, query=None, scroll='10m', slices=None,
+                   ordered=False, **kwargs):
+        '''yield all docs (ES hits) matching "query". Shards are scrolled
+           in parallel, "slices" at a time (default: all of them), in
+           threads. With "ordered", docs are yielded sorted by _id (all
+           shards are then scrolled at once, merging their sorted hits).
+        '''
         conn = self.conn
         index_name = index_name or self.ES_INDEX_NAME
         doc_type = index_type or self.ES_INDEX_TYPE
 
-        n = self.count(query=query)['count']
+        n = self.count(query={'query': query['query']}
+                       if query and 'query' in query else None,
+                       index_type=doc_type, index_name=index_name)['count']
+        shards = len(conn.search_shards(index=index_name)['shards'])
+        slices = shards if ordered else min(slices or shards, shards)
         cnt = 0
         t0 = time.time()
         if verbose:
-            print('\ttotal docs: {}'.format(n))
-
-        _kwargs = kwargs.copy()
-        _kwargs.update(dict(size=step, index=index_name, doc_type=doc_type))
-        res = helpers.scan(conn, query=query, scroll=scroll, **_kwargs)
-        t1 = time.time()
-        for doc in res:
-            if verbose and cnt % step == 0:
-                if cnt != 0:
-                    print('done.[%.1f%%,%s]' % (cnt*100./n, timesofar(t1)))
-                print('\t{}-{}...'.format(cnt+1, min(cnt+step, n)), end='')
-                t1 = time.time()
-            yield doc
-            cnt += 1
+            print('\ttotal docs: {} [{} shards, {} in parallel]'.format(
+                  n, shards, slices))
+
+        body = dict(query or {})
+        if ordered:
+            body['sort'] = [{'_uid': 'asc'}]
+        stop = threading.Event()
+        # one queue for all shards, or one per shard to merge sorted hits
+        queues = [Queue(maxsize=4) for _ in range(shards if ordered else 1)]
+
+        def _put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def _scan_shard(shard):
+            q = queues[shard if ordered else 0]
+            hits = helpers.scan(conn, query=body, scroll=scroll, size=step,
+                                index=index_name, doc_type=doc_type,
+                                preference='_shards:{}'.format(shard),
+                                preserve_order=ordered, **kwargs)
+            try:
+                batch = []
+                for hit in hits:
+                    batch.append(hit)
+                    if len(batch) >= step:
+                        if not _put(q, batch):
+                            return
+                        batch = []
+                if batch and not _put(q, batch):
+                    return
+                _put(q, None)
+            except Exception as err:
+                _put(q, err)
+            finally:
+                hits.close()
+
+        def _get_hits(q, remaining):
+            while remaining:
+                batch = q.get()
+                if batch is None:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    for hit in batch:
+                        yield hit
+
+        executor = ThreadPoolExecutor(max_workers=slices)
+        try:
+            for shard in range(shards):
+                executor.submit(_scan_shard, shard)
+            if ordered:
+                res = heapq.merge(*[_get_hits(q, 1) for q in queues],
+                                  key=lambda hit: hit['_id'])
+            else:
+                res = _get_hits(queues[0], shards)
+            t1 = time.time()
+            for doc in res:
+                if verbose and cnt % step == 0:
+                    if cnt != 0:
+                        print('done.[%.1f%%,%s]' % (cnt*100./n if n else 100., timesofar(t1)))
+                    print('\t{}-{}...'.format(cnt+1, min(cnt+step, n)), end='')
+                    t1 = time.time()
+                yield doc
+                cnt += 1
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
         if verbose:
-            print('done.[%.1f%%,%s]' % (cnt*100./n, timesofar(t1)))
-            print("Finished! [{}]".format(timesofar(t0)))
+            print('done.[%.1f%%,%s]' % (cnt*100./n if n else 100., timesofar(t1)))
+            print("Finished! [{} docs, {:.0f} docs/s, {}]".format(
+                  cnt, cnt / max(time.time() - t0, 1e-6), timesofar(t0)))
 
     def get_id_list(self, index_type=None, index_name=None, step=100000,
                     verbose=True):
         cur = self.doc_feeder(index_type=index_type, index_name=index_name,
-                              step=step, fields=[], verbose=verbose)
+                              step=step, query={'_source': False},
+                              verbose=verbose)
         id_li = [doc['_id'] for doc in cur]
         return id_li
 
+    def get_id_set(self, query=None, index_type=None, index_name=None,
+                   step=100000, verbose=True):
+        '''return ids of all docs matching "query" as an IDSet (using much
+           less memory than a list or set of str ids).'''
+        query = dict(query or {}, _source=False)
+        cur = self.doc_feeder(index_type=index_type, index_name=index_name,
+                              step=step, query=query, verbose=verbose)
+        return IDSet(doc['_id'] for doc in cur)
+
     def get_id_list_parallel(self, taxid_li, index_type=None, index_name=None,
-                             step=1000, verbose=True):
-        '''return a list of all doc ids in an index_type.'''
-        raise NotImplementedError
-        from utils.parallel import run_jobs_on_ipythoncluster
-
-        def _get_ids_worker(args):
-            from utils.es import ESIndexer
-            from pyes import MatchAllQuery
-            es_kwargs, start, step = args
-            q = MatchAllQuery().search()
-            q.sort = [{'entrezgene': 'asc'}, {'ensembl.gene': 'asc'}]
-            q.fields = []
-            q.start = start
-            q.size = step
-            esi = ESIndexer(**es_kwargs)
-            cnt = esi.count()['count']
-            res = esi.conn.search_raw(q)
-            assert res['hits']['total'] == cnt
-            return [doc['_id'] for doc in res['hits']['hits']]
-
-        def _get_ids_worker_by_taxid(args):
-            from utils.es import ESIndexer
-            from pyes import TermQuery
-            es_kwargs, taxid, step = args
-            q = TermQuery()
-            q.add('taxid', taxid)
-            q.fields = []
-            q.size = step
-            esi = ESIndexer(**es_kwargs)
-            res = esi.conn.search(q)
-            xli = [doc['_id'] for doc in res]
-            assert len(xli) == res.total
-            return xli
-
-        es_kwargs = {'es_index_name': self.ES_INDEX_NAME,
-                     'es_host': 'su02:9200'}
-        task_li = [(es_kwargs, taxid, step) for taxid in taxid_li]
-        # print task_li
-        job_results = run_jobs_on_ipythoncluster(
-                _get_ids_worker_by_taxid, task_li)
-        return job_results
+                             step=100000, verbose=True):
+        '''return a list of ids of all docs from "taxid_li" species (all
+           shards scrolled in parallel, see doc_feeder).'''
+        query = {'query': {'terms': {'taxid': list(taxid_li)}},
+                 '_source': False}
+        cur = self.doc_feeder(index_type=index_type, index_name=index_name,
+                              step=step, query=query, verbose=verbose)
+        return [doc['_id'] for doc in cur]
 
     def clone_index(self, src_index, target_index, target_es_host=None,
                     step=10000, scroll='10m', target_index_settings=None,
-                    number_of_shards=None):
+                    number_of_shards=None, slices=None, checkpoint=None):
         '''clone src_index to target_index on the same es_host, or another one given
            by target_es_host.
 
-           This method can now be replaced by helpers.reindex
+           Each shard of src_index is scrolled and bulk indexed into
+           target_index in its own thread ("slices" shards at a time,
+           default: all of them). target_index is created if needed, with
+           mappings and analysis settings of src_index, "number_of_shards"
+           and "target_index_settings" (e.g. {"index": {...}}) if given.
+           Shards copied are recorded in the "checkpoint" file (default:
+           clone_<src_index>_<target_index>.json), so an interrupted clone
+           resumes with the remaining shards. Return the # of docs copied.
         '''
+        conn = self.conn
+        target = ESIndexer(es_index_name=target_index,
+                           es_index_type=self.ES_INDEX_TYPE,
+                           es_host=target_es_host or self.es_host)
+        checkpoint = checkpoint or 'clone_{}_{}.json'.format(src_index, target_index)
+        done = {}
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as in_f:
+                done = {int(shard): cnt for shard, cnt in json.load(in_f).items()}
+            print("Resuming from \"{}\": {} shards already copied.".format(
+                  checkpoint, len(done)))
+
+        if not target.exists_index(target_index):
+            src_settings = list(conn.indices.get_settings(index=src_index).values())[0]
+            src_settings = src_settings['settings']['index']
+            settings = {'number_of_shards': number_of_shards or src_settings['number_of_shards']}
+            if 'analysis' in src_settings:
+                settings['analysis'] = src_settings['analysis']
+            body = {'settings': {'index': settings},
+                    'mappings': list(conn.indices.get_mapping(index=src_index).values())[0]['mappings']}
+            if target_index_settings:
+                body['settings'].update(target_index_settings)
+            print(target.conn.indices.create(index=target_index, body=body))
+        target.conn.indices.put_settings(target.build_profile['bulk_settings'],
+                                         target_index)
+
+        shards = len(conn.search_shards(index=src_index)['shards'])
+        todo = [shard for shard in range(shards) if shard not in done]
+        lock = threading.Lock()
+        stats = []
+
+        def _get_action(hit):
+            action = {'_index': target_index, '_type': hit['_type'],
+                      '_id': hit['_id'], '_source': hit['_source']}
+            # docs custom routing (by taxid) is kept
+            if '_routing' in hit:
+                action['_routing'] = hit['_routing']
+            return action
+
+        def _clone_shard(shard):
+            preference = '_shards:{}'.format(shard)
+            src_cnt = conn.count(index=src_index, doc_type=self.ES_INDEX_TYPE,
+                                 preference=preference)['count']
+            shard_stats = BulkStats()
+            with lock:
+                stats.append(shard_stats)
+            hits = helpers.scan(conn, scroll=scroll, size=step,
+                                index=src_index, doc_type=self.ES_INDEX_TYPE,
+                                preference=preference)
+            actions = (_get_action(hit) for hit in hits)
+            cnt = 0
+            controller = BulkSizeController(conn=target.conn)
+            for ok, item in adaptive_bulk(target.conn, actions, controller,
+                                          shard_stats):
+                cnt += ok
+            if cnt != src_cnt:
+                raise ValueError("Shard {}: {} docs copied, should be {}".format(
+                                 shard, cnt, src_cnt))
+            with lock:
+                done[shard] = cnt
+                tmp_fn = checkpoint + '.tmp'
+                with open(tmp_fn, 'w') as out_f:
+                    json.dump(done, out_f)
+                os.replace(tmp_fn, checkpoint)
+            return cnt
+
+        t0 = time.time()
+        print("Copying {} shards ({} in parallel)...".format(
+              len(todo), slices or len(todo)))
+        errors = []
+        with ThreadPoolExecutor(max_workers=slices or max(len(todo), 1)) as executor:
+            jobs = {executor.submit(_clone_shard, shard): shard for shard in todo}
+            pending = set(jobs)
+            while pending:
+                finished, pending = wait(pending, timeout=10)
+                for job in finished:
+                    if job.exception():
+                        errors.append((jobs[job], job.exception()))
+                docs = sum(_stats.docs for _stats in stats)
+                nbytes = sum(_stats.bytes for _stats in stats)
+                elapsed = max(time.time() - t0, 1e-6)
+                self.clone_stats = {'shards_done': len(done), 'shards': shards,
+                                    'docs': docs, 'docs_per_sec': docs / elapsed,
+                                    'bytes_per_sec': nbytes / elapsed}
+                print("\t{}/{} shards, {} docs [{:.0f} docs/s, {:.2f} MB/s, {}]".format(
+                      len(done), shards, docs, docs / elapsed,
+                      nbytes / elapsed / 1024 / 1024, timesofar(t0)))
+
+        target.conn.indices.put_settings(target.build_profile['settings'],
+                                         target_index)
+        if errors:
+            for shard, err in errors:
+                print("Error: shard {}: {}".format(shard, err))
+            print("Run again to resume from \"{}\".".format(checkpoint))
+            return
+        target.conn.indices.refresh(target_index)
+        src_cnt = conn.count(index=src_index, doc_type=self.ES_INDEX_TYPE)['count']
+        target_cnt = target.count()['count']
+        if src_cnt != target_cnt:
+            print("Warning: {} docs in \"{}\", should be {}.".format(
+                  target_cnt, target_index, src_cnt))
+        else:
+            print("OK [total count={}]".format(target_cnt))
+            os.remove(checkpoint)
+            target.finalize_index()
+        return sum(done.values())
+
+
+def split_index_name(index):
+    '''return (prefix, timestamp) of an index named as
+       "<prefix>_<yyyymmdd>_<random>", or None.'''
+    mat = re.match(r'(\w+)_(\d{8})_\w{8}$', index)
+    if mat:
+        return mat.groups()
 
 
 def es_clean_indices(keep_last=2, es_host=None, verbose=True, noconfirm=False,
                      dryrun=False):
-    '''clean up es indices, only keep last <keep_last> number of indices.'''
+    '''clean up es indices, only keep last <keep_last> number of indices
+       (so the previous one for ESIndexer.rollback_alias), and indices
+       an alias points to.'''
     conn = get_es(es_host)
-    index_li = list(conn.indices.get_aliases().keys())
+    aliases = conn.indices.get_aliases()
+    index_li = list(aliases.keys())
     if verbose:
         print("Found {} indices".format(len(index_li)))
 
@@ -1348,7 +2451,8 @@ def es_clean_indices(keep_last=2, es_host=None, verbose=True, noconfirm=False,
                 _li.append((mat.group(1), index))
         _li.sort()   # older collection appears first
         # keep last # of newer indices
-        index_to_remove = [x[1] for x in _li[:-keep_last]]
+        index_to_remove = [x[1] for x in _li[:-keep_last]
+                           if not aliases[x[1]].get('aliases')]
         if len(index_to_remove) > 0:
             print("{} \"{}*\" indices will be removed.".format(
                   len(index_to_remove), prefix))
@@ -1,64 +1,173 @@
+'''
+Non-blocking access to ES for the web API, as coroutines running on
+tornado's IOLoop (instead of blocking it during each ES round trip).
+'''
 import re
 import json
+import logging
+from urllib.parse import urlencode
 
-import tornado.web
-import tornado.httpclient
-tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-import tornadoes
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.locks import Semaphore
+from tornado.queues import Queue
+from tornado.ioloop import IOLoop
+from elasticsearch.exceptions import (TransportError, ConnectionError,
+                                      ConnectionTimeout)
 
-from utils.es import (ESQuery, ESQueryBuilder,
-                      MGQueryError, ElasticSearchException,
-                      ES_INDEX_NAME_ALL)
-from utils.dotfield import parse_dot_fields
-from config import ES_HOST
+from biothings.utils.dotfield import parse_dot_fields
+from utils.es import (ESQuery, ESQueryBuilder, QueryError, query_body,
+                      msearch_routing, source_stats)
+from utils.field_cost import source_excludes
+from utils.es_pool import get_node_stats, pick_node
+from config import (ES_HOST, ES_ASYNC_MAX_CLIENTS, ES_ASYNC_MAX_PER_HOST,
+                    ES_ASYNC_CONNECT_TIMEOUT, ES_ASYNC_REQUEST_TIMEOUT,
+                    EXPORT_SCROLL_SIZE, EXPORT_SCROLL_TIME,
+                    ES_SOURCE_DEFAULT_EXCLUDES)
+
+try:
+    # libcurl keeps connections to ES alive between requests
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as ESHTTPClient
+except ImportError:
+    logging.warning("pycurl is not installed, connections to ES will not be kept alive.")
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as ESHTTPClient
+
+
+class AsyncESClient(object):
+    '''A minimal non-blocking ES client. Requests are spread over ES nodes
+       (comma-separated in ES_HOST), routed away from slow or failing nodes
+       (see utils.es_pool), with at most "max_per_host" concurrent requests
+       per node, and "max_clients" in total.
+       Errors are raised as elasticsearch-py exceptions.
+    '''
+    def __init__(self, hosts=None, max_per_host=ES_ASYNC_MAX_PER_HOST,
+                 connect_timeout=ES_ASYNC_CONNECT_TIMEOUT,
+                 request_timeout=ES_ASYNC_REQUEST_TIMEOUT,
+                 max_clients=ES_ASYNC_MAX_CLIENTS):
+        hosts = hosts or ES_HOST
+        if isinstance(hosts, str):
+            hosts = hosts.split(',')
+        self.hosts = [h.strip().rstrip('/') if h.strip().startswith('http')
+                      else 'http://' + h.strip().rstrip('/') for h in hosts]
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self._semaphores = dict((h, Semaphore(max_per_host)) for h in self.hosts)
+        self.max_clients = max_clients
+        self._http_client = None
+
+    @property
+    def http_client(self):
+        '''HTTP client of this ES client only (other AsyncHTTPClients of
+           the process are left as configured), created on first request,
+           on the IOLoop running it.'''
+        if self._http_client is None:
+            self._http_client = ESHTTPClient(force_instance=True,
+                                             max_clients=self.max_clients)
+        return self._http_client
+
+    async def request(self, method, path, params=None, body=None):
+        host = pick_node(self.hosts)
+        node_stats = get_node_stats(host)
+        url = host + path
+        if params:
+            url += '?' + urlencode(params)
+        if body is not None and not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        req = HTTPRequest(url, method=method, body=body,
+                          headers={'Content-Type': 'application/json'},
+                          connect_timeout=self.connect_timeout,
+                          request_timeout=self.request_timeout,
+                          # DELETE with a body (clear scroll)
+                          allow_nonstandard_methods=True)
+        async with self._semaphores[host]:
+            t0 = node_stats.start()
+            try:
+                response = await self.http_client.fetch(req)
+                node_stats.done(t0)
+            except HTTPError as err:
+                # 599 is no response at all, other errors come from ES
+                # itself (e.g. a bad query) and the node is fine
+                node_stats.done(t0, failed=err.code == 599)
+                if err.code == 599:
+                    # no response: timeout or connection error
+                    if 'timeout' in str(err).lower():
+                        raise ConnectionTimeout('TIMEOUT', str(err), err)
+                    raise ConnectionError('N/A', str(err), err)
+                response = err.response
+                try:
+                    info = json.loads(response.body.decode())
+                except (AttributeError, ValueError):
+                    info = None
+                raise TransportError(err.code, str(err), info)
+            except OSError as err:
+                node_stats.done(t0, failed=True)
+                raise ConnectionError('N/A', str(err), err)
+        return json.loads(response.body.decode())
+
+    def _path(self, index, doc_type, endpoint):
+        return '/' + '/'.join([x for x in (index, doc_type, endpoint) if x])
+
+    async def search(self, index, doc_type, body, **params):
+        return await self.request('POST', self._path(index, doc_type, '_search'),
+                                  params=params, body=body)
+
+    async def msearch(self, index, doc_type, body, **params):
+        return await self.request('POST', self._path(index, doc_type, '_msearch'),
+                                  params=params, body=body)
+
+    async def scroll(self, scroll_id, scroll):
+        return await self.request('POST', '/_search/scroll',
+                                  body={'scroll_id': scroll_id, 'scroll': scroll})
+
+    async def clear_scroll(self, scroll_id):
+        return await self.request('DELETE', '/_search/scroll',
+                                  body={'scroll_id': [scroll_id]})
+
+    async def search_shards(self, index):
+        return await self.request('GET', self._path(index, None, '_search_shards'))
+
+    async def get_mapping(self, index, doc_type):
+        return await self.request('GET', self._path(index, '_mapping', doc_type))
 
 
 class ESQueryAsync(ESQuery):
-    es_connection = tornadoes.ESConnection(ES_HOST.split(':')[0])
-    es_connection.httprequest_kwargs = {'request_timeout': 120.}  # increase default timeout from 20 to 120s
-
-    def _search_async(self, q, species='all', callback=None):
-        self._set_index(species)
-        self.es_connection.search(callback=callback,
-                                  index=self._index,
-                                  type=self._doc_type,
-                                  source=q)
-
-    def _msearch_async(self, q, species='all', callback=None):
-        self._set_index(species)
-        path = '/'.join((self.es_connection.url, self._index, self._doc_type, '_msearch'))
-        request_http = tornadoes.HTTPRequest(path, method="POST", body=q,
-                                             **self.es_connection.httprequest_kwargs)
-        self.es_connection.client.fetch(request=request_http, callback=callback)
-        self._index = ES_INDEX_NAME_ALL     # reset self._index
-
-    def get_gene2(self, geneid, fields='all', **kwargs):
-        '''for /gene/<geneid>'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
+    '''Same as ESQuery, with get_gene, mget_gene, query and metadata
+       as coroutines, and export.'''
+    # shared by all instances, so that connection pool and per-node
+    # concurrency limits are per process.
+    es_client = AsyncESClient()
+
+    async def _search_async(self, q, species='all', **params):
+        routing = self._get_routing(species)
+        if routing:
+            params['routing'] = routing
+        res = await self.es_client.search(self._get_index(species),
+                                          self._doc_type, query_body(q),
+                                          **params)
+        if ES_SOURCE_DEFAULT_EXCLUDES:
+            source_stats.add_res(source_excludes(q), res)
+        return res
+
+    async def _msearch_async(self, q, species='all'):
+        routing = self._get_routing(species)
+        if routing:
+            q = msearch_routing(q, routing)
+        res = await self.es_client.msearch(self._get_index(species),
+                                           self._doc_type, q)
+        if ES_SOURCE_DEFAULT_EXCLUDES:
+            source_stats.add_res(source_excludes(q), res)
+        return res
 
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
+    async def get_gene(self, geneid, **kwargs):
+        '''for /gene/<geneid>'''
+        options = self._get_cleaned_annotation_options(kwargs)
+        qbdr = ESQueryBuilder(options=options, **options.kwargs)
         _q = qbdr.build_id_query(geneid, options.scopes)
         if options.rawquery:
-            if is_async:
-                callback(_q)
-                return
-            else:
-                return _q
-        if is_async:
-            def inner_callback(response):
-                res = json.loads(response.body)
-                if not options.raw:
-                    res = self._cleaned_res(res, empty=None, single_hit=True, dotfield=options.dotfield)
-                callback(res)
-            self._search_async(_q, species=options.kwargs['species'], callback=inner_callback)
-            return
-        else:
-            res = self._search(_q)
-            if not options.raw:
-                res = self._cleaned_res(res, empty=None, single_hit=True, dotfield=options.dotfield)
-            return res
+            return _q
+        res = await self._search_async(_q, species=options.kwargs['species'])
+        if not options.raw:
+            res = self._cleaned_res(res, empty=None, single_hit=True, options=options)
+        return res
 
     def _normalize_msearch_res(self, res, geneid_list, options):
         assert len(res) == len(geneid_list)
@@ -66,68 +175,65 @@ class ESQueryAsync(ESQuery):
         for i in range(len(res)):
             hits = res[i]
             qterm = geneid_list[i]
-            hits = self._cleaned_res(hits, empty=[], single_hit=False, dotfield=options.dotfield)
+            if 'error' in hits:
+                _res.append({u'query': qterm,
+                             u'error': True})
+                continue
+            hits = self._cleaned_res(hits, empty=[], single_hit=False, options=options)
             if len(hits) == 0:
                 _res.append({u'query': qterm,
                              u'notfound': True})
-            elif 'error' in hits:
-                _res.append({u'query': qterm,
-                             u'error': True})
             else:
                 for hit in hits:
                     hit[u'query'] = qterm
                     _res.append(hit)
         return _res
 
-    def mget_gene2(self, geneid_list, fields=None, **kwargs):
-        '''for /query post request'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
+    async def _mget_gene_by_terms(self, qbdr, geneid_list, options):
+        '''fast path of mget_gene for exact match scopes (entrezgene, symbol...),
+           return None if ids must be looked up one by one.'''
+        terms_q = qbdr.build_terms_id_query(geneid_list, options.scopes)
+        if not terms_q:
+            return
+        _q, id_keys = terms_q
+        try:
+            res = await self._msearch_async(_q, species=options.kwargs['species'])
+        except ConnectionTimeout:
+            return {'success': False,
+                    'error': 'timeout'}
+        res = qbdr.regroup_terms_id_res(id_keys, res['responses'])
+        if res is not None:
+            return self._normalize_msearch_res(res, geneid_list, options)
 
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
+    async def mget_gene(self, geneid_list, **kwargs):
+        '''for /gene and /query post requests'''
+        options = self._get_cleaned_annotation_options(kwargs)
+        qbdr = ESQueryBuilder(options=options, **options.kwargs)
+        if not (options.raw or options.rawquery):
+            res = await self._mget_gene_by_terms(qbdr, geneid_list, options)
+            if res is not None:
+                return res
         try:
             _q = qbdr.build_multiple_id_query(geneid_list, options.scopes)
-        except MGQueryError as err:
-            res = {'success': False,
-                   'error': err.message}
-            if is_async:
-                callback(res)
-                return
-            else:
-                return res
+        except QueryError as err:
+            return {'success': False,
+                    'error': str(err)}
         if options.rawquery:
-            if is_async:
-                callback(_q)
-                return
-            else:
-                return _q
-        if is_async:
-            def inner_callback(response):
-                if response.code == 599 and response.body is None:
-                    res = {'success': False,
-                           'error': 'timeout'}
-                else:
-                    res = json.loads(response.body)['responses']
-                    if not options.raw:
-                        res = self._normalize_msearch_res(res, geneid_list, options)
-                callback(res)
-            self._msearch_async(_q, species=kwargs['species'], callback=inner_callback)
-            return
-        else:
-            res = self._msearch(_q, kwargs['species'])['responses']
-            return res if options.raw else self._normalize_msearch_res(res, geneid_list, options)
+            return _q
+        try:
+            res = await self._msearch_async(_q, species=options.kwargs['species'])
+        except ConnectionTimeout:
+            return {'success': False,
+                    'error': 'timeout'}
+        res = res['responses']
+        return res if options.raw else self._normalize_msearch_res(res, geneid_list, options)
 
     @staticmethod
     def _normalize_query_res(res, options):
-        if "error" in res:
-            return {'success': False,
-                    'error': "invalid query term."}
-
         _res = res['hits']
         _res['took'] = res['took']
-        if "facets" in res:
-            _res['facets'] = res['facets']
+        if "aggregations" in res:
+            _res['facets'] = res['aggregations']
         for v in _res['hits']:
             del v['_type']
             del v['_index']
@@ -138,85 +244,115 @@ class ESQueryAsync(ESQuery):
                     break
             if not options.dotfield:
                 parse_dot_fields(v)
-        res = _res
-        return res
+        return _res
 
-    def query(self, q, fields=None, **kwargs):
+    async def query(self, q, **kwargs):
         '''for /query?q=<query>'''
-        callback = kwargs.pop('callback', None)
-        is_async = callback is not None
-
-        options = self._get_cleaned_query_options(fields, kwargs)
-        qbdr = ESQueryBuilder(**options.kwargs)
-        q = re.sub(u'[\t\n\x0b\x0c\r\x00]+', ' ', q)
-        q = q.strip()
-        _q = None
-        # Check if special interval query pattern exists
-        interval_query = self._parse_interval_query(q)
+        options = self._get_cleaned_query_options(kwargs)
+        q = re.sub(u'[\t\n\x0b\x0c\r\x00]+', ' ', q).strip()
         try:
-            if interval_query:
-                #should also passing a "taxid" along with interval.
-                if qbdr.species != 'all':
-                    qbdr.species = [qbdr.species[0]]
-                    _q = qbdr.build_genomic_pos_query(**interval_query)
-                else:
-                    res = {'success': False,
-                           'error': 'genomic interval query cannot be combined with "species=all" parameter. Specify a single species.'}
-                    if is_async:
-                        callback(res)
-                        return
-                    else:
-                        return res
-
-            # Check if fielded/boolean query, excluding special goid query
-            # raw_string_query should be checked ahead of wildcard query, as raw_string may contain wildcard as well
-            # e.g., a query "symbol:CDK?", should be treated as raw_string_query.
-            elif self._is_raw_string_query(q) and not q.lower().startswith('go:'):
-                _q = qbdr.build(q, mode=3)   # raw string query
-            elif self._is_wildcard_query(q):
-                _q = qbdr.build(q, mode=2)   # wildcard query
-            else:
-            # normal text query
-                _q = qbdr.build(q, mode=1)
-        except MGQueryError as err:
-            res = {'success': False,
-                   'error': err.message}
-            if is_async:
-                callback(res)
-                return
-            else:
-                return res
+            _q = self._build_query(q, **options.kwargs)
+        except QueryError as err:
+            return {'success': False,
+                    'error': str(err)}
+        if options.rawquery:
+            return _q
+        try:
+            res = await self._search_async(_q, species=options.kwargs['species'])
+        except TransportError as err:
+            err_msg = err.error if options.raw else "invalid query term."
+            return {'success': False,
+                    'error': err_msg}
+        return res if options.raw else self._normalize_query_res(res, options)
 
-        if _q:
-            if options.rawquery:
-                if is_async:
-                    callback(_q)
-                    return
-                else:
-                    return _q
-
-            if is_async:
-                def inner_callback(response):
-                    res = json.loads(response.body)
-                    if not options.raw:
-                        res = self._normalize_query_res(res, options)
-                    callback(res)
-                self._search_async(_q, species=kwargs['species'], callback=inner_callback)
-                return
-            else:
-                try:
-                    res = self._search(_q, species=kwargs['species'])
-                    if not options.raw:
-                        res = self._normalize_query_res(res, options)
-                except ElasticSearchException as err:
-                    err_msg = err.message if options.raw else "invalid query term."
-                    res = {'success': False,
-                           'error': err_msg}
-        else:
-            res = {'success': False, 'error': "Invalid query. Please check parameters."}
+    async def metadata(self, raw=False):
+        '''return metadata about the index.'''
+        mapping = await self.es_client.get_mapping(self._index, self._doc_type)
+        if raw:
+            return mapping
+        return self._format_metadata(mapping)
 
-        if is_async:
-            callback(res)
-            return
+    async def _scan_shard(self, index, body, shard, skip, queue, state):
+        '''scroll over all hits of "shard", putting (shard, hits) pages in
+           "queue", then (shard, None) or (shard, exception).
+           The first "skip" hits are dropped.
+        '''
+        scroll_id = None
+        try:
+            # always the primary copy, so that hits come in the same order
+            # (and can be skipped when resuming)
+            res = await self.es_client.search(
+                index, self._doc_type, body, scroll=EXPORT_SCROLL_TIME,
+                preference='_shards:{};_primary'.format(shard))
+            while not state['stopped']:
+                scroll_id = res.get('_scroll_id', scroll_id)
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+                if skip:
+                    skipped = min(skip, len(hits))
+                    hits = hits[skipped:]
+                    skip -= skipped
+                if hits:
+                    await queue.put((shard, hits))
+                res = await self.es_client.scroll(scroll_id, EXPORT_SCROLL_TIME)
+        except Exception as err:
+            await queue.put((shard, err))
         else:
-            return res
+            await queue.put((shard, None))
+        finally:
+            if scroll_id:
+                try:
+                    await self.es_client.clear_scroll(scroll_id)
+                except Exception:
+                    # expires anyway
+                    pass
+
+    async def export(self, q, sent=None, **kwargs):
+        '''for /export?q=<query>: an async generator of (shard, docs), with
+           all docs matching "q", one page at a time. Shards are scrolled
+           in parallel (ES 2.x has no sliced scroll).
+           "sent" is a dict of number of docs already exported per shard,
+           to resume an export.
+        '''
+        options = self._get_cleaned_query_options(kwargs)
+        q = re.sub(u'[\t\n\x0b\x0c\r\x00]+', ' ', q).strip()
+        _q = dict(self._build_query(q, **options.kwargs))
+        for key in ['from', 'size', 'sort', 'aggs', 'explain']:
+            _q.pop(key, None)
+        _q['size'] = EXPORT_SCROLL_SIZE     # per shard
+        _q['sort'] = ['_doc']
+        index = self._get_index(options.kwargs['species'])
+        shards = await self.es_client.search_shards(index)
+        sent = sent or {}
+        state = {'stopped': False}
+        queue = Queue(maxsize=len(shards['shards']))
+        running = 0
+        for shard in range(len(shards['shards'])):
+            IOLoop.current().spawn_callback(self._scan_shard, index, _q, shard,
+                                            sent.get(shard, 0), queue, state)
+            running += 1
+        try:
+            while running:
+                shard, hits = await queue.get()
+                if hits is None:
+                    running -= 1
+                    continue
+                if isinstance(hits, Exception):
+                    running -= 1
+                    raise hits
+                docs = []
+                for hit in hits:
+                    doc = hit.get('_source', {})
+                    doc['_id'] = hit['_id']
+                    if not options.dotfield:
+                        parse_dot_fields(doc)
+                    docs.append(doc)
+                yield shard, docs
+        finally:
+            # let the other shard scans stop and clear their scroll
+            state['stopped'] = True
+            while running:
+                shard, hits = await queue.get()
+                if hits is None or isinstance(hits, Exception):
+                    running -= 1
@@ -0,0 +1,193 @@
+'''
+Bulk indexing at the pace the ES cluster can take: bulk requests are sized
+in bytes, grown or shrunk depending on how long ES took to process the
+previous ones and on bulk thread pool rejections, and docs rejected because
+the bulk queue is full (HTTP 429) are resent after an exponential backoff.
+'''
+from __future__ import print_function
+import time
+import random
+import logging
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import TransportError
+
+from config import (ES_BULK_CHUNK_BYTES, ES_BULK_MIN_CHUNK_BYTES,
+                    ES_BULK_MAX_CHUNK_BYTES, ES_BULK_TARGET_TOOK,
+                    ES_BULK_MAX_BACKOFF, ES_BULK_MAX_RETRIES)
+
+
+class BulkSizeController(object):
+    '''Size (in bytes) of the next bulk request.
+
+       It grows while ES processes requests in less than half "target_took"
+       seconds, and shrinks when they take longer than "target_took", when
+       docs are rejected (429), or when the bulk thread pool of any node
+       rejected requests (from any client) since the last check.
+    '''
+    grow_factor = 1.25
+    shrink_factor = 0.5
+    # first backoff (in seconds), doubled on each consecutive rejection
+    base_backoff = 1.
+    # how often (in seconds) to check bulk thread pool rejections
+    thread_pool_check_interval = 10
+
+    def __init__(self, conn=None, chunk_bytes=ES_BULK_CHUNK_BYTES,
+                 min_bytes=ES_BULK_MIN_CHUNK_BYTES,
+                 max_bytes=ES_BULK_MAX_CHUNK_BYTES,
+                 target_took=ES_BULK_TARGET_TOOK,
+                 max_backoff=ES_BULK_MAX_BACKOFF):
+        self.conn = conn
+        self.chunk_bytes = chunk_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_took = target_took
+        self.max_backoff = max_backoff
+        self.rejections = 0
+        self._attempt = 0
+        self._pool_rejected = None
+        self._last_check = 0
+
+    def _resize(self, factor):
+        self.chunk_bytes = int(min(self.max_bytes,
+                                   max(self.min_bytes, self.chunk_bytes * factor)))
+
+    def update(self, took, rejected=False):
+        '''adjust chunk size after a bulk request taking "took" seconds
+           (in ES), "rejected" if some of its docs were rejected.'''
+        if rejected:
+            self.rejections += 1
+            self._attempt += 1
+            self._resize(self.shrink_factor)
+            return
+        self._attempt = 0
+        if self._thread_pool_rejected() or took > self.target_took:
+            self._resize(self.shrink_factor)
+        elif took < self.target_took / 2:
+            self._resize(self.grow_factor)
+
+    def _thread_pool_rejected(self):
+        '''True if bulk requests were rejected by any node since last check.'''
+        now = time.time()
+        if self.conn is None or now - self._last_check < self.thread_pool_check_interval:
+            return False
+        self._last_check = now
+        try:
+            res = self.conn.nodes.stats(metric='thread_pool')
+        except TransportError as err:
+            logging.warning("Cannot get ES thread pool stats: %s" % err)
+            return False
+        rejected = sum(node['thread_pool'].get('bulk', {}).get('rejected', 0)
+                       for node in res['nodes'].values())
+        last_rejected, self._pool_rejected = self._pool_rejected, rejected
+        return last_rejected is not None and rejected > last_rejected
+
+    def backoff(self):
+        '''wait before resending rejected docs: exponential, with jitter so
+           that concurrent indexers do not retry all at once.'''
+        delay = min(self.max_backoff,
+                    self.base_backoff * 2 ** max(0, self._attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        time.sleep(delay)
+        return delay
+
+
+class BulkStats(object):
+    '''Docs and bytes indexed so far, and indexing rates.'''
+    def __init__(self):
+        self.t0 = time.time()
+        self.docs = 0
+        self.bytes = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def add(self, docs, nbytes):
+        self.docs += docs
+        self.bytes += nbytes
+
+    def docs_per_sec(self):
+        return self.docs / max(time.time() - self.t0, 1e-6)
+
+    def bytes_per_sec(self):
+        return self.bytes / max(time.time() - self.t0, 1e-6)
+
+    def stats(self):
+        return {'docs': self.docs,
+                'bytes': self.bytes,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'docs_per_sec': round(self.docs_per_sec(), 1),
+                'bytes_per_sec': round(self.bytes_per_sec(), 1)}
+
+    def __str__(self):
+        return "{} docs indexed [{:.0f} docs/s, {:.2f} MB/s]".format(
+            self.docs, self.docs_per_sec(), self.bytes_per_sec() / 1024 / 1024)
+
+
+def adaptive_bulk(client, actions, controller=None, stats=None,
+                  max_retries=ES_BULK_MAX_RETRIES, **kwargs):
+    '''send "actions" (as for helpers.bulk) in bulk requests sized by
+       "controller" (a BulkSizeController), and yield (ok, item) for each
+       action (as helpers.streaming_bulk with raise_on_error=False).
+       Actions rejected with a 429 status are resent up to "max_retries"
+       times. "stats" (a BulkStats) is updated as docs get indexed.
+    '''
+    controller = controller or BulkSizeController(conn=client)
+    stats = stats or BulkStats()
+    serializer = client.transport.serializer
+    chunk = []
+    chunk_bytes = 0
+    for action in actions:
+        action, data = helpers.expand_action(action)
+        lines = [serializer.dumps(action)]
+        if data is not None:
+            lines.append(serializer.dumps(data))
+        nbytes = sum(len(line.encode('utf-8')) + 1 for line in lines)
+        if chunk and chunk_bytes + nbytes > controller.chunk_bytes:
+            for res in _send_chunk(client, chunk, controller, stats,
+                                   max_retries, **kwargs):
+                yield res
+            chunk = []
+            chunk_bytes = 0
+        chunk.append((lines, nbytes))
+        chunk_bytes += nbytes
+    if chunk:
+        for res in _send_chunk(client, chunk, controller, stats,
+                               max_retries, **kwargs):
+            yield res
+
+
+def _send_chunk(client, chunk, controller, stats, max_retries, **kwargs):
+    attempt = 0
+    while chunk:
+        body = '\n'.join([line for lines, _ in chunk for line in lines]) + '\n'
+        try:
+            resp = client.bulk(body, **kwargs)
+        except TransportError as err:
+            if err.status_code != 429 or attempt >= max_retries:
+                raise
+            # whole request rejected
+            controller.update(None, rejected=True)
+            stats.rejected += len(chunk)
+            attempt += 1
+            controller.backoff()
+            continue
+
+        rejected = []
+        for (lines, nbytes), item in zip(chunk, resp['items']):
+            op_type, info = item.popitem()
+            status = info.get('status', 500)
+            if status == 429 and attempt < max_retries:
+                rejected.append((lines, nbytes))
+            elif 200 <= status < 300:
+                stats.add(1, nbytes)
+                yield True, {op_type: info}
+            else:
+                stats.failed += 1
+                yield False, {op_type: info}
+        controller.update(resp.get('took', 0) / 1000., rejected=bool(rejected))
+        chunk = rejected
+        if rejected:
+            stats.rejected += len(rejected)
+            attempt += 1
+            controller.backoff()
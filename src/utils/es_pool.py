@@ -0,0 +1,154 @@
+'''
+One Elasticsearch client per process for the web API, with pooled
+keep-alive connections to each ES node, and node selection routing
+requests away from slow or failing nodes.
+'''
+import time
+import random
+import threading
+
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.connection_pool import ConnectionSelector
+from elasticsearch.exceptions import ConnectionError
+
+from config import (ES_HOST, ES_MAX_CONNECTIONS_PER_NODE, ES_SNIFF,
+                    ES_SNIFF_INTERVAL, ES_REQUEST_TIMEOUT)
+
+
+class NodeStats(object):
+    '''Latency (exponentially weighted moving average, in seconds) and
+       failures of requests to one ES node.'''
+    # weight of the last request in the average
+    alpha = 0.1
+    # a failure counts as a request this slow
+    failure_latency = 10.
+
+    def __init__(self, host):
+        self.host = host
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+        return time.time()
+
+    def done(self, t0, failed=False):
+        latency = self.failure_latency if failed else time.time() - t0
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if failed:
+                self.failures += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+
+    def score(self):
+        '''expected time to serve one more request, lower is better.'''
+        # unknown nodes are tried first
+        return (self.latency or 0.) * (1 + self.in_flight)
+
+    def stats(self):
+        return {'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+                'requests': self.requests,
+                'failures': self.failures,
+                'in_flight': self.in_flight}
+
+
+# host -> NodeStats, for all clients of this process
+_node_stats = {}
+_node_stats_lock = threading.Lock()
+
+
+def get_node_stats(host):
+    with _node_stats_lock:
+        if host not in _node_stats:
+            _node_stats[host] = NodeStats(host)
+        return _node_stats[host]
+
+
+# share of requests sent to a random node, so that latency of nodes
+# avoided so far keeps being measured
+EXPLORE_RATIO = 0.05
+
+
+def pick_node(nodes, key=lambda node: node):
+    '''pick one of "nodes" from two random ones ("power of two choices"),
+       the one with the best NodeStats score (of host "key(node)").'''
+    if len(nodes) == 1:
+        return nodes[0]
+    if random.random() < EXPLORE_RATIO:
+        return random.choice(nodes)
+    a, b = random.sample(nodes, 2)
+    if get_node_stats(key(b)).score() < get_node_stats(key(a)).score():
+        return b
+    return a
+
+
+class TimedConnection(Urllib3HttpConnection):
+    '''Urllib3HttpConnection recording NodeStats of its node.'''
+    def __init__(self, *args, **kwargs):
+        super(TimedConnection, self).__init__(*args, **kwargs)
+        self.node_stats = get_node_stats(self.host)
+
+    def perform_request(self, *args, **kwargs):
+        t0 = self.node_stats.start()
+        failed = False
+        try:
+            return super(TimedConnection, self).perform_request(*args, **kwargs)
+        except ConnectionError:
+            # other errors come from ES itself (e.g. 404), the node is fine
+            failed = True
+            raise
+        finally:
+            self.node_stats.done(t0, failed=failed)
+
+
+class LatencySelector(ConnectionSelector):
+    '''Select among live connections the one with lower latency of two
+       random ones (dead nodes are already excluded by the connection pool).'''
+    def select(self, connections):
+        return pick_node(connections, key=lambda conn: conn.host)
+
+
+_es = None
+_es_lock = threading.Lock()
+
+
+def get_es_client():
+    '''return the Elasticsearch client shared by this process.'''
+    global _es
+    with _es_lock:
+        if _es is None:
+            _es = Elasticsearch(
+                [h.strip() for h in ES_HOST.split(',')] if isinstance(ES_HOST, str) else ES_HOST,
+                connection_class=TimedConnection,
+                selector_class=LatencySelector,
+                maxsize=ES_MAX_CONNECTIONS_PER_NODE,
+                timeout=ES_REQUEST_TIMEOUT,
+                sniff_on_start=ES_SNIFF,
+                sniff_on_connection_fail=ES_SNIFF,
+                sniffer_timeout=ES_SNIFF_INTERVAL if ES_SNIFF else None,
+                retry_on_timeout=True)
+        return _es
+
+
+def es_nodes_status():
+    '''return health of ES nodes known by this process.'''
+    status = {}
+    if _es is not None:
+        pool = _es.transport.connection_pool
+        for conn in pool.connections:
+            status[conn.host] = {'alive': True}
+        for _, conn in pool.dead.queue:
+            status[conn.host] = {'alive': False,
+                                 'dead_count': pool.dead_count.get(conn, 0)}
+    with _node_stats_lock:
+        for host, stats in _node_stats.items():
+            status.setdefault(host, {}).update(stats.stats())
+    return status
@@ -0,0 +1,114 @@
+'''
+Cost of returning each top-level field of gene docs: the average size of
+its JSON in the docs of a build, and if it is indexed at all according to
+the mapping (e.g. "exons" or "reporter" are large, but only returned).
+Fields too costly to be returned by default can be excluded from "_source"
+(see ES_SOURCE_DEFAULT_EXCLUDES), and the bytes it saved are counted.
+'''
+import json
+import threading
+
+
+def _is_indexed(prop):
+    '''True if mapping property "prop" or any of its sub-fields is indexed.'''
+    if prop.get('enabled') is False:
+        return False
+    if 'properties' in prop:
+        return any(_is_indexed(p) for p in prop['properties'].values())
+    return prop.get('index') != 'no'
+
+
+def get_field_costs(mapping, docs):
+    '''return a dict of top-level field -> {"avg_bytes", "docs", "indexed"}
+       for fields of "mapping" (as from DataBuilder.get_mapping), "avg_bytes"
+       being the average size of the field JSON in "docs" having it (a
+       sample of the docs), and "docs" the % of docs having it.
+    '''
+    properties = mapping.get('properties', {})
+    nbytes = {}
+    count = {}
+    n = 0
+    for doc in docs:
+        n += 1
+        for field, value in doc.items():
+            if field not in properties:
+                continue
+            nbytes[field] = nbytes.get(field, 0) + \
+                len(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+            count[field] = count.get(field, 0) + 1
+    costs = {}
+    for field in properties:
+        costs[field] = {
+            'avg_bytes': round(nbytes[field] / count[field], 1) if field in count else 0,
+            'docs': round(100. * count.get(field, 0) / n, 2) if n else 0,
+            'indexed': _is_indexed(properties[field])
+        }
+    return costs
+
+
+def heavy_fields(field_costs, min_bytes=1024):
+    '''return fields not indexed with "avg_bytes" of at least "min_bytes",
+       the costliest first: candidates for ES_SOURCE_DEFAULT_EXCLUDES.'''
+    fields = [f for f, cost in field_costs.items()
+              if not cost['indexed'] and cost['avg_bytes'] >= min_bytes]
+    return sorted(fields, key=lambda f: -field_costs[f]['avg_bytes'])
+
+
+def source_excludes(body):
+    '''return fields excluded from "_source" by query "body" (a dict, or
+       a msearch body with the same options in all queries).'''
+    if isinstance(body, dict):
+        _source = body.get('_source')
+    else:
+        lines = body.split('\n') if isinstance(body, str) else list(body)
+        if len(lines) < 2:
+            return []
+        query = lines[1]
+        if isinstance(query, str):
+            if '"exclude"' not in query:
+                return []
+            query = json.loads(query)
+        _source = query.get('_source')
+    if isinstance(_source, dict):
+        return _source.get('exclude') or []
+    return []
+
+
+class SourceStats(object):
+    '''Hits returned without the fields excluded by default, and bytes
+       saved (estimated from field costs).'''
+    def __init__(self):
+        self.hits = 0
+        self.queries = 0
+        self.excluded = {}
+        self._lock = threading.Lock()
+
+    def add(self, excludes, hits):
+        '''record "hits" (a number) returned without fields "excludes".'''
+        with self._lock:
+            self.queries += 1
+            self.hits += hits
+            for field in excludes:
+                self.excluded[field] = self.excluded.get(field, 0) + hits
+
+    def add_res(self, excludes, res):
+        '''record hits of ES response "res" (search or msearch).'''
+        if not excludes:
+            return
+        responses = res.get('responses', [res])
+        self.add(excludes, sum(len(r.get('hits', {}).get('hits', []))
+                               for r in responses))
+
+    def stats(self, field_costs=None):
+        '''return counters, with bytes saved if "field_costs" (see
+           get_field_costs) are given.'''
+        with self._lock:
+            _stats = {'queries': self.queries,
+                      'hits': self.hits,
+                      'excluded': dict(self.excluded)}
+        if field_costs is not None:
+            # field costs are averages over docs having the field
+            _stats['bytes_saved'] = int(sum(
+                cnt * field_costs[f]['avg_bytes'] * field_costs[f]['docs'] / 100.
+                for f, cnt in _stats['excluded'].items() if f in field_costs))
+        return _stats
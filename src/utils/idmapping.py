@@ -0,0 +1,247 @@
+'''
+Compact, read-only id mappings (e.g. retired -> current Entrez gene ids,
+Ensembl -> Entrez gene ids) stored in a file and memory-mapped, instead of
+pickled dicts: opening one costs nothing whatever its size, and its pages
+are shared by all processes using it (e.g. forked merge workers).
+
+Keys (int or str) are sorted, int keys in an array of int64, str keys in
+one bytes buffer with an array of offsets, and looked up by binary search.
+Values are int64, one or more per key.
+'''
+import os
+import json
+import mmap
+import struct
+import datetime
+from array import array
+from bisect import bisect_left
+
+_MAGIC = b'MGIDMAP1'
+_ITEMSIZE = 8
+
+
+def _padding(n):
+    return b' ' * (-n % _ITEMSIZE)
+
+
+def write_idmapping(filename, items, meta=None):
+    '''write (key, value) pairs of "items" as an id mapping file, keys
+       being int or str, values int (a key may come with several values,
+       in several pairs). "meta" is any JSON-serializable data, available
+       as IDMapping.meta. The file is written atomically.
+    '''
+    int_items = []
+    str_items = []
+    for key, value in items:
+        if isinstance(key, int):
+            int_items.append((key, int(value)))
+        else:
+            str_items.append((key.encode('utf-8'), int(value)))
+    # stable sorts: values of a key keep their order
+    int_items.sort(key=lambda x: x[0])
+    str_items.sort(key=lambda x: x[0])
+
+    int_keys = array('q')
+    str_offsets = array('q', [0])
+    str_keys = []
+    value_offsets = array('q', [0])
+    values = array('q')
+    last = None
+    for i, (key, value) in enumerate(int_items):
+        if i == 0 or key != last:
+            if i > 0:
+                value_offsets.append(len(values))
+            int_keys.append(key)
+            last = key
+        values.append(value)
+    if int_items:
+        value_offsets.append(len(values))
+    for i, (key, value) in enumerate(str_items):
+        if i == 0 or key != last:
+            if i > 0:
+                value_offsets.append(len(values))
+            str_keys.append(key)
+            str_offsets.append(str_offsets[-1] + len(key))
+            last = key
+        values.append(value)
+    if str_items:
+        value_offsets.append(len(values))
+    str_keys = b''.join(str_keys)
+
+    header = json.dumps({'n_int': len(int_keys),
+                         'n_str': len(str_offsets) - 1,
+                         'n_values': len(values),
+                         'str_bytes': len(str_keys),
+                         'meta': meta}).encode('utf-8')
+    header += _padding(len(header))
+    tmp_fn = filename + '.tmp'
+    with open(tmp_fn, 'wb') as out_f:
+        out_f.write(_MAGIC)
+        out_f.write(struct.pack('<q', len(header)))
+        out_f.write(header)
+        for a in (int_keys, str_offsets, value_offsets, values):
+            a.tofile(out_f)
+        out_f.write(str_keys)
+    os.replace(tmp_fn, filename)
+    return filename
+
+
+class IDMapping(object):
+    '''Read-only, dict-like id mapping from a file written by
+       write_idmapping. get/[] return the value of a key, or the list of its
+       values if it has several (as list2dict does).
+       Pickled, it becomes a plain dict.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as in_f:
+            if in_f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('"{}" is not an id mapping file.'.format(filename))
+            self._mm = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = len(_MAGIC)
+        header_len = struct.unpack('<q', self._mm[offset:offset + 8])[0]
+        offset += 8
+        header = json.loads(self._mm[offset:offset + header_len].decode('utf-8'))
+        offset += header_len
+        self.meta = header['meta']
+        self._n_int = header['n_int']
+        self._n_str = header['n_str']
+        mv = memoryview(self._mm)
+
+        def _section(n):
+            nonlocal offset
+            section = mv[offset:offset + n * _ITEMSIZE].cast('q')
+            offset += n * _ITEMSIZE
+            return section
+        self._int_keys = _section(self._n_int)
+        self._str_offsets = _section(self._n_str + 1)
+        self._value_offsets = _section(self._n_int + self._n_str + 1)
+        self._values = _section(header['n_values'])
+        self._str_start = offset
+
+    def _str_at(self, i):
+        start = self._str_start
+        return self._mm[start + self._str_offsets[i]:start + self._str_offsets[i + 1]]
+
+    def _index(self, key):
+        '''return the index of "key" (int keys first, then str keys), or -1.'''
+        if isinstance(key, int):
+            i = bisect_left(self._int_keys, key)
+            return i if i < self._n_int and self._int_keys[i] == key else -1
+        if not isinstance(key, str):
+            return -1
+        key = key.encode('utf-8')
+        lo, hi = 0, self._n_str
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._str_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self._n_int + lo if lo < self._n_str and self._str_at(lo) == key else -1
+
+    def _value(self, i):
+        start, end = self._value_offsets[i], self._value_offsets[i + 1]
+        if end - start == 1:
+            return self._values[start]
+        return list(self._values[start:end])
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        return default if i < 0 else self._value(i)
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._value(i)
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def __len__(self):
+        return self._n_int + self._n_str
+
+    def keys(self):
+        for key in self._int_keys:
+            yield key
+        for i in range(self._n_str):
+            yield self._str_at(i).decode('utf-8')
+
+    __iter__ = keys
+
+    def items(self):
+        for i, key in enumerate(self.keys()):
+            yield key, self._value(i)
+
+    def __reduce__(self):
+        return (dict, (list(self.items()),))
+
+    def close(self):
+        self._int_keys = self._str_offsets = self._value_offsets = self._values = None
+        self._mm.close()
+
+    def __repr__(self):
+        return '<IDMapping "{}" of {} keys>'.format(self.filename, len(self))
+
+
+def _gridfs_cache_key(fobj):
+    return '{}_{}'.format(fobj.upload_date.strftime('%Y%m%d%H%M%S'), fobj.length)
+
+
+def dump_idmapping2gridfs(items, filename, db, meta=None):
+    '''write (key, value) "items" as id mapping file "filename" in MongoDB
+       gridfs (as is, to be memory-mapped once copied, see load_idmapping).'''
+    import gridfs
+    import tempfile
+    print('Dumping into "MongoDB:%s/%s"...' % (db.name, filename), end='')
+    fs = gridfs.GridFS(db)
+    fd, tmp_fn = tempfile.mkstemp(suffix='.idmap')
+    os.close(fd)
+    try:
+        write_idmapping(tmp_fn, items, meta=meta)
+        if fs.exists(_id=filename):
+            fs.delete(filename)
+        with open(tmp_fn, 'rb') as in_f:
+            fs.put(in_f, filename=filename, _id=filename)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+    print('Done. [%s]' % fs.get(filename).length)
+
+
+def load_idmapping(db, filename, folder, fallback=None):
+    '''return the IDMapping of gridfs file "filename" of MongoDB "db", copied
+       into local "folder" unless already there (same upload). If the file is
+       not in gridfs, "fallback" (name of a pickled dict, or list of (key,
+       value), in gridfs, as from utils.common.dump2gridfs) is loaded once
+       and converted.
+    '''
+    import gridfs
+    from utils.common import loadobj
+    fs = gridfs.GridFS(db)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if fs.exists(_id=filename):
+        fobj = fs.get(filename)
+        local_fn = os.path.join(folder, '{}_{}'.format(_gridfs_cache_key(fobj), filename))
+        if not os.path.exists(local_fn):
+            tmp_fn = local_fn + '.tmp'
+            with open(tmp_fn, 'wb') as out_f:
+                for chunk in fobj:
+                    out_f.write(chunk)
+            os.replace(tmp_fn, local_fn)
+        return IDMapping(local_fn)
+    if fallback is None:
+        raise ValueError('"{}" not found in "{}" gridfs.'.format(filename, db.name))
+    fobj = fs.get(fallback)
+    local_fn = os.path.join(folder, '{}_{}.idmap'.format(_gridfs_cache_key(fobj), fallback))
+    if not os.path.exists(local_fn):
+        obj = loadobj((fallback, db), mode='gridfs')
+        if isinstance(obj, dict):
+            obj = ((k, v) for k, _v in obj.items() for v in
+                   (_v if isinstance(_v, (list, tuple)) else [_v]))
+        write_idmapping(local_fn, obj,
+                        meta={'source': fallback,
+                              'created': datetime.datetime.now().isoformat()})
+    return IDMapping(local_fn)
@@ -0,0 +1,99 @@
+'''
+Compact set of doc ids, to hold all ids of an index (tens of millions)
+in a fraction of the memory of a Python set or list of str.
+'''
+from array import array
+from bisect import bisect_left
+
+# max. number of digits of ids stored as integers (fitting in an int64)
+_MAX_INT_DIGITS = 18
+
+
+def _is_int_id(_id):
+    # "1017" but not "01017", which would not be the same id once an int
+    return _id.isdigit() and len(_id) <= _MAX_INT_DIGITS and \
+        (_id[0] != '0' or _id == '0')
+
+
+def _unique(sorted_values):
+    last = None
+    for i, value in enumerate(sorted_values):
+        if i == 0 or value != last:
+            yield value
+        last = value
+
+
+class IDSet(object):
+    '''Immutable set of str ids: integer-like ids ("1017") are kept in a
+       sorted array of int64, others ("ENSG00000123456") sorted in one
+       bytes buffer with an array of offsets. Lookups are binary searches.
+    '''
+    def __init__(self, ids=()):
+        int_ids = array('q')
+        str_ids = []
+        for _id in ids:
+            _id = str(_id)
+            if _is_int_id(_id):
+                int_ids.append(int(_id))
+            else:
+                str_ids.append(_id.encode('utf-8'))
+        self._ints = array('q', _unique(sorted(int_ids)))
+        str_ids = list(_unique(sorted(str_ids)))
+        self._offsets = array('q', [0])
+        for _id in str_ids:
+            self._offsets.append(self._offsets[-1] + len(_id))
+        self._strs = b''.join(str_ids)
+
+    def _str_at(self, i):
+        return self._strs[self._offsets[i]:self._offsets[i + 1]]
+
+    def __len__(self):
+        return len(self._ints) + len(self._offsets) - 1
+
+    def __contains__(self, _id):
+        _id = str(_id)
+        if _is_int_id(_id):
+            n = int(_id)
+            i = bisect_left(self._ints, n)
+            return i < len(self._ints) and self._ints[i] == n
+        _id = _id.encode('utf-8')
+        lo, hi = 0, len(self._offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._str_at(mid) < _id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(self._offsets) - 1 and self._str_at(lo) == _id
+
+    def __iter__(self):
+        for n in self._ints:
+            yield str(n)
+        for i in range(len(self._offsets) - 1):
+            yield self._str_at(i).decode('utf-8')
+
+    def __eq__(self, other):
+        if not isinstance(other, IDSet):
+            other = IDSet(other)
+        return self._ints == other._ints and self._strs == other._strs and \
+            self._offsets == other._offsets
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __sub__(self, other):
+        return IDSet(_id for _id in self if _id not in other)
+
+    def __and__(self, other):
+        return IDSet(_id for _id in self if _id in other)
+
+    def __or__(self, other):
+        return IDSet(list(self) + list(other))
+
+    def nbytes(self):
+        '''memory used by ids, in bytes.'''
+        return (self._ints.itemsize * len(self._ints) +
+                self._offsets.itemsize * len(self._offsets) + len(self._strs))
+
+    def __repr__(self):
+        return '<IDSet of {} ids>'.format(len(self))
@@ -0,0 +1,146 @@
+'''
+In-process index of gene genomic positions, to answer "chr:start-end"
+interval queries without a nested range query on ES.
+'''
+import time
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+# genomic_pos_* fields indexed, one per supported assembly
+GENOMIC_POS_FIELDS = ['genomic_pos', 'genomic_pos_hg19', 'genomic_pos_mm9']
+
+
+class GenomicIntervalIndex(object):
+    '''Intervals of each (genomic_pos field, taxid, chr), as arrays sorted
+       by start position. An interval query is two binary searches: genes
+       overlapping [gstart, gend] start between "gstart - longest gene"
+       and "gend", then only those candidates' end positions are checked.
+    '''
+    def __init__(self, taxids):
+        self.taxids = set(taxids)
+        # (field, taxid, chr) -> (starts, ends, ids, max. length)
+        self._intervals = {}
+        self.size = 0
+
+    @classmethod
+    def from_docs(cls, docs, taxids, fields=GENOMIC_POS_FIELDS):
+        '''build an index from "docs", having "_id", "taxid" and
+           "fields" (a dict or a list of dicts with "chr", "start" and "end").
+        '''
+        intervals = {}
+        for doc in docs:
+            for field in fields:
+                positions = doc.get(field)
+                if not positions:
+                    continue
+                if isinstance(positions, dict):
+                    positions = [positions]
+                for pos in positions:
+                    try:
+                        key = (field, int(doc['taxid']), str(pos['chr']).lower())
+                        interval = (int(pos['start']), int(pos['end']), doc['_id'])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    intervals.setdefault(key, []).append(interval)
+        index = cls(taxids)
+        for key, _intervals in intervals.items():
+            _intervals.sort()
+            index._intervals[key] = (
+                array('l', [x[0] for x in _intervals]),
+                array('l', [x[1] for x in _intervals]),
+                [x[2] for x in _intervals],
+                max(end - start for (start, end, _) in _intervals))
+            index.size += len(_intervals)
+        return index
+
+    def search(self, field, taxid, chr, gstart, gend):
+        '''return the list of _ids of genes overlapping [gstart, gend],
+           or None if "taxid" is not indexed.
+        '''
+        if taxid not in self.taxids:
+            return
+        entry = self._intervals.get((field, taxid, chr.lower()))
+        if entry is None:
+            return []
+        starts, ends, ids, max_len = entry
+        lo = bisect_left(starts, gstart - max_len)
+        hi = bisect_right(starts, gend)
+        _ids = []
+        seen = set()
+        for i in range(lo, hi):
+            if ends[i] >= gstart and ids[i] not in seen:
+                seen.add(ids[i])
+                _ids.append(ids[i])
+        return _ids
+
+    def stats(self):
+        return {'taxids': sorted(self.taxids),
+                'chromosomes': len(self._intervals),
+                'intervals': self.size}
+
+
+class GenomicIntervalIndexLoader(object):
+    '''Keep a GenomicIntervalIndex of genes from "taxids" up to date.
+
+       "feeder(taxids)" returns the docs to index, "index_version()" the
+       version of the ES index(es) they come from. Versions are checked
+       (at most once every "check_interval" seconds, on searches) and the
+       index is rebuilt when it changes, in a background thread. Until the
+       first build is done, search returns None (i.e. query ES instead).
+    '''
+    def __init__(self, taxids, feeder, index_version, check_interval=60):
+        self.taxids = taxids
+        self.feeder = feeder
+        self.index_version = index_version
+        self.check_interval = check_interval
+        self.index = None
+        self.builds = 0
+        self._version = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def maybe_refresh(self):
+        '''rebuild the index in background if ES index(es) changed.'''
+        now = time.time()
+        with self._lock:
+            if self._refreshing or now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            self._refreshing = True
+        self._executor.submit(self._refresh)
+
+    def _refresh(self):
+        try:
+            version = self.index_version()
+            if version != self._version:
+                t0 = time.time()
+                index = GenomicIntervalIndex.from_docs(self.feeder(self.taxids),
+                                                       self.taxids)
+                self.index = index
+                self._version = version
+                self.builds += 1
+                logging.info("Genomic interval index built: %s intervals in %.1fs" %
+                             (index.size, time.time() - t0))
+        except Exception as err:
+            logging.error("Cannot build genomic interval index: %s" % err)
+        finally:
+            self._refreshing = False
+
+    def search(self, field, taxid, chr, gstart, gend):
+        self.maybe_refresh()
+        index = self.index
+        if index is None:
+            return
+        return index.search(field, taxid, chr, gstart, gend)
+
+    def stats(self):
+        _stats = {'builds': self.builds,
+                  'index_version': self._version}
+        if self.index:
+            _stats.update(self.index.stats())
+        return _stats
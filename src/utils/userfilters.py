@@ -1,3 +1,9 @@
+import json
+import time
+import logging
+import threading
+
+from elasticsearch import helpers
 from elasticsearch.exceptions import NotFoundError
 
 from biothings.settings import BiothingSettings
@@ -5,8 +11,8 @@ from biothings.utils.es import get_es
 biothing_settings = BiothingSettings()
 
 class UserFilters(object):
-    def __init__(self):
-        self.conn = get_es(biothing_settings.es_host) 
+    def __init__(self, conn=None):
+        self.conn = conn or get_es(biothing_settings.es_host)
         self.ES_INDEX_NAME = 'userfilters'
         self.ES_DOC_TYPE = 'filter'
         self._MAPPING = {
@@ -49,16 +55,34 @@ class UserFilters(object):
             return None
 
     def count(self):
-        n = self.conn.count(None, self.ES_INDEX_NAME, self.ES_DOC_TYPE)['count']
+        n = self.conn.count(index=self.ES_INDEX_NAME, doc_type=self.ES_DOC_TYPE)['count']
         return n
 
-    def get_all(self, skip=0, size=1000):
+    def get_all(self, skip=0, size=1000, verbose=True):
         '''get all named filter.'''
-        print('\ttotal filters: {}'.format(self.count()))
+        if verbose:
+            print('\ttotal filters: {}'.format(self.count()))
+        q = {"query": {"match_all": {}}}
+        res = self.conn.search(index=self.ES_INDEX_NAME, doc_type=self.ES_DOC_TYPE,
+                               body=q, from_=skip, size=size)
+        return [hit['_source'] for hit in res['hits']['hits']]
+
+    def _scan(self, **kwargs):
+        '''all named filters (as ES hits), however many there are.'''
         q = {"query": {"match_all": {}}}
-        res = self.conn.search_raw(q, indices=self.ES_INDEX_NAME, doc_types=self.ES_DOC_TYPE,
-                                   **{"from": str(skip), "size": str(1000)})
-        return [hit['_source'] for hit in res.hits.hits]
+        return helpers.scan(self.conn, query=q, index=self.ES_INDEX_NAME,
+                            doc_type=self.ES_DOC_TYPE, **kwargs)
+
+    def get_all_named(self):
+        '''return (name, filter doc) of all named filters, name being the
+           _id of the doc (not necessarily stored in it).'''
+        return [(hit['_id'], hit['_source']) for hit in self._scan()]
+
+    def get_versions(self):
+        '''return (name, version) of all named filters, cheap way to
+           know if any filter changed.'''
+        return tuple(sorted((hit['_id'], hit['_version'])
+                            for hit in self._scan(version=True, _source=False)))
 
     def delete(self, name, noconfirm=False):
         '''delete a named filter.'''
@@ -84,3 +108,78 @@ class UserFilters(object):
         else:
             print('Filter "{}" does not exist. Abort now.'.format(name))
 
+
+
+class UserFiltersCache(object):
+    '''All named filters, kept in memory so that filtered queries cost no
+       extra request to ES. Filters are reloaded in a background thread
+       when they changed (checked at most once every "check_interval"
+       seconds, on lookups). Each filter is also kept serialized as JSON,
+       large "terms" filters being costly to serialize on every query.
+       "version" is incremented each time filters are reloaded.
+    '''
+    def __init__(self, userfilters, check_interval=60):
+        self.userfilters = userfilters
+        self.check_interval = check_interval
+        self.version = 0
+        self._filters = None    # name -> (filter doc, filter as json)
+        self._versions = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self):
+        '''(re)load all filters if they changed.'''
+        versions = self.userfilters.get_versions()
+        if versions == self._versions:
+            return
+        filters = {}
+        for name, doc in self.userfilters.get_all_named():
+            if 'filter' in doc:
+                filters[name] = (doc, json.dumps(doc['filter']))
+        self._filters = filters
+        self._versions = versions
+        self.version += 1
+
+    def _refresh(self):
+        try:
+            self.load()
+        except Exception as err:
+            # keep current filters
+            logging.error("Cannot reload userfilters: %s" % err)
+        finally:
+            self._refreshing = False
+
+    def maybe_refresh(self):
+        now = time.time()
+        with self._lock:
+            if self._refreshing or now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _get(self, name):
+        if self._filters is None:
+            # not loaded yet, the only time a lookup waits for ES
+            with self._lock:
+                if self._filters is None:
+                    self.load()
+                    self._last_check = time.time()
+        else:
+            self.maybe_refresh()
+        return self._filters.get(name)
+
+    def get(self, name):
+        '''same as UserFilters.get, the returned doc must not be modified.'''
+        entry = self._get(name)
+        return entry[0] if entry else None
+
+    def get_json(self, name):
+        '''return the filter of a named filter, serialized as JSON.'''
+        entry = self._get(name)
+        return entry[1] if entry else None
+
+    def stats(self):
+        return {'filters': len(self._filters or {}),
+                'version': self.version}
@@ -1,5 +1,8 @@
 import re
 import json
+import zlib
+import base64
+import hashlib
 
 from tornado.web import HTTPError
 from biothings.www.api.handlers import MetaDataHandler, BiothingHandler, QueryHandler, \
@@ -7,21 +10,88 @@ from biothings.www.api.handlers import MetaDataHandler, BiothingHandler, QueryHa
 
 from biothings.utils.version import get_software_info
 from biothings.settings import BiothingSettings
-from utils.es import ESQuery
+from elasticsearch.exceptions import TransportError
+from utils.es import (ESQuery, ESQueryBuilder, QueryError, user_filters,
+                      source_stats)
+from utils.es_async import ESQueryAsync
 from biothings.utils.common import split_ids
-from config import GA_EVENT_CATEGORY
+from utils.cache import ResponseCache, SingleFlight
+from utils.interval_index import GenomicIntervalIndexLoader
+from utils.es_pool import es_nodes_status
+from config import (GA_EVENT_CATEGORY, RESPONSE_CACHE_MAX_SIZE,
+                    RESPONSE_CACHE_TTL, RESPONSE_CACHE_CHECK_INTERVAL,
+                    MGET_STREAM_BATCH_SIZE, GENOMIC_INTERVAL_INDEX_SPECIES,
+                    GENOMIC_INTERVAL_INDEX_CHECK_INTERVAL,
+                    ES_SOURCE_DEFAULT_EXCLUDES)
 import os, logging
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 mygene_settings = BiothingSettings()
 
+# shared by all handlers of this process
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_SIZE,
+                               ttl=RESPONSE_CACHE_TTL,
+                               index_version=ESQuery().index_version,
+                               check_interval=RESPONSE_CACHE_CHECK_INTERVAL)
+# identical concurrent requests share one ES call
+single_flight = SingleFlight()
+
+# load named filters now, not on first filtered query
+user_filters.maybe_refresh()
+
+if GENOMIC_INTERVAL_INDEX_SPECIES:
+    _esq = ESQuery()
+    ESQueryBuilder.genomic_interval_index = GenomicIntervalIndexLoader(
+        GENOMIC_INTERVAL_INDEX_SPECIES, _esq.genomic_pos_feeder,
+        _esq.index_version, check_interval=GENOMIC_INTERVAL_INDEX_CHECK_INTERVAL)
+    # build it now, not on first interval query
+    ESQueryBuilder.genomic_interval_index.maybe_refresh()
+
+
+class MGetStreamMixin(object):
+    '''Write responses to large batches of ids as a chunked JSON array,
+       one sub-batch of MGET_STREAM_BATCH_SIZE ids at a time, instead of
+       building the whole list in memory first.
+    '''
+    stream_batch_size = MGET_STREAM_BATCH_SIZE
+
+    def _can_stream(self, ids, kwargs):
+        if not self.stream_batch_size or len(ids) <= self.stream_batch_size:
+            return False
+        # raw ES responses, jsonp and msgpack are not streamed
+        return not (kwargs.get('raw') or kwargs.get('rawquery') or
+                    self.get_argument('callback', None) or
+                    self.get_argument('msgpack', None))
+
+    async def _stream_mget(self, ids, kwargs):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('[')
+        sep = ''
+        for i in range(0, len(ids), self.stream_batch_size):
+            batch = ids[i:i + self.stream_batch_size]
+            res = await self.esq_async.mget_gene(batch, **kwargs)
+            if not isinstance(res, list):
+                # response status is already sent, report a failed
+                # sub-batch per id
+                res = [{'query': _id, 'error': True} for _id in batch]
+            if res:
+                self.write(sep + ','.join(json.dumps(doc) for doc in res))
+                sep = ','
+            # wait for the client to get this chunk before the next one
+            await self.flush()
+        self.write(']')
+
 
 class MyGeneMetaDataHandler(MetaDataHandler):
     '''Return db metadata in json string.'''
     disable_caching = True
-    esq = ESQuery()
+    esq = ESQueryAsync()
 
-    def get(self):
-        _meta = self.esq.metadata()
+    async def get(self):
+        _meta = await self.esq.metadata()
         self._fill_software_info(_meta)
         _meta["app_revision"] = os.environ["MYGENE_REVISION"]
         self.return_json(_meta, indent=2)
@@ -30,10 +100,13 @@ class MyGeneFieldsHandler(FieldsHandler):
     ''' This class is for the /metadata/fields endpoint. '''
     esq = ESQuery()
 
-class GeneHandler(BiothingHandler):
+class GeneHandler(MGetStreamMixin, BiothingHandler):
     esq = ESQuery()
+    esq_async = ESQueryAsync()
+    response_cache = response_cache
+    single_flight = single_flight
 
-    def get(self, geneid=None):
+    async def get(self, geneid=None):
         '''/gene/<geneid>
            geneid can be entrezgene, ensemblgene, retired entrezgene ids.
            /gene/1017
@@ -44,7 +117,7 @@ class GeneHandler(BiothingHandler):
             kwargs = self.get_query_params()
             kwargs.setdefault('scopes', 'entrezgene,ensemblgene,retired')
             kwargs.setdefault('species', 'all')
-            gene = self.esq.get_gene(geneid, **kwargs)
+            gene = await self._get_gene(geneid, kwargs)
             if gene:
                 self.return_json(gene)
                 self.ga_track(event={'category': GA_EVENT_CATEGORY,
@@ -54,9 +127,158 @@ class GeneHandler(BiothingHandler):
         else:
             raise HTTPError(404)
 
+    async def _get_gene(self, geneid, kwargs):
+        # key is made first, get_gene consumes kwargs
+        key = self.response_cache.make_key('gene', geneid, kwargs)
+        gene = self.response_cache.get(key) if self.response_cache.enabled else None
+        if gene is None:
+            gene = await self.single_flight.do(key, self._fetch_gene, key,
+                                               geneid, kwargs)
+        return gene
+
+    async def _fetch_gene(self, key, geneid, kwargs):
+        gene = await self.esq_async.get_gene(geneid, **kwargs)
+        if gene and self.response_cache.enabled:
+            self.response_cache.set(key, gene)
+        return gene
+
+    async def post(self, geneid=None):
+        '''
+           This is essentially the same as post request in QueryHandler, with different defaults.
 
-class QueryHandler(QueryHandler):
+           parameters:
+            ids
+            fields
+            species
+        '''
+        kwargs = self.get_query_params()
+        ids = kwargs.pop('ids', None)
+        if ids:
+            ids = split_ids(ids)
+        if ids:
+            kwargs['scopes'] = 'entrezgene,ensemblgene,retired'
+            kwargs.setdefault('species', 'all')
+            if self._can_stream(ids, kwargs):
+                res = None
+                await self._stream_mget(ids, kwargs)
+            else:
+                res = await self.esq_async.mget_gene(ids, **kwargs)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+
+        if res is not None:
+            self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'gene_post',
+                             'label': 'qsize',
+                             'value': len(ids) if ids else 0})
+
+
+class QueryHandler(MGetStreamMixin, QueryHandler):
     esq = ESQuery()
+    esq_async = ESQueryAsync()
+    response_cache = response_cache
+    single_flight = single_flight
+
+    async def _cached(self, q, kwargs, func):
+        '''return cached response for query "q" with parameters "kwargs" if
+           any, otherwise the result of "func(q, **kwargs)" (a coroutine
+           function), shared with identical requests in flight and cached
+           unless it's an error.
+        '''
+        key = self.response_cache.make_key('query_' + self.request.method.lower(),
+                                           q, kwargs)
+        if self.response_cache.enabled:
+            res = self.response_cache.get(key)
+            if res is not None:
+                return res
+        return await self.single_flight.do(key, self._fetch, key, q, kwargs, func)
+
+    async def _fetch(self, key, q, kwargs, func):
+        res = await func(q, **kwargs)
+        if self.response_cache.enabled and \
+           not (isinstance(res, dict) and ('error' in res or
+                                           res.get('success') is False)):
+            self.response_cache.set(key, res)
+        return res
+
+    async def get(self):
+        '''
+        parameters:
+            q
+            fields
+            from
+            size
+            sort
+            species
+
+            explain
+        '''
+        kwargs = self.get_query_params()
+        if kwargs.get('fetch_all') or kwargs.get('scroll_id'):
+            # scrolls are stateful on ES side, kept on the blocking path
+            return super(QueryHandler, self).get()
+        q = kwargs.pop('q', None)
+        res = None
+        if q:
+            kwargs = self._check_paging_param(kwargs)
+            explain = self.get_argument('explain', None)
+            if explain and explain.lower() == 'true':
+                kwargs['explain'] = True
+            for arg in ['from', 'size']:
+                value = kwargs.get(arg, None)
+                if value:
+                    try:
+                        kwargs[arg] = int(value)
+                    except ValueError:
+                        res = {'success': False, 'error': 'Parameter "{}" must be an integer.'.format(arg)}
+            if res is None:
+                res = await self._cached(q, kwargs, self.esq_async.query)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+
+        self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'query_get',
+                             'label': 'qsize',
+                             'value': len(q) if q else 0})
+
+    async def post(self):
+        '''
+        parameters:
+            q
+            scopes
+            fields
+            species
+
+            jsoninput   if true, input "q" is a json string, must be decoded as a list.
+        '''
+        kwargs = self.get_query_params()
+        q = kwargs.pop('q', None)
+        jsoninput = kwargs.pop('jsoninput', None) in ('1', 'true')
+        if q:
+            try:
+                ids = json.loads(q) if jsoninput else split_ids(q)
+                if not isinstance(ids, list):
+                    raise ValueError
+            except ValueError:
+                ids = None
+            if not ids:
+                res = {'success': False, 'error': 'Invalid input for "q" parameter.'}
+            elif self._can_stream(ids, kwargs):
+                res = None
+                await self._stream_mget(ids, kwargs)
+            else:
+                res = await self._cached(ids, kwargs, self.esq_async.mget_gene)
+        else:
+            res = {'success': False, 'error': "Missing required parameters."}
+
+        if res is not None:
+            self.return_json(res)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'query_post',
+                             'label': 'qsize',
+                             'value': len(q) if q else 0})
 
     # over ride from biothings BaseHandler to stop renaming "from" to "from_"
     def _check_paging_param(self, kwargs):
@@ -77,6 +299,129 @@ class QueryHandler(QueryHandler):
                 pass
         return kwargs
 
+class MyGeneCacheStatusHandler(BaseHandler):
+    ''' This class is for the /status/cache endpoint. '''
+    disable_caching = True
+    esq = ESQuery()
+
+    def get(self):
+        _stats = {'response_cache': response_cache.stats(),
+                  'single_flight': single_flight.stats(),
+                  'userfilters': user_filters.stats()}
+        if ES_SOURCE_DEFAULT_EXCLUDES:
+            try:
+                field_costs = self.esq.field_costs()
+            except TransportError:
+                field_costs = None
+            _stats['source_excludes'] = source_stats.stats(field_costs=field_costs)
+        if ESQueryBuilder.genomic_interval_index:
+            _stats['genomic_interval_index'] = ESQueryBuilder.genomic_interval_index.stats()
+        self.return_json(_stats, indent=2)
+
+
+class ExportHandler(BaseHandler):
+    '''/export?q=<query>&fields=<fields>&format=ndjson|msgpack
+
+       Stream all genes matching "q" (same parameters as /query, except
+       for paging and sorting), as newline-delimited JSON (default) or as
+       a sequence of msgpack objects, gzip-compressed if the client
+       accepts it. A {"_cursor": <token>} record follows each page of
+       genes: pass the last one received as "cursor" parameter to resume
+       an interrupted export. The last record is {"_cursor": null}.
+    '''
+    disable_caching = True
+    esq_async = ESQueryAsync()
+    content_types = {'ndjson': 'application/x-ndjson',
+                     'msgpack': 'application/x-msgpack'}
+
+    def _get_export_key(self, q, kwargs):
+        '''a digest of the export parameters, so that a cursor is only
+           used to resume the same export.'''
+        key = response_cache.make_key('export', q, kwargs)
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+
+    def _encode_cursor(self, key, sent):
+        return base64.urlsafe_b64encode(json.dumps({'key': key, 'sent': sent}).encode('utf-8')).decode('ascii')
+
+    def _decode_cursor(self, cursor, key):
+        '''return the number of genes already sent per shard.'''
+        _cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if _cursor['key'] != key:
+            raise ValueError('cursor from another export')
+        return dict((int(shard), int(n)) for (shard, n) in _cursor['sent'].items())
+
+    def _encode(self, fmt, doc):
+        if fmt == 'msgpack':
+            return msgpack.packb(doc, use_bin_type=True)
+        return (json.dumps(doc) + '\n').encode('utf-8')
+
+    def _set_export_headers(self, fmt, gzip):
+        self.set_header('Content-Type', self.content_types[fmt])
+        if gzip:
+            self.set_header('Content-Encoding', 'gzip')
+
+    async def get(self):
+        kwargs = self.get_query_params()
+        q = kwargs.pop('q', None)
+        fmt = kwargs.pop('format', 'ndjson')
+        cursor = kwargs.pop('cursor', None)
+        for arg in ['from', 'size', 'skip', 'limit', 'sort', 'fetch_all',
+                    'scroll_id', 'callback', 'msgpack']:
+            kwargs.pop(arg, None)
+        if not q:
+            return self.return_json({'success': False, 'error': "Missing required parameters."})
+        if fmt not in self.content_types:
+            return self.return_json({'success': False, 'error': 'Parameter "format" must be one of: {}.'.format(
+                ', '.join(sorted(self.content_types)))})
+        if fmt == 'msgpack' and msgpack is None:
+            return self.return_json({'success': False, 'error': 'msgpack format is not available.'})
+        key = self._get_export_key(q, kwargs)
+        sent = {}
+        if cursor:
+            try:
+                sent = self._decode_cursor(cursor, key)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return self.return_json({'success': False, 'error': 'Invalid input for "cursor" parameter.'})
+
+        gzip = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzip else None
+        started = False
+        export = self.esq_async.export(q, sent=sent, **kwargs)
+        try:
+            async for shard, docs in export:
+                if not started:
+                    started = True
+                    self._set_export_headers(fmt, gzip)
+                sent[shard] = sent.get(shard, 0) + len(docs)
+                docs.append({'_cursor': self._encode_cursor(key, sent)})
+                chunk = b''.join([self._encode(fmt, doc) for doc in docs])
+                self.write(compressor.compress(chunk) if gzip else chunk)
+                # wait for the client to get this chunk before the next one
+                await self.flush()
+        except (QueryError, TransportError) as err:
+            if started:
+                raise
+            return self.return_json({'success': False, 'error': "invalid query term."})
+        finally:
+            await export.aclose()
+        if not started:
+            self._set_export_headers(fmt, gzip)
+        chunk = self._encode(fmt, {'_cursor': None})
+        self.write(compressor.compress(chunk) + compressor.flush() if gzip else chunk)
+        self.ga_track(event={'category': GA_EVENT_CATEGORY,
+                             'action': 'export',
+                             'label': 'qsize',
+                             'value': sum(sent.values())})
+
+
+class MyGeneESStatusHandler(BaseHandler):
+    ''' This class is for the /status/es endpoint. '''
+    disable_caching = True
+
+    def get(self):
+        self.return_json({'nodes': es_nodes_status()}, indent=2)
+
+
 class TaxonHandler(BaseHandler):
 
     def get(self, taxid):
@@ -87,6 +432,7 @@ APP_LIST = [
     (r"/gene/([\w\-\.]+)/?", GeneHandler),   # for gene get request
     (r"/gene/?$", GeneHandler),              # for gene post request
     (r"/query/?", QueryHandler),
+    (r"/export/?", ExportHandler),
     (r"/species/(\d+)/?", TaxonHandler),
     (r"/taxon/(\d+)/?", TaxonHandler),
     (r"/metadata", MyGeneMetaDataHandler),
@@ -62,6 +62,8 @@ from demo.handlers import APP_LIST as demo_app_list
 #from auth.handlers import APP_LIST as auth_app_list
 from www.api.handlers import MyGeneMetaDataHandler
 from www.api.handlers import MyGeneFieldsHandler
+from www.api.handlers import MyGeneCacheStatusHandler
+from www.api.handlers import MyGeneESStatusHandler
 
 
 from config import INCLUDE_DOCS
@@ -74,6 +76,8 @@ if INCLUDE_DOCS and not os.path.exists(DOCS_STATIC_PATH):
 APP_LIST = [
     (r"/", MainHandler),
     (r"/status", MyGeneStatusHandler),
+    (r"/status/cache", MyGeneCacheStatusHandler),
+    (r"/status/es", MyGeneESStatusHandler),
     (r"/metadata", MyGeneMetaDataHandler),
     #TODO: what is v2a ?
     (r"/v2a/metadata", MyGeneMetaDataHandler),